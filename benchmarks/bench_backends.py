@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# Compares how the FUSE backends handle many clients at once, by sending the same
+# mix of requests from several concurrent clients through each backend's dispatch:
+#
+#   fusepy          one request at a time, as fusepy runs without --threads
+#   fusepy-threads  every client's requests on its own thread, as with --threads
+#   pyfuse3         trio tasks through InodeOperations, with files read on its worker threads
+#
+# Each client opens random files, reads them in 128KiB pieces from a random offset
+# and looks up random paths in between, like a file indexer or a Samba client would.
+# The kernel and the FUSE libraries aren't involved, so the numbers show how the
+# backends overlap requests, not the cost of the round trips through the kernel.
+#
+# Usage: bench_backends.py <backup> [--password PASSWORD] [--clients N] [--requests N]
+import os
+import sys
+import time
+import queue
+import random
+import argparse
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from mount_ios_backup.standard_backup import BackupFS
+from mount_ios_backup.encrypted_backup import EncryptedBackupFS
+from mount_ios_backup.inode_operations import InodeOperations, DEFAULT_WORKERS
+import trio
+
+BACKENDS = ("fusepy", "fusepy-threads", "pyfuse3")
+READ_SIZE = 128 * 1024
+# Pieces read from each opened file
+READS_PER_FILE = 8
+
+def create_fs(args):
+    if args.password is None:
+        return BackupFS(args.backup)
+    # No readahead or block cache, so every read is decrypted
+    return EncryptedBackupFS(args.backup, args.password, readahead_size=0, cache_size=0)
+
+def list_entries(fs, path="/"):
+    for entry in fs("readdir", path, 0):
+        name = entry if isinstance(entry, str) else entry[0]
+        if name in (".", ".."):
+            continue
+        child = f"{path.rstrip('/')}/{name}"
+        attrs = fs("getattr", child)
+        yield (child, attrs)
+        if attrs["st_mode"] & 0o170000 == 0o040000:
+            yield from list_entries(fs, child)
+
+def client_script(rng, files, paths, requests):
+    """
+    Returns the requests of one client: ("open", path, size), ("read", offset), ("release",) and ("getattr", path).
+    """
+    script = []
+    while len(script) < requests:
+        (path, size) = rng.choice(files)
+        script.append(("open", path, size))
+        offset = rng.randrange(max(1, size - READ_SIZE * READS_PER_FILE))
+        for piece in range(READS_PER_FILE):
+            script.append(("read", offset + piece * READ_SIZE))
+            script.append(("getattr", rng.choice(paths)))
+        script.append(("release",))
+    return script
+
+def _run_path_request(fs, request, state):
+    # The same requests as the kernel would send to a fusepy filesystem
+    if request[0] == "open":
+        state["path"] = request[1]
+        state["fh"] = fs("open", request[1], os.O_RDONLY)
+    elif request[0] == "read":
+        return len(fs("read", state["path"], READ_SIZE, request[1], state["fh"]))
+    elif request[0] == "release":
+        fs("release", state["path"], state["fh"])
+    else:
+        fs("getattr", request[1])
+    return 0
+
+def run_fusepy(fs, scripts):
+    # Clients queue their requests for the one thread that handles them, and wait for each reply
+    requests = queue.Queue()
+    def serve():
+        while True:
+            item = requests.get()
+            if item is None:
+                return
+            (request, state, reply) = item
+            reply.put(_run_path_request(fs, request, state))
+    server = threading.Thread(target=serve)
+    server.start()
+    latencies = []
+    totals = []
+    def client(script):
+        state = {}
+        reply = queue.Queue()
+        total = 0
+        for request in script:
+            start = time.perf_counter()
+            requests.put((request, state, reply))
+            total += reply.get()
+            latencies.append(time.perf_counter() - start)
+        totals.append(total)
+    threads = [threading.Thread(target=client, args=(script,)) for script in scripts]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    requests.put(None)
+    server.join()
+    return (latencies, sum(totals))
+
+def run_fusepy_threads(fs, scripts):
+    latencies = []
+    totals = []
+    def client(script):
+        state = {}
+        total = 0
+        for request in script:
+            start = time.perf_counter()
+            total += _run_path_request(fs, request, state)
+            latencies.append(time.perf_counter() - start)
+        totals.append(total)
+    threads = [threading.Thread(target=client, args=(script,)) for script in scripts]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return (latencies, sum(totals))
+
+def run_pyfuse3(fs, scripts, workers):
+    operations = InodeOperations(fs, workers)
+    latencies = []
+    totals = []
+    # path -> inode, standing in for the kernel's dentry cache
+    inodes = {"/": 1}
+
+    async def lookup_path(path):
+        # Resolved a component at a time the first time, as the kernel does
+        inode = inodes.get(path)
+        if inode is None:
+            (parent, name) = path.rsplit("/", 1)
+            inode = (await operations.lookup(await lookup_path(parent or "/"), name))["st_ino"]
+            inodes[path] = inode
+        return inode
+
+    async def client(script):
+        fh = None
+        total = 0
+        for request in script:
+            start = time.perf_counter()
+            if request[0] == "open":
+                (fh, _) = await operations.open(await lookup_path(request[1]), os.O_RDONLY)
+            elif request[0] == "read":
+                total += len(await operations.read(fh, request[1], READ_SIZE))
+            elif request[0] == "release":
+                await operations.release(fh)
+            else:
+                await operations.getattr(await lookup_path(request[1]))
+            latencies.append(time.perf_counter() - start)
+        totals.append(total)
+
+    async def main():
+        async with trio.open_nursery() as nursery:
+            for script in scripts:
+                nursery.start_soon(client, script)
+    trio.run(main)
+    return (latencies, sum(totals))
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Compare the FUSE backends with many concurrent clients, without mounting.")
+    arg_parser.add_argument("backup", help="the backup folder to benchmark")
+    arg_parser.add_argument("--password", help="the backup password, if encrypted")
+    arg_parser.add_argument("--clients", type=int, default=32, help="number of concurrent clients (default: %(default)s)")
+    arg_parser.add_argument("--requests", type=int, default=500, help="requests sent by each client (default: %(default)s)")
+    arg_parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="worker threads of the pyfuse3 backend (default: %(default)s)")
+    arg_parser.add_argument("--backends", default=",".join(BACKENDS), help="comma-separated backends to run (default: %(default)s)")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    args = arg_parser.parse_args()
+
+    fs = create_fs(args)
+    fs("init", "/")
+    entries = list(list_entries(fs))
+    files = [(path, attrs["st_size"]) for (path, attrs) in entries
+             if attrs["st_mode"] & 0o170000 == 0o100000 and attrs["st_size"] > 0 and not path.startswith("/.mount-ios-backup")]
+    paths = [path for (path, _) in entries]
+    rng = random.Random(args.seed)
+    scripts = [client_script(rng, files, paths, args.requests) for _ in range(args.clients)]
+    # Warm the page cache, so every backend reads from memory
+    run_fusepy_threads(fs, scripts)
+
+    print(f"{'backend':16} {'requests':>9} {'time s':>8} {'req/s':>9} {'MB/s':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for backend in args.backends.split(","):
+        if backend not in BACKENDS:
+            arg_parser.error(f"unknown backend: {backend}")
+        start = time.perf_counter()
+        if backend == "fusepy":
+            (latencies, total) = run_fusepy(fs, scripts)
+        elif backend == "fusepy-threads":
+            (latencies, total) = run_fusepy_threads(fs, scripts)
+        else:
+            (latencies, total) = run_pyfuse3(fs, scripts, args.workers)
+        elapsed = time.perf_counter() - start
+        print(f"{backend:16} {len(latencies):9} {elapsed:8.2f} {len(latencies) / elapsed:9.0f} {total / 2**20 / elapsed:8.1f} "
+              f"{percentile(latencies, 0.5) * 1000:8.2f} {percentile(latencies, 0.99) * 1000:8.2f}")
+    fs("destroy", "/")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# Compares the specialised MBFile decoder with generic biplist parsing
+# on the `file` column of a (decrypted or unencrypted) Manifest.db.
+#
+# Usage: bench_mbfile.py <backup directory or Manifest.db> [repeats]
+import os
+import sys
+import time
+import sqlite3
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from mount_ios_backup import mbfile
+
+def timed(function, blobs, repeats):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function(blobs)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return (best, result)
+
+def main():
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} <backup directory or Manifest.db> [repeats]")
+        sys.exit(1)
+    db_path = sys.argv[1]
+    if os.path.isdir(db_path):
+        db_path = os.path.join(db_path, "Manifest.db")
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    connection = sqlite3.connect(db_path)
+    blobs = [row[0] for row in connection.execute("SELECT `file` FROM `Files` WHERE `file` IS NOT NULL")]
+    connection.close()
+    print(f"{len(blobs)} entries")
+
+    (biplist_time, expected) = timed(lambda blobs: [mbfile._decode_with_biplist(blob) for blob in blobs], blobs, repeats)
+    (fast_time, actual) = timed(lambda blobs: mbfile.MBFileDecoder().decode_all(blobs), blobs, repeats)
+    mismatches = sum(1 for (a, b) in zip(expected, actual) if a != b)
+
+    for (name, elapsed) in (("biplist", biplist_time), ("mbfile", fast_time)):
+        print(f"{name:8} {elapsed:8.3f}s {len(blobs) / elapsed:12.0f} entries/s")
+    print(f"Speedup: {biplist_time / fast_time:.1f}x")
+    if mismatches > 0:
+        print(f"{mismatches} entries decoded differently!")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# Compares the memory used by the metadata index with that of keeping one
+# FileInfo (with a dict of properties) per entry, as earlier versions did.
+#
+# Usage: bench_memory.py <backup directory or Manifest.db> [copies]
+#
+# The manifest must be unencrypted. With copies > 1, every entry is added that
+# many times (under different paths) to simulate a larger backup.
+import os
+import sys
+import time
+import sqlite3
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from mount_ios_backup.file_info import FileInfo
+from mount_ios_backup.metadata_index import MetadataIndex, read_manifest
+
+def read_rows(db_path, copies):
+    connection = sqlite3.connect(db_path)
+    rows = list(read_manifest(connection))
+    connection.close()
+    for copy in range(copies):
+        for ((file_id, domain, relative_path, flags), properties) in rows:
+            if copy > 0:
+                relative_path = f"copy{copy}/{relative_path}"
+            # Copy the strings, as they would be if they came from the database
+            yield (file_id.encode().decode(), domain.encode().decode(), relative_path.encode().decode(), flags, dict(properties))
+
+def build_objects(root, rows):
+    entries = {}
+    children = {}
+    for (file_id, domain, relative_path, flags, properties) in rows:
+        entries[(domain, relative_path)] = FileInfo(root, file_id, domain, relative_path, properties, flags)
+        if len(relative_path) > 0:
+            (parent, _, name) = relative_path.rpartition("/")
+            children.setdefault((domain, parent), []).append(name)
+    return (entries, children)
+
+def build_index(root, rows):
+    index = MetadataIndex(root)
+    for (file_id, domain, relative_path, flags, properties) in rows:
+        index.add(file_id, domain, relative_path, flags, properties)
+    return index
+
+def measure(build, root, db_path, copies):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = build(root, read_rows(db_path, copies))
+    elapsed = time.perf_counter() - start
+    (size, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (result, size, peak, elapsed)
+
+def main():
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} <backup directory or Manifest.db> [copies]")
+        sys.exit(1)
+    db_path = sys.argv[1]
+    if os.path.isdir(db_path):
+        db_path = os.path.join(db_path, "Manifest.db")
+    root = os.path.dirname(os.path.abspath(db_path))
+    copies = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+
+    results = []
+    for (name, build) in (("objects", build_objects), ("index", build_index)):
+        (result, size, peak, elapsed) = measure(build, root, db_path, copies)
+        results.append(result)
+        count = len(result[0]) if isinstance(result, tuple) else len(result)
+        print(f"{name:8} {count:9} entries {size / 2**20:9.1f}MiB ({size / count:6.0f}B/entry), peak {peak / 2**20:9.1f}MiB, {elapsed:6.2f}s")
+
+    # Both must describe the same entries
+    (entries, _) = results[0]
+    index = results[1]
+    for ((domain, relative_path), file_info) in entries.items():
+        other = index.get(domain, relative_path)
+        if other is None or (other.hash, other.flags, other.properties) != (file_info.hash, file_info.flags, file_info.properties):
+            print(f"Mismatch for {domain} {relative_path}!")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# Generates a synthetic iOS backup for benchmarking, with a Manifest.plist,
+# a Manifest.db with MBFile archives and files in the usual hashed layout.
+#
+# With --password, the backup is encrypted like a real one: files with their own
+# keys wrapped by class keys, class keys wrapped by a key derived from the password.
+# The number of key derivation iterations is much lower than on a real device,
+# so mounting doesn't spend most of its time there.
+#
+# The same arguments (including --seed) always give the same backup.
+#
+# Usage: generate_backup.py <output folder> [options], see --help
+import os
+import sys
+import struct
+import random
+import sqlite3
+import hashlib
+import argparse
+import biplist
+from Crypto.Cipher import AES
+
+# Protection class used for file keys and for the manifest key, as on real backups
+FILE_PROTECTION_CLASS = 3
+MANIFEST_PROTECTION_CLASS = 4
+# Start of the range of modification times given to entries
+BASE_TIME = 1600000000
+
+FIXED_DOMAINS = ("HomeDomain", "MediaDomain", "CameraRollDomain", "KeychainDomain", "WirelessDomain")
+
+def _aes_wrap(kek, key):
+    # RFC 3394 key wrap, the inverse of AESUnwrap in google_iphone_dataprotection.py
+    blocks = [key[i:i + 8] for i in range(0, len(key), 8)]
+    a = 0xA6A6A6A6A6A6A6A6
+    cipher = AES.new(kek, AES.MODE_ECB)
+    for j in range(6):
+        for i in range(len(blocks)):
+            b = cipher.encrypt(struct.pack(">Q", a) + blocks[i])
+            a = struct.unpack(">Q", b[:8])[0] ^ (len(blocks) * j + i + 1)
+            blocks[i] = b[8:]
+    return struct.pack(">Q", a) + b"".join(blocks)
+
+def _random_bytes(rng, count):
+    # Random.randbytes needs Python 3.9
+    if count == 0:
+        return b""
+    return rng.getrandbits(count * 8).to_bytes(count, "little")
+
+def _pad(data):
+    padding = 16 - len(data) % 16
+    return data + bytes([padding]) * padding
+
+def _tlv(tag, value):
+    if isinstance(value, int):
+        value = struct.pack(">L", value)
+    return tag + struct.pack(">L", len(value)) + value
+
+def _mbfile(relative_path, mode, size, mtime, inode, encryption_key=None, target=None, digest=None):
+    # NSKeyedArchiver layout of an MBFile, as found in the `file` column of real manifests
+    properties = {
+        "LastModified": mtime, "LastStatusChange": mtime + 1, "Birth": mtime - 1,
+        "Size": size, "Mode": mode, "UserID": 501, "GroupID": 501, "Flags": 0,
+        "InodeNumber": inode, "ProtectionClass": FILE_PROTECTION_CLASS,
+        "RelativePath": biplist.Uid(2),
+    }
+    objects = ["$null", properties, relative_path]
+    if encryption_key is not None:
+        properties["EncryptionKey"] = biplist.Uid(len(objects))
+        objects.append({"NS.data": biplist.Data(encryption_key), "$class": biplist.Uid(len(objects) + 1)})
+        objects.append({"$classname": "NSMutableData", "$classes": ["NSMutableData", "NSData", "NSObject"]})
+    if target is not None:
+        properties["Target"] = biplist.Uid(len(objects))
+        objects.append(target)
+    if digest is not None:
+        # SHA-1 of the contents, archived as plain NSData
+        properties["Digest"] = biplist.Uid(len(objects))
+        objects.append(biplist.Data(digest))
+    properties["$class"] = biplist.Uid(len(objects))
+    objects.append({"$classname": "MBFile", "$classes": ["MBFile", "NSObject"]})
+    return biplist.writePlistToString({"$version": 100000, "$archiver": "NSKeyedArchiver",
+                                       "$top": {"root": biplist.Uid(1)}, "$objects": objects})
+
+def _domain_names(count):
+    names = list(FIXED_DOMAINS[:count])
+    for index in range(count - len(names)):
+        if index % 3 == 2:
+            names.append(f"AppDomainGroup-group.com.example.app{index}")
+        else:
+            names.append(f"AppDomain-com.example.app{index}")
+    return names
+
+def generate_backup(path, files=1000, domains=5, depth=4, median_size=16 * 1024, max_size=4 * 1024 * 1024,
+                    password=None, seed=0, iterations=1000):
+    """
+    Writes a backup with the given number of files (plus directories and symlinks)
+    spread over the given number of domains, at most depth directories deep.
+
+    File sizes follow a log-normal distribution around median_size, capped at max_size.
+    Returns a dict of (domain, relativePath) -> contents for every file.
+    """
+    rng = random.Random(seed)
+    os.makedirs(path, exist_ok=True)
+    class_keys = dict((protection_class, _random_bytes(rng, 32)) for protection_class in range(1, 12))
+    db_path = os.path.join(path, "Manifest.db")
+    plain_db_path = db_path + ".plain" if password is not None else db_path
+    if os.path.exists(plain_db_path):
+        os.remove(plain_db_path)
+    db = sqlite3.connect(plain_db_path)
+    db.executescript("""
+    CREATE TABLE Files (fileID TEXT PRIMARY KEY, domain TEXT, relativePath TEXT, flags INTEGER, file BLOB);
+    CREATE INDEX FilesDomainIdx ON Files(domain);
+    CREATE INDEX FilesRelativePathIdx ON Files(relativePath);
+    CREATE TABLE Properties (key TEXT PRIMARY KEY, value BLOB);
+    """)
+    contents = {}
+
+    def add_entry(domain, relative_path, flags, mode, data=None, target=None):
+        file_id = hashlib.sha1(f"{domain}-{relative_path}".encode("utf-8")).hexdigest()
+        size = 0
+        encryption_key = None
+        digest = None
+        if flags == 1:
+            size = len(data)
+            blob = data
+            if password is not None:
+                file_key = _random_bytes(rng, 32)
+                encryption_key = struct.pack("<l", FILE_PROTECTION_CLASS) + _aes_wrap(class_keys[FILE_PROTECTION_CLASS], file_key)
+                blob = AES.new(file_key, AES.MODE_CBC, b"\x00" * 16).encrypt(_pad(data))
+            os.makedirs(os.path.join(path, file_id[:2]), exist_ok=True)
+            with open(os.path.join(path, file_id[:2], file_id), 'wb') as outfile:
+                outfile.write(blob)
+            contents[(domain, relative_path)] = data
+            digest = hashlib.sha1(data).digest()
+        mbfile = _mbfile(relative_path, mode, size, BASE_TIME + rng.randrange(10 ** 7), rng.randrange(1, 10 ** 9), encryption_key, target, digest)
+        db.execute("INSERT INTO Files VALUES (?, ?, ?, ?, ?)", (file_id, domain, relative_path, flags, mbfile))
+
+    domain_names = _domain_names(domains)
+    # (relativePath, depth) of each directory per domain
+    directories = {}
+    for domain in domain_names:
+        add_entry(domain, "", 2, 0o40755)
+        directories[domain] = [("", 0)]
+    for index in range(files):
+        # Earlier domains get more of the files, like HomeDomain and MediaDomain on a real backup
+        domain = domain_names[min(int(rng.expovariate(3 / len(domain_names))), len(domain_names) - 1)]
+        (parent, parent_depth) = rng.choice(directories[domain])
+        # Some new directories along the way, so files end up at all depths
+        while parent_depth < depth and rng.random() < 0.15:
+            parent = f"{parent}/d{index}" if parent else f"d{index}"
+            parent_depth += 1
+            add_entry(domain, parent, 2, 0o40755)
+            directories[domain].append((parent, parent_depth))
+        name = f"f{index}"
+        relative_path = f"{parent}/{name}" if parent else name
+        if rng.random() < 0.02:
+            add_entry(domain, relative_path, 4, 0o120755, target=f"/private/var/mobile/{name}")
+            continue
+        size = min(int(rng.lognormvariate(0, 1.5) * median_size), max_size)
+        add_entry(domain, relative_path, 1, 0o100644, data=_random_bytes(rng, size))
+    db.commit()
+    db.close()
+
+    plist = {"IsEncrypted": password is not None, "Version": "10.0", "Date": "2024-01-01T00:00:00Z",
+             "Lockdown": {"DeviceName": "Synthetic", "ProductVersion": "17.0"}}
+    if password is not None:
+        # Keybag as in a real backup: two rounds of PBKDF2, then class keys wrapped with the result
+        dpsl = _random_bytes(rng, 20)
+        salt = _random_bytes(rng, 20)
+        passcode_key = hashlib.pbkdf2_hmac("sha1", hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), dpsl, iterations, 32), salt, 1, 32)
+        keybag = _tlv(b"VERS", 4) + _tlv(b"TYPE", 1) + _tlv(b"UUID", _random_bytes(rng, 16)) + _tlv(b"HMCK", _random_bytes(rng, 40)) \
+            + _tlv(b"WRAP", 0) + _tlv(b"SALT", salt) + _tlv(b"ITER", 1) + _tlv(b"DPWT", 1) + _tlv(b"DPIC", iterations) + _tlv(b"DPSL", dpsl)
+        for (protection_class, key) in class_keys.items():
+            keybag += _tlv(b"UUID", _random_bytes(rng, 16)) + _tlv(b"CLAS", protection_class) + _tlv(b"WRAP", 2) \
+                + _tlv(b"KTYP", 0) + _tlv(b"WPKY", _aes_wrap(passcode_key, key))
+        manifest_key = _random_bytes(rng, 32)
+        plist["BackupKeyBag"] = biplist.Data(keybag)
+        plist["ManifestKey"] = biplist.Data(struct.pack("<l", MANIFEST_PROTECTION_CLASS) + _aes_wrap(class_keys[MANIFEST_PROTECTION_CLASS], manifest_key))
+        with open(plain_db_path, 'rb') as infile:
+            encrypted = AES.new(manifest_key, AES.MODE_CBC, b"\x00" * 16).encrypt(_pad(infile.read()))
+        with open(db_path, 'wb') as outfile:
+            outfile.write(encrypted)
+        os.remove(plain_db_path)
+    biplist.writePlist(plist, os.path.join(path, "Manifest.plist"))
+    return contents
+
+def add_arguments(arg_parser):
+    arg_parser.add_argument("--files", type=int, default=1000, help="number of files (default: %(default)s)")
+    arg_parser.add_argument("--domains", type=int, default=5, help="number of domains (default: %(default)s)")
+    arg_parser.add_argument("--depth", type=int, default=4, help="maximum directory depth (default: %(default)s)")
+    arg_parser.add_argument("--median-size", type=int, default=16 * 1024, metavar="BYTES",
+                            help="median file size (default: %(default)s)")
+    arg_parser.add_argument("--max-size", type=int, default=4 * 1024 * 1024, metavar="BYTES",
+                            help="maximum file size (default: %(default)s)")
+    arg_parser.add_argument("--password", help="encrypt the backup with this password")
+    arg_parser.add_argument("--seed", type=int, default=0, help="random seed (default: %(default)s)")
+    arg_parser.add_argument("--iterations", type=int, default=1000,
+                            help="key derivation iterations for encrypted backups (default: %(default)s)")
+
+def generate_from_arguments(path, args):
+    return generate_backup(path, files=args.files, domains=args.domains, depth=args.depth,
+                           median_size=args.median_size, max_size=args.max_size,
+                           password=args.password, seed=args.seed, iterations=args.iterations)
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Generate a synthetic iOS backup for benchmarking.")
+    arg_parser.add_argument("output", help="folder to write the backup to")
+    add_arguments(arg_parser)
+    args = arg_parser.parse_args()
+    if os.path.exists(os.path.join(args.output, "Manifest.plist")):
+        print(f"{args.output} already contains a backup")
+        sys.exit(1)
+    contents = generate_from_arguments(args.output, args)
+    print(f"Wrote {len(contents)} files ({sum(len(data) for data in contents.values()) / 2**20:.1f}MiB) to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# Benchmarks the filesystem by calling BackupFS/EncryptedBackupFS operations
+# directly, the same way FUSE would, without mounting anything.
+#
+# Each scenario runs in its own process, so the mount time and peak RSS
+# reported for it aren't affected by the others:
+#
+#   mount        only mounting
+#   walk         recursive readdir + getattr of every entry (ls -lR)
+#   stat         random getattr calls on known and missing paths
+#   seq_read     every file read from start to end
+#   random_read  small reads at random offsets of random files
+#
+# Usage:
+#   run_benchmarks.py <backup folder> [--password PASSWORD] [options]
+#   run_benchmarks.py --generate <folder> [generator options] [options]
+#
+# With --json, the results are also written to a file, along with the current
+# commit, so runs on different commits can be compared.
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import generate_backup
+
+SCENARIOS = ("mount", "walk", "stat", "seq_read", "random_read")
+SEQUENTIAL_READ_SIZE = 128 * 1024
+RANDOM_READ_SIZE = 4096
+# Marks the line with the results in the output of a scenario's process
+RESULT_PREFIX = "RESULT "
+
+def create_fs(args):
+    from mount_ios_backup.standard_backup import BackupFS
+    from mount_ios_backup.encrypted_backup import EncryptedBackupFS, DEFAULT_READAHEAD_SIZE, DEFAULT_CACHE_SIZE
+    options = {"index_dir": args.index_dir, "ram_cache": not args.no_ram_cache, "lazy": args.lazy}
+    if args.password is None:
+        return BackupFS(args.backup, **options)
+    readahead_size = DEFAULT_READAHEAD_SIZE if args.readahead is None else args.readahead * 1024 * 1024
+    cache_size = DEFAULT_CACHE_SIZE if args.cache_size is None else args.cache_size * 1024 * 1024
+    return EncryptedBackupFS(args.backup, args.password, readahead_size=readahead_size, cache_size=cache_size, **options)
+
+def _join(path, name):
+    return f"{path.rstrip('/')}/{name}"
+
+def walk(fs, path="/"):
+    """
+    Yields (path, attrs) for everything below path, the way `ls -lR` would find it.
+    """
+    for entry in fs("readdir", path, 0):
+        name = entry if isinstance(entry, str) else entry[0]
+        if name in (".", ".."):
+            continue
+        child = _join(path, name)
+        attrs = fs("getattr", child)
+        yield (child, attrs)
+        if attrs["st_mode"] & 0o170000 == 0o040000:
+            yield from walk(fs, child)
+
+def list_files(fs):
+    return [(path, attrs["st_size"]) for (path, attrs) in walk(fs) if attrs["st_mode"] & 0o170000 == 0o100000]
+
+def scenario_mount(fs, rng, args):
+    return (0, 0)
+
+def scenario_walk(fs, rng, args):
+    # Every entry costs a readdir entry and a getattr
+    return (sum(2 for _ in walk(fs)), 0)
+
+def scenario_stat(fs, rng, args):
+    paths = [path for (path, _) in walk(fs)]
+    start = time.perf_counter()
+    for _ in range(args.ops):
+        path = rng.choice(paths)
+        # One in ten lookups is for something that doesn't exist, like a shell or editor would try
+        if rng.random() < 0.1:
+            path += ".missing"
+        try:
+            fs("getattr", path)
+        except OSError:
+            pass
+    return (args.ops, 0, time.perf_counter() - start)
+
+def scenario_seq_read(fs, rng, args):
+    files = list_files(fs)
+    start = time.perf_counter()
+    ops = 0
+    total = 0
+    for (path, _) in files:
+        fh = fs("open", path, os.O_RDONLY)
+        offset = 0
+        while True:
+            data = fs("read", path, SEQUENTIAL_READ_SIZE, offset, fh)
+            ops += 1
+            if len(data) == 0:
+                break
+            offset += len(data)
+        fs("release", path, fh)
+        total += offset
+    return (ops, total, time.perf_counter() - start)
+
+def scenario_random_read(fs, rng, args):
+    files = [(path, size) for (path, size) in list_files(fs) if size > 0]
+    handles = {}
+    start = time.perf_counter()
+    total = 0
+    for _ in range(args.ops):
+        (path, size) = rng.choice(files)
+        if path not in handles:
+            handles[path] = fs("open", path, os.O_RDONLY)
+        total += len(fs("read", path, RANDOM_READ_SIZE, rng.randrange(size), handles[path]))
+    for (path, fh) in handles.items():
+        fs("release", path, fh)
+    return (args.ops, total, time.perf_counter() - start)
+
+def peak_rss():
+    """
+    Returns the peak resident set size of this process in bytes.
+    """
+    # ru_maxrss carries over from the parent process through exec on Linux, VmHWM doesn't
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, KiB elsewhere
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+def run_scenario(name, args):
+    rng = random.Random(args.seed)
+    start = time.perf_counter()
+    fs = create_fs(args)
+    fs("init", "/")
+    mount_time = time.perf_counter() - start
+    start = time.perf_counter()
+    result = globals()[f"scenario_{name}"](fs, rng, args)
+    elapsed = time.perf_counter() - start
+    if len(result) == 3:
+        # Scenarios that need to find their files first time only the actual work
+        (ops, total, elapsed) = result
+    else:
+        (ops, total) = result
+    fs("destroy", "/")
+    return {
+        "scenario":   name,
+        "mount_s":    mount_time,
+        "seconds":    elapsed,
+        "ops":        ops,
+        "ops_per_s":  ops / elapsed if elapsed > 0 else None,
+        "bytes":      total,
+        "mb_per_s":   total / 2**20 / elapsed if elapsed > 0 else None,
+        "peak_rss_mb": peak_rss() / 2**20,
+    }
+
+def _format(value, digits):
+    return "-" if value is None else f"{value:.{digits}f}"
+
+def print_results(results):
+    print(f"{'scenario':12} {'mount s':>8} {'time s':>8} {'ops':>9} {'ops/s':>11} {'MB/s':>9} {'peak RSS MB':>12}")
+    for result in results:
+        ops_per_s = result["ops_per_s"] if result["ops"] > 0 else None
+        mb_per_s = result["mb_per_s"] if result["bytes"] > 0 else None
+        print(f"{result['scenario']:12} {result['mount_s']:8.3f} {result['seconds']:8.3f} {result['ops']:9} "
+              f"{_format(ops_per_s, 0):>11} {_format(mb_per_s, 1):>9} {result['peak_rss_mb']:12.1f}")
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Benchmark filesystem operations on a backup without mounting it.")
+    arg_parser.add_argument("backup", nargs="?", help="the backup folder to benchmark")
+    arg_parser.add_argument("--generate", metavar="DIR", help="generate a synthetic backup in this folder (if it isn't there yet) and use it")
+    arg_parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma-separated scenarios to run (default: %(default)s)")
+    arg_parser.add_argument("--ops", type=int, default=10000, help="number of operations in the stat and random_read scenarios (default: %(default)s)")
+    arg_parser.add_argument("--json", metavar="FILE", help="also write the results to this file")
+    arg_parser.add_argument("--index-dir", metavar="DIR", help="passed on to the filesystem, as with mount_ios_backup")
+    arg_parser.add_argument("--no-ram-cache", action="store_true", help="passed on to the filesystem, as with mount_ios_backup")
+    arg_parser.add_argument("--lazy", action="store_true", help="passed on to the filesystem, as with mount_ios_backup")
+    arg_parser.add_argument("--readahead", type=int, metavar="MIB", help="passed on to the filesystem, as with mount_ios_backup")
+    arg_parser.add_argument("--cache-size", type=int, metavar="MIB", help="passed on to the filesystem, as with mount_ios_backup")
+    arg_parser.add_argument("--run-scenario", help=argparse.SUPPRESS)
+    generate_backup.add_arguments(arg_parser)
+    args = arg_parser.parse_args()
+
+    if args.run_scenario is not None:
+        # Child process, see below
+        if args.backup is None:
+            args.backup = args.generate
+        print(RESULT_PREFIX + json.dumps(run_scenario(args.run_scenario, args)))
+        return
+    if args.generate is not None:
+        args.backup = args.generate
+        if not os.path.exists(os.path.join(args.generate, "Manifest.plist")):
+            print(f"Generating backup in {args.generate}...")
+            generate_backup.generate_from_arguments(args.generate, args)
+    if args.backup is None:
+        arg_parser.error("either a backup folder or --generate is required")
+
+    results = []
+    for name in args.scenarios.split(","):
+        if name not in SCENARIOS:
+            arg_parser.error(f"unknown scenario: {name}")
+        # Same arguments, but only running this scenario
+        command = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + ["--run-scenario", name]
+        child = subprocess.run(command, stdout=subprocess.PIPE, text=True)
+        if child.returncode != 0:
+            print(f"Scenario {name} failed")
+            sys.exit(1)
+        # The filesystem prints progress messages as well
+        for line in child.stdout.splitlines():
+            if line.startswith(RESULT_PREFIX):
+                results.append(json.loads(line[len(RESULT_PREFIX):]))
+    print_results(results)
+    if args.json is not None:
+        with open(args.json, 'w') as outfile:
+            json.dump({"commit": _git_commit(), "backup": os.path.abspath(args.backup), "arguments": sys.argv[1:], "results": results}, outfile, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+from collections import OrderedDict
+import threading
+
+class BlockCache():
+    """
+    Least-recently-used cache of decrypted blocks, shared by every open file.
+    Blocks are keyed by (fileID, blob version, block index), so they outlive the handle
+    that decrypted them.
+
+    The total size of the cached blocks is kept under `max_size` bytes.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the cached block, or None if it isn't cached.
+        """
+        with self._lock:
+            block = self._blocks.get(key)
+            if block is None:
+                self.misses += 1
+                return None
+            self._blocks.move_to_end(key)
+            self.hits += 1
+            return block
+
+    def put(self, key, block):
+        if len(block) > self.max_size:
+            return
+        with self._lock:
+            old_block = self._blocks.pop(key, None)
+            if old_block is not None:
+                self.size -= len(old_block)
+            self._blocks[key] = block
+            self.size += len(block)
+            while self.size > self.max_size:
+                (_, evicted) = self._blocks.popitem(last=False)
+                self.size -= len(evicted)
+
+    def remove_files(self, file_ids=None):
+        """
+        Drops the blocks of the given fileIDs, i.e. because their contents changed, or every block if None.
+        """
+        with self._lock:
+            if file_ids is None:
+                self._blocks.clear()
+                self.size = 0
+                return
+            for key in [key for key in self._blocks if key[0] in file_ids]:
+                self.size -= len(self._blocks.pop(key))
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits":     self.hits,
+                "misses":   self.misses,
+                "hit_rate": self.hits / lookups if lookups > 0 else None,
+                "blocks":   len(self._blocks),
+                "size":     self.size,
+                "max_size": self.max_size,
+            }
@@ -1,32 +1,131 @@
 from . import google_iphone_dataprotection
-from .standard_backup import BackupFS
+from .standard_backup import BackupFS, STATS_DIR, STATS_PATH
+from .readahead import ReadAhead
+from .block_cache import BlockCache
+from . import stats
 from fuse import FuseOSError
+from Crypto.Cipher import AES
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import tempfile
+import hashlib
+import sqlite3
 import biplist
 import struct
 import errno
 import math
+import sys
 import os
 
 # Some functions and code borrowed from iphone_backup.py: https://github.com/jsharkey13/iphone_backup_decrypt
 AES_BLOCK_SIZE = 16
+# Default number of bytes to read ahead of sequential reads
+DEFAULT_READAHEAD_SIZE = 8 * 1024 * 1024
+# Number of threads reading ahead, shared by all open files
+READAHEAD_WORKERS = 4
+# Default memory limit of the decrypted block cache
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+# Size of the blocks kept in the block cache. Must be a multiple of AES_BLOCK_SIZE.
+CACHE_BLOCK_SIZE = 64 * 1024
+# Size of the pieces Manifest.db is decrypted in. Must be a multiple of AES_BLOCK_SIZE.
+MANIFEST_CHUNK_SIZE = 4 * 1024 * 1024
+
+def _pread(fh, length, offset):
+    with stats.timer("disk_read"):
+        return os.pread(fh, length, offset)
+
+class OpenFile():
+    """
+    State kept for each open file handle, so that reads don't need to look up
+    the path or unwrap the file's key again.
+    """
+    def __init__(self, file_info, key, version=None):
+        self.file_info = file_info
+        # Unwrapped AES key, or None if the file isn't encrypted
+        self.key = key
+        # Identifies the blob this handle has open, see _blob_version
+        self.version = version
+        # CBC cipher left over from the previous read, and the offset it can continue decrypting from
+        self.cipher = None
+        self.next_offset = None
+        # Guards cipher and next_offset when FUSE is running with multiple threads
+        self.lock = threading.Lock()
+        # ReadAhead for the file, if enabled
+        self.readahead = None
+
+    def take_cipher(self, offset):
+        """
+        Returns the leftover cipher if it can continue decrypting at offset, or None.
+        The caller owns the cipher afterwards, so concurrent reads never share one.
+        """
+        with self.lock:
+            cipher = self.cipher if self.next_offset == offset else None
+            self.cipher = None
+            self.next_offset = None
+            return cipher
+
+    def put_cipher(self, cipher, next_offset):
+        with self.lock:
+            self.cipher = cipher
+            self.next_offset = next_offset
+
+def _blob_version(fh):
+    # A blob that's replaced or rewritten keeps its fileID, but not its inode, modification time and size,
+    # so blocks cached through a handle on the old blob can't be served to handles on the new one
+    st = os.fstat(fh)
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def _manifest_padding(data):
+    # Returns the length of the padding at the end of the decrypted Manifest.db
+    padding = google_iphone_dataprotection.paddingLength(data, AES_BLOCK_SIZE)
+    if padding is None:
+        raise ValueError("Manifest.db has invalid padding after decrypting it, the backup may be damaged")
+    return padding
 
 class EncryptedBackupFS(BackupFS):
-    def __init__(self, root, raw_password):
-        self._password = raw_password if type(raw_password) is bytes else raw_password.encode("utf-8")
+    def __init__(self, root, raw_password, readahead_size=DEFAULT_READAHEAD_SIZE, cache_size=DEFAULT_CACHE_SIZE, index_dir=None, ram_cache=True, key_cache=None, lazy=False, negative_cache=False, shared_columns=None, refresh_interval=None):
+        # The password may be None if the keys are in key_cache
+        self._password = raw_password if raw_password is None or type(raw_password) is bytes else raw_password.encode("utf-8")
+        self._key_cache = key_cache
+        self._keybag = None
+        # The BackupKeyBag the keybag was read from
+        self._keybag_data = None
+        self._manifest_key = None
         self._open_files_info = {}
-        super().__init__(root)
+        self._block_cache = None
+        if cache_size > 0:
+            self._block_cache = BlockCache(cache_size)
+            stats.add_source("block_cache", self._block_cache.stats)
+        self._readahead_size = readahead_size
+        self._readahead_executor = None
+        if readahead_size > 0:
+            self._readahead_executor = ThreadPoolExecutor(max_workers=READAHEAD_WORKERS)
+        super().__init__(root, index_dir=index_dir, ram_cache=ram_cache, lazy=lazy, negative_cache=negative_cache,
+                         shared_columns=shared_columns, refresh_interval=refresh_interval)
 
     def _get_db_file(self):
         return self._temp_db
 
     def _create_db_connection(self):
-        with tempfile.TemporaryDirectory() as tempdir:
-            self._temp_db = os.path.join(tempdir, "Manifest.db")
-            self._decrypt_manifest_db_file()
-            result = super()._create_db_connection()
-            self._temp_db = None
-            return result
+        # Before Python 3.11, sqlite3 can only open databases from files.
+        # Without RAM-caching, the manifest is used from disk anyway.
+        if not self._ram_cache or not hasattr(sqlite3.Connection, "deserialize"):
+            with tempfile.TemporaryDirectory() as tempdir:
+                self._temp_db = os.path.join(tempdir, "Manifest.db")
+                self._decrypt_manifest_db_file()
+                # Without RAM-caching, the connection keeps using the file after it's deleted
+                result = super()._create_db_connection()
+                self._temp_db = None
+                return result
+        try:
+            if self._db_connection is None:
+                data = self._decrypt_manifest_db()
+                self._db_connection = sqlite3.connect(":memory:", check_same_thread=False)
+                print("Loading manifest into memory...")
+                self._db_connection.deserialize(data)
+            return self._check_db_connection()
+        except sqlite3.Error:
+            return False
 
     # Modified from iphone_backup.py
     # Returns ManifestKey from Manifest.plist
@@ -34,36 +133,119 @@ class EncryptedBackupFS(BackupFS):
         # Open the Manifest.plist file to access the Keybag:
         with open(os.path.join(self.root, "Manifest.plist"), 'rb') as infile:
             manifest_plist = biplist.readPlist(infile)
-        self._keybag = google_iphone_dataprotection.Keybag(manifest_plist['BackupKeyBag'])
-        # Attempt to unlock the Keybag:
-        if not self._keybag.unlockWithPassphrase(self._password):
-            raise ValueError("Failed to decrypt keys: incorrect passphrase?")
+        if self._keybag is not None and manifest_plist['BackupKeyBag'] == self._keybag_data:
+            # Already unlocked, and unlocking it again with the passphrase takes a while
+            return manifest_plist['ManifestKey']
+        # Only replaces the keybag in use once it's unlocked, as files are still being opened with it
+        keybag = google_iphone_dataprotection.Keybag(manifest_plist['BackupKeyBag'])
+        if self._key_cache is not None and self._key_cache.load(keybag):
+            print("Loaded keys from key cache")
+        else:
+            if self._password is None:
+                raise ValueError("Failed to decrypt keys: no passphrase given and keys are not cached")
+            # Attempt to unlock the Keybag:
+            if not keybag.unlockWithPassphrase(self._password):
+                raise ValueError("Failed to decrypt keys: incorrect passphrase?")
+            if self._key_cache is not None:
+                self._key_cache.save(keybag)
+        self._keybag = keybag
+        self._keybag_data = manifest_plist['BackupKeyBag']
         return manifest_plist['ManifestKey']
     
+    def _get_manifest_key(self):
+        if self._manifest_key is None:
+            print("Loading decryption keys...")
+            manifest_key = self._read_and_unlock_keybag()
+            manifest_class = struct.unpack('<l', manifest_key[:4])[0]
+            with stats.timer("key_unwrap"):
+                self._manifest_key = self._keybag.unwrapKeyForClass(manifest_class, manifest_key[4:])
+        return self._manifest_key
+
+    def _reload_manifest(self):
+        # The manifest key is read from Manifest.plist again, in case that changed too
+        self._manifest_key = None
+
+    def _entries_changed(self, previous, changed):
+        # Blobs are rewritten in place, under the same fileID, so cached blocks of changed files are stale.
+        # Handles opened before the change still cache blocks afterwards, but under the old blob's version.
+        if self._block_cache is None:
+            return
+        file_ids = None
+        if changed is not None:
+            file_ids = set()
+            for (domain, relative_path) in changed:
+                file_info = previous.get(domain, relative_path)
+                if file_info is not None:
+                    file_ids.add(file_info.hash)
+        self._block_cache.remove_files(file_ids)
+
+    def _get_index_key(self):
+        # Index files hold the same information as the manifest, so they are protected by
+        # a key derived from the manifest's key rather than stored in plain text.
+        return hashlib.sha256(b"mount-ios-backup index file" + self._get_manifest_key()).digest()
+
     def _decrypt_manifest_db_file(self):
-        # Decrypt the Manifest.db index database:
-        print("Loading decryption keys...")
-        manifest_key = self._read_and_unlock_keybag()
-        manifest_class = struct.unpack('<l', manifest_key[:4])[0]
-        key = self._keybag.unwrapKeyForClass(manifest_class, manifest_key[4:])
+        # Decrypt the Manifest.db index database a piece at a time, to keep memory use down
+        key = self._get_manifest_key()
         iv = b"\x00" * 16
         print("Decrypting manifest...")
-        with open(os.path.join(self.root, "Manifest.db"), 'rb') as encrypted_db_filehandle, open(self._temp_db, 'wb') as decrypted_db_filehandle:
+        db_path = os.path.join(self.root, "Manifest.db")
+        remaining = os.path.getsize(db_path)
+        with open(db_path, 'rb') as encrypted_db_filehandle, open(self._temp_db, 'wb') as decrypted_db_filehandle:
             while True:
                 # Read in arbitrary block sizes
                 encrypted_data = encrypted_db_filehandle.read(65536)
                 if not encrypted_data:
                     break
+                remaining -= len(encrypted_data)
                 decrypted_data = google_iphone_dataprotection.AESdecryptCBC(encrypted_data, key, iv=iv)
+                if remaining == 0:
+                    decrypted_data = decrypted_data[:-_manifest_padding(decrypted_data)]
                 decrypted_db_filehandle.write(decrypted_data)
                 # Last block of ciphertext = next block IV
                 iv = encrypted_data[-16:]
-    
-    def _decrypt(self, file_info, iv, data):
+
+    def _decrypt_manifest_db(self):
+        """
+        Decrypts the Manifest.db index database into memory and returns it as a bytearray.
+        """
+        key = self._get_manifest_key()
+        print("Decrypting manifest...")
+        db_path = os.path.join(self.root, "Manifest.db")
+        data = bytearray(os.path.getsize(db_path))
+        with open(db_path, 'rb') as encrypted_db_filehandle, stats.timer("disk_read"):
+            encrypted_db_filehandle.readinto(data)
+        # CBC decryption doesn't depend on the previous plaintext, so the chunks can be decrypted
+        # in parallel as long as each one gets the last block of ciphertext before it as its IV.
+        # The IVs are copied out first because the chunks are decrypted in place.
+        chunks = []
+        for start in range(0, len(data), MANIFEST_CHUNK_SIZE):
+            iv = b"\x00" * AES_BLOCK_SIZE if start == 0 else bytes(data[start - AES_BLOCK_SIZE:start])
+            chunks.append((start, min(start + MANIFEST_CHUNK_SIZE, len(data)), iv))
+        view = memoryview(data)
+        def decrypt_chunk(chunk):
+            (start, end, iv) = chunk
+            AES.new(key, AES.MODE_CBC, iv).decrypt(view[start:end], output=view[start:end])
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor, stats.timer("decrypt"):
+            # list() to re-raise any exceptions from the workers
+            list(executor.map(decrypt_chunk, chunks))
+        view.release()
+        # Remove the AES padding from the end
+        del data[-_manifest_padding(data):]
+        return data
+
+    def get_file_key(self, file_info):
+        if "EncryptionKey" not in file_info.properties:
+            return None
         protection_class = file_info.properties["ProtectionClass"]
-        encryption_key = file_info.plist['$objects'][file_info.properties['EncryptionKey'].integer]['NS.data'][4:]
-        inner_key = self._keybag.unwrapKeyForClass(protection_class, encryption_key)
-        return google_iphone_dataprotection.AESdecryptCBC(data, inner_key, iv=iv)
+        encryption_key = file_info.properties['EncryptionKey'][4:]
+        with stats.timer("key_unwrap"):
+            key = self._keybag.unwrapKeyForClass(protection_class, encryption_key)
+        # The unwrap returns None when its integrity check fails, and treating that as
+        # an unencrypted file would hand out the ciphertext as if it were the contents
+        if key is None:
+            raise ValueError("can't unwrap the file's key, it failed the integrity check (the backup may be damaged)")
+        return key
     
     # File methods
     # ============
@@ -72,20 +254,38 @@ class EncryptedBackupFS(BackupFS):
         # If any flags that cause writing are present, throw an error
         if flags & self.BAD_FILE_FLAGS != 0:
             raise FuseOSError(errno.EROFS)
+        if path == STATS_DIR or path == STATS_PATH:
+            return super().open(path, flags)
         file_info = self._get_file_info(path)
         if file_info.is_directory():
             # Default implementation is just return 0, so I guess that's fine?
             return self.opendir(path)
+        # Unwrap the key up front, this is much more expensive than decrypting a single read
+        try:
+            key = self.get_file_key(file_info)
+        except ValueError as e:
+            print(f"Error: {path}: {e}", file=sys.stderr)
+            raise FuseOSError(errno.EIO)
         fh = os.open(file_info.get_path(), flags)
-        # Caching the file info avoids hitting the database for each read call
-        self._open_files_info[fh] = file_info
+        # Caching the file info avoids looking up the path again for each read call
+        open_file = OpenFile(file_info, key, _blob_version(fh) if key is not None and self._block_cache is not None else None)
+        if key is not None and self._readahead_executor is not None:
+            open_file.readahead = ReadAhead(self._readahead_executor, fh, key, file_info.get_size(), self._readahead_size)
+        self._open_files_info[fh] = open_file
         return fh
 
     def read(self, path, req_length, req_offset, fh):
-        file_info = self._open_files_info[fh]
-        # If file is not encrypted, handle it like a normal file
-        if not "EncryptionKey" in file_info.properties:
+        open_file = self._open_files_info.get(fh)
+        # If file is not encrypted (or not a backup file at all), handle it like a normal file
+        if open_file is None or open_file.key is None:
             return super().read(path, req_length, req_offset, fh)
+        # Sequential reads are served from data decrypted ahead of time
+        if open_file.readahead is not None:
+            data = open_file.readahead.read(req_offset, req_length)
+            if data is not None:
+                return data
+        if self._block_cache is not None:
+            return self._read_cached(open_file, fh, req_length, req_offset)
 
         # This next section looks really confusing and I'm not really sure how to make it better.
         #
@@ -94,12 +294,7 @@ class EncryptedBackupFS(BackupFS):
         # we have to decrypt it first, and AES is a block cipher.
         #
         # So what ends up happening is we need to find the start and end positions of the
-        # block(s) the caller requested, then back up one block from the first of those to
-        # find the IV for decryption. (Use zeroes if we're already at the beginning of the file.)
-        #
-        # We can then pass this information off to the decryption function and get the result.
-        #
-        # If we read to the end of the file, some AES padding needs to be trimmed, so we do that next.
+        # block(s) the caller requested, and decrypt those. (See _decrypt_range for how the IV is found.)
         #
         # Finally, we need to trim the decrypted data back down to what the caller actually requested,
         # in case the caller requested partial block(s).
@@ -112,31 +307,79 @@ class EncryptedBackupFS(BackupFS):
         req_end_block_boundary = (math.ceil(req_end / AES_BLOCK_SIZE) * AES_BLOCK_SIZE)
         # Number of bytes that need to be removed from the beginning before returning
         block_start_offset = req_offset - req_block_boundary
-        # Number of bytes that need to be removed from the end before returning
-        block_end_offset = req_end_block_boundary - req_end
-        # Block before first requested block, to determine the IV
-        prev_block_boundary = req_block_boundary - AES_BLOCK_SIZE
-        if prev_block_boundary < 0:
-            os.lseek(fh, 0, os.SEEK_SET)
-            iv = b"\x00" * 16
+        decrypted = self._decrypt_range(open_file, fh, req_block_boundary, req_end_block_boundary)
+        return decrypted[block_start_offset:block_start_offset + req_length]
+
+    def _read_cached(self, open_file, fh, req_length, req_offset):
+        # Same as above, except whole cache blocks are decrypted and kept in the block cache,
+        # so reads of the same area (even through other handles) don't need to decrypt it again.
+        file_id = open_file.file_info.hash
+        version = open_file.version
+        blob_size = open_file.file_info.get_size()
+        req_end = min(req_offset + req_length, blob_size)
+        if req_end <= req_offset:
+            return b""
+        first = req_offset // CACHE_BLOCK_SIZE
+        last = (req_end - 1) // CACHE_BLOCK_SIZE
+        blocks = [self._block_cache.get((file_id, version, index)) for index in range(first, last + 1)]
+        index = 0
+        while index < len(blocks):
+            if blocks[index] is not None:
+                index += 1
+                continue
+            # Decrypt each run of missing blocks in one go
+            run_end = index
+            while run_end < len(blocks) and blocks[run_end] is None:
+                run_end += 1
+            run_start_offset = (first + index) * CACHE_BLOCK_SIZE
+            decrypted = self._decrypt_range(open_file, fh, run_start_offset, min((first + run_end) * CACHE_BLOCK_SIZE, blob_size))
+            for run_index in range(index, run_end):
+                block_offset = (run_index - index) * CACHE_BLOCK_SIZE
+                blocks[run_index] = decrypted[block_offset:block_offset + CACHE_BLOCK_SIZE]
+                self._block_cache.put((file_id, version, first + run_index), blocks[run_index])
+            index = run_end
+        block_start_offset = req_offset - first * CACHE_BLOCK_SIZE
+        return b"".join(blocks)[block_start_offset:block_start_offset + req_length]
+
+    def _decrypt_range(self, open_file, fh, start, end):
+        """
+        Reads and decrypts the part of the file between start and end,
+        which must both be multiples of AES_BLOCK_SIZE.
+
+        If the range includes the last block of the file, the AES padding is removed.
+        """
+        # Sequential reads can continue with the previous read's cipher, which already holds the right IV
+        cipher = open_file.take_cipher(start)
+        if cipher is not None:
+            data = _pread(fh, end - start, start)
+        elif start == 0:
+            # Use zeroes if we're at the beginning of the file
+            cipher = AES.new(open_file.key, AES.MODE_CBC, b"\x00" * AES_BLOCK_SIZE)
+            data = _pread(fh, end - start, start)
         else:
-            os.lseek(fh, prev_block_boundary, os.SEEK_SET)
-            iv = os.read(fh, AES_BLOCK_SIZE)
+            # Otherwise, the IV is the block before the first requested block,
+            # so read it along with the data rather than making a separate call.
+            data = _pread(fh, end - start + AES_BLOCK_SIZE, start - AES_BLOCK_SIZE)
             # If a program is attempting to read past the end of a file, this may occur.
-            if len(iv) == 0:
+            if len(data) <= AES_BLOCK_SIZE:
                 return b""
-        data = os.read(fh, req_end_block_boundary - req_block_boundary)
-        decrypted = self._decrypt(file_info, iv, data)
-        # If we're reading the last byte in the file
-        if req_end_block_boundary - 1 >= file_info.get_size():
+            cipher = AES.new(open_file.key, AES.MODE_CBC, data[:AES_BLOCK_SIZE])
+            data = memoryview(data)[AES_BLOCK_SIZE:]
+        if len(data) == 0:
+            return b""
+        with stats.timer("decrypt"):
+            decrypted = cipher.decrypt(data)
+        data_end = start + len(data)
+        open_file.put_cipher(cipher, data_end)
+        # If we're reading the last block in the file, some AES padding needs to be trimmed
+        if data_end >= open_file.file_info.get_size():
             decrypted = google_iphone_dataprotection.removePadding(decrypted)
-        if block_start_offset > 0:
-            decrypted = decrypted[block_start_offset:]
-        if len(decrypted) > req_length:
-            decrypted = decrypted[:req_length - len(decrypted)]
         return decrypted
 
     def release(self, path, fh):
         # Remove file_info cache if it exists
-        self._open_files_info.pop(fh, None)
+        open_file = self._open_files_info.pop(fh, None)
+        # Background reads must stop before the file descriptor is closed
+        if open_file is not None and open_file.readahead is not None:
+            open_file.readahead.close()
         super().release(path, fh)
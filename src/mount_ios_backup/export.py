@@ -0,0 +1,225 @@
+from .extract import BlobReader
+from .file_info import is_safe_path
+from .google_iphone_dataprotection import paddingLength
+from Crypto.Cipher import AES
+import posixpath
+import io
+import tarfile
+import zipfile
+import stat
+import time
+import os
+
+# Files are read and decrypted in pieces of this size, which bounds the memory used per file.
+# Must be a multiple of the AES block size.
+EXPORT_CHUNK_SIZE = 1024 * 1024
+FORMATS = ("tar", "zip")
+# Zip timestamps can't be earlier than this
+_ZIP_MIN_DATE = (1980, 1, 1, 0, 0, 0)
+
+class _SizedReader():
+    """
+    Returns exactly size bytes of reader's data, cutting it off or padding it with zeros,
+    as archive headers are written before the data is read.
+    """
+    def __init__(self, reader, size):
+        self._reader = reader
+        self._remaining = size
+        # Whether the data turned out to be shorter or longer than size
+        self.mismatch = False
+        # Why reading failed, after which the rest is zeros
+        self.error = None
+
+    def read(self, size=-1):
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        data = b""
+        if size > 0 and self.error is None:
+            try:
+                data = self._reader.read(size)
+            except (OSError, ValueError) as e:
+                # The header is already written, so the archive can only be kept intact by carrying on
+                self.error = str(e)
+        if len(data) < size:
+            self.mismatch = True
+            data += b"\x00" * (size - len(data))
+        self._remaining -= len(data)
+        return data
+
+def _check_blob(path, key):
+    """
+    Returns why the blob at path can't be decrypted with key, or None if it can, without decrypting
+    all of it: an encrypted blob must be made of whole AES blocks, and the last one must have valid padding.
+    """
+    if key is None:
+        return None
+    size = os.path.getsize(path)
+    if size == 0:
+        return None
+    if size % AES.block_size != 0:
+        return f"encrypted blob is {size} bytes, not a multiple of {AES.block_size}"
+    with open(path, 'rb') as infile:
+        infile.seek(max(0, size - 2 * AES.block_size))
+        tail = infile.read()
+    # In CBC mode, the block before the last one is its IV
+    iv = tail[:-AES.block_size] if len(tail) > AES.block_size else b"\x00" * AES.block_size
+    if paddingLength(AES.new(key, AES.MODE_CBC, iv).decrypt(tail[-AES.block_size:]), AES.block_size) is None:
+        return "invalid padding, the blob is damaged or the key is wrong"
+    return None
+
+class _TarWriter():
+    def __init__(self, output):
+        # Stream mode never seeks, so output can be a pipe or a socket
+        self._archive = tarfile.open(fileobj=output, mode="w|", format=tarfile.PAX_FORMAT)
+
+    def _tar_info(self, name, type, mode, uid, gid, mtime):
+        info = tarfile.TarInfo(name)
+        info.type = type
+        info.mode = mode & 0o7777
+        info.uid = uid
+        info.gid = gid
+        info.mtime = mtime
+        return info
+
+    def add_directory(self, name, mode, uid, gid, mtime):
+        self._archive.addfile(self._tar_info(name, tarfile.DIRTYPE, mode, uid, gid, mtime))
+
+    def add_symlink(self, name, target, mode, uid, gid, mtime):
+        info = self._tar_info(name, tarfile.SYMTYPE, mode, uid, gid, mtime)
+        info.linkname = target
+        self._archive.addfile(info)
+
+    def add_file(self, name, reader, size, mode, uid, gid, mtime):
+        info = self._tar_info(name, tarfile.REGTYPE, mode, uid, gid, mtime)
+        info.size = size
+        self._archive.addfile(info, reader)
+
+    def close(self):
+        self._archive.close()
+
+class _ZipWriter():
+    def __init__(self, output):
+        # zipfile writes data descriptors instead of seeking back when output isn't seekable
+        self._archive = zipfile.ZipFile(output, "w", compression=zipfile.ZIP_STORED, allowZip64=True)
+
+    def _zip_info(self, name, mode, mtime):
+        date_time = max(time.localtime(mtime)[:6], _ZIP_MIN_DATE)
+        info = zipfile.ZipInfo(name, date_time)
+        # Unix mode in the high bits, as written by Info-ZIP
+        info.create_system = 3
+        info.external_attr = (mode & 0xFFFF) << 16
+        return info
+
+    def add_directory(self, name, mode, uid, gid, mtime):
+        info = self._zip_info(name + "/", stat.S_IFDIR | mode, mtime)
+        # MS-DOS directory flag
+        info.external_attr |= 0x10
+        self._archive.writestr(info, b"")
+
+    def add_symlink(self, name, target, mode, uid, gid, mtime):
+        self._archive.writestr(self._zip_info(name, stat.S_IFLNK | mode, mtime), target.encode("utf-8"))
+
+    def add_file(self, name, reader, size, mode, uid, gid, mtime):
+        info = self._zip_info(name, stat.S_IFREG | mode, mtime)
+        info.file_size = size
+        with self._archive.open(info, "w", force_zip64=size > zipfile.ZIP64_LIMIT) as outfile:
+            while True:
+                data = reader.read(EXPORT_CHUNK_SIZE)
+                if len(data) == 0:
+                    break
+                outfile.write(data)
+
+    def close(self):
+        self._archive.close()
+
+def export(fs, paths, output, format="tar"):
+    """
+    Writes a tar or zip archive of the given paths (files or folders, as they appear in the mount)
+    and everything below them to output, a binary file object that doesn't have to be seekable.
+    Entries are named by their full path, without the leading slash (i.e. HomeDomain/Library/...).
+
+    The archive is produced straight from the index and the files in the backup folder,
+    decrypting them as they're written, so memory use doesn't depend on the size of the files.
+    Modes, owners, modification times and symlink targets are taken from the manifest.
+
+    Returns a dict with the number of entries and bytes written and a list of errors.
+    Files that are missing from the backup or can't be decrypted are left out. If reading
+    a file fails after its header has been written, the rest of it is filled with zeros.
+
+    As with extract, entries whose path would lead outside of wherever the archive is unpacked
+    (i.e. with ".." in a crafted manifest) are left out. Symlinks are written after everything else,
+    and left out if anything was written below them, so unpacking never writes through one.
+    """
+    if format not in FORMATS:
+        raise ValueError(f"unknown archive format: {format}")
+    writer = _TarWriter(output) if format == "tar" else _ZipWriter(output)
+    result = {"entries": 0, "bytes": 0, "errors": []}
+    # Virtual folders (the root and domain groups) get the backup folder's metadata, as in the mount
+    root_stat = os.stat(fs.root)
+    # (path in the backup, name, target, metadata) of each symlink
+    symlinks = []
+    # Case-folded names of the folders that have something written below them,
+    # as the archive may be unpacked on a case-insensitive filesystem
+    folders = set()
+    for path in paths:
+        for (entry_path, file_info) in fs.walk(posixpath.normpath("/" + path.strip("/"))):
+            if not is_safe_path(entry_path):
+                result["errors"].append(f"{entry_path}: path leads outside of the archive, left out")
+                continue
+            name = entry_path.lstrip("/")
+            folder = posixpath.dirname(name).casefold()
+            while folder and folder not in folders:
+                folders.add(folder)
+                folder = posixpath.dirname(folder)
+            if file_info.virtual:
+                if len(name) > 0:
+                    writer.add_directory(name, stat.S_IMODE(root_stat.st_mode), root_stat.st_uid, root_stat.st_gid, root_stat.st_mtime)
+                    result["entries"] += 1
+                continue
+            attrs = file_info.properties
+            metadata = (attrs["Mode"], attrs["UserID"], attrs["GroupID"], attrs["LastModified"])
+            if file_info.is_directory():
+                writer.add_directory(name, *metadata)
+            elif file_info.is_symlink():
+                symlinks.append((entry_path, name, attrs.get("Target", ""), metadata))
+                continue
+            else:
+                size = attrs["Size"]
+                if not os.path.exists(file_info.get_path()):
+                    if size != 0:
+                        result["errors"].append(f"{entry_path}: missing from backup")
+                        continue
+                    writer.add_file(name, io.BytesIO(), 0, *metadata)
+                else:
+                    # Checked before anything is written, so a damaged file can be left out
+                    try:
+                        key = fs.get_file_key(file_info)
+                        error = _check_blob(file_info.get_path(), key)
+                        blob = BlobReader(file_info.get_path(), key, chunk_size=EXPORT_CHUNK_SIZE) if error is None else None
+                    except (OSError, ValueError) as e:
+                        error = str(e)
+                    if error is not None:
+                        result["errors"].append(f"{entry_path}: {error}, left out")
+                        continue
+                    with blob:
+                        reader = _SizedReader(blob, size)
+                        writer.add_file(name, reader, size, *metadata)
+                        if reader.error is None:
+                            try:
+                                reader.mismatch = reader.mismatch or len(blob.read(1)) > 0
+                            except (OSError, ValueError) as e:
+                                reader.error = str(e)
+                    if reader.error is not None:
+                        result["errors"].append(f"{entry_path}: {reader.error}, the rest was written as zeros")
+                    elif reader.mismatch:
+                        result["errors"].append(f"{entry_path}: contents don't match the size in the manifest, written as {size} bytes")
+                result["bytes"] += size
+            result["entries"] += 1
+    for (entry_path, name, target, metadata) in symlinks:
+        if name.casefold() in folders:
+            result["errors"].append(f"{entry_path}: symlink with other entries below it, left out")
+            continue
+        writer.add_symlink(name, target, *metadata)
+        result["entries"] += 1
+    writer.close()
+    return result
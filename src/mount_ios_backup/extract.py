@@ -0,0 +1,249 @@
+from . import google_iphone_dataprotection
+from .file_info import is_safe_path
+from concurrent.futures import ProcessPoolExecutor
+from Crypto.Cipher import AES
+import multiprocessing
+import posixpath
+import shutil
+import time
+import os
+
+# Files are read and decrypted in pieces of this size. Must be a multiple of the AES block size.
+EXTRACT_CHUNK_SIZE = 8 * 1024 * 1024
+# Number of files handed to a worker process at a time
+JOBS_PER_TASK = 16
+# Seconds between progress messages
+PROGRESS_INTERVAL = 2
+# Suffix of files that are still being written
+PARTIAL_SUFFIX = ".partial"
+
+class ExtractJob():
+    """
+    Everything a worker process needs to extract one file, without access to the backup's index or keys.
+    """
+    def __init__(self, path, source, destination, key, size, mode, mtime):
+        # Path of the file in the backup, for error messages
+        self.path = path
+        # Blob in the backup folder, or None if it has no contents
+        self.source = source
+        self.destination = destination
+        # Unwrapped AES key, or None if the file isn't encrypted
+        self.key = key
+        self.size = size
+        self.mode = mode
+        self.mtime = mtime
+
+class BlobReader():
+    """
+    Reads the contents of a file from its blob in the backup folder, a chunk at a time.
+
+    If key is given, the blob is decrypted in one CBC pass as it's read.
+    The last decrypted chunk is held back until the end of the blob is reached,
+    so its padding can be removed.
+    """
+    def __init__(self, path, key=None, chunk_size=EXTRACT_CHUNK_SIZE):
+        self._file = open(path, 'rb')
+        self._cipher = None
+        if key is not None:
+            self._cipher = AES.new(key, AES.MODE_CBC, b"\x00" * AES.block_size)
+        self._chunk_size = chunk_size
+        # Decrypted data that can be returned, and how much of it has been
+        self._buffer = b""
+        self._position = 0
+        self._pending = b""
+        self._eof = False
+
+    def _fill(self):
+        chunk = self._file.read(self._chunk_size)
+        remaining = self._buffer[self._position:]
+        self._position = 0
+        if not chunk:
+            self._eof = True
+            if len(self._pending) > 0:
+                # Strict PKCS#7, so a damaged blob or wrong key fails instead of losing or keeping bytes at the end
+                self._pending = google_iphone_dataprotection.removePadding(self._pending)
+            self._buffer = remaining + self._pending
+            self._pending = b""
+            return
+        self._buffer = remaining + self._pending
+        self._pending = self._cipher.decrypt(chunk)
+
+    def read(self, size=-1):
+        if self._cipher is None:
+            return self._file.read(size)
+        while not self._eof and (size < 0 or len(self._buffer) - self._position < size):
+            self._fill()
+        if size < 0:
+            size = len(self._buffer) - self._position
+        data = self._buffer[self._position:self._position + size]
+        self._position += len(data)
+        return data
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def _extract_file(job):
+    """
+    Extracts one file. Runs in a worker process, returns (job, error message or None).
+    """
+    temp_path = job.destination + PARTIAL_SUFFIX
+    try:
+        if job.source is None:
+            open(temp_path, 'wb').close()
+        elif job.key is None:
+            shutil.copyfile(job.source, temp_path)
+        else:
+            with BlobReader(job.source, job.key) as infile, open(temp_path, 'wb') as outfile:
+                shutil.copyfileobj(infile, outfile, EXTRACT_CHUNK_SIZE)
+        size = os.path.getsize(temp_path)
+        if size != job.size:
+            raise ValueError(f"extracted {size} bytes, expected {job.size}")
+        os.chmod(temp_path, job.mode & 0o7777)
+        os.utime(temp_path, (job.mtime, job.mtime))
+        # Only complete files get their real name, so an interrupted run can pick up from there
+        os.replace(temp_path, job.destination)
+        return (job, None)
+    except Exception as e:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return (job, str(e))
+
+def _is_extracted(job):
+    try:
+        st = os.stat(job.destination)
+    except OSError:
+        return False
+    return st.st_size == job.size and int(st.st_mtime) == int(job.mtime)
+
+def _check_folders(target, destination, checked):
+    """
+    Raises ValueError if any folder between destination and target is a symlink, so writing
+    to target would follow it, i.e. to a symlink an earlier, interrupted extraction created.
+    checked is a set of folders that are known not to be symlinks, which is added to.
+    """
+    folder = os.path.dirname(target)
+    unchecked = []
+    while len(folder) > len(destination) and folder not in checked:
+        if os.path.islink(folder):
+            raise ValueError(f"{folder} is a symlink, not following it")
+        unchecked.append(folder)
+        folder = os.path.dirname(folder)
+    checked.update(unchecked)
+
+def extract(fs, path, destination, workers=None, resume=True, full_paths=False):
+    """
+    Copies path (a file or folder, as it appears in the mount) and everything below it
+    out of the backup into the destination folder, with their modes and modification times.
+    With full_paths, they are put at their full path within the destination folder
+    (i.e. <destination>/HomeDomain/Library/...), otherwise relative to path.
+
+    Files are copied (and decrypted) whole by a pool of worker processes, which is much faster
+    than reading them through the mount. With resume, files that are already at the destination
+    with the right size and modification time are skipped, so an interrupted run can be repeated.
+
+    Entries whose path would lead outside the destination folder (i.e. with ".." in a crafted manifest)
+    are left out. Symlinks are created after everything else, and existing ones aren't followed,
+    so no entry can be written through one.
+
+    Returns a dict with the number of files extracted and skipped, bytes written and a list of errors.
+    """
+    workers = workers or os.cpu_count() or 1
+    destination = os.path.abspath(destination)
+    base = posixpath.normpath("/" + path.strip("/"))
+    result = {"files": 0, "skipped": 0, "bytes": 0, "errors": []}
+    jobs = []
+    # (path, mode, mtime) of each folder, their times are set last as extracting files changes them
+    directories = []
+    # (path in the backup, path, target) of each symlink
+    symlinks = []
+    # Folders that aren't symlinks, see _check_folders
+    checked = set()
+    print("Listing files...")
+    for (entry_path, file_info) in fs.walk(base):
+        if not is_safe_path(entry_path):
+            result["errors"].append(f"{entry_path}: path leads outside of the destination, left out")
+            continue
+        if full_paths:
+            target = os.path.join(destination, entry_path.lstrip("/"))
+        elif entry_path == base and not file_info.is_directory():
+            # A single file goes into the destination folder
+            target = os.path.join(destination, posixpath.basename(entry_path))
+        else:
+            target = os.path.normpath(os.path.join(destination, posixpath.relpath(entry_path, base)))
+        try:
+            # A folder's own path is checked too, as its contents are written inside it
+            _check_folders(os.path.join(target, "") if file_info.is_directory() else target, destination, checked)
+        except ValueError as e:
+            result["errors"].append(f"{entry_path}: {e}")
+            continue
+        if file_info.is_directory() or entry_path == base:
+            os.makedirs(target if file_info.is_directory() else os.path.dirname(target), exist_ok=True)
+        if file_info.is_directory():
+            if not file_info.virtual:
+                directories.append((target, file_info.properties["Mode"], file_info.properties["LastModified"]))
+        elif file_info.is_symlink():
+            symlinks.append((entry_path, target, file_info.properties["Target"]))
+        else:
+            source = file_info.get_path()
+            if not os.path.exists(source):
+                if file_info.properties["Size"] != 0:
+                    result["errors"].append(f"{entry_path}: missing from backup")
+                    continue
+                source = None
+            try:
+                key = fs.get_file_key(file_info)
+            except ValueError as e:
+                result["errors"].append(f"{entry_path}: {e}")
+                continue
+            job = ExtractJob(entry_path, source, target, key,
+                             file_info.properties["Size"], file_info.properties["Mode"], file_info.properties["LastModified"])
+            if resume and _is_extracted(job):
+                result["skipped"] += 1
+                continue
+            jobs.append(job)
+
+    print(f"Extracting {len(jobs)} files...")
+    last_progress = time.monotonic()
+    if workers > 1 and len(jobs) > JOBS_PER_TASK:
+        # Worker processes are started fresh rather than forked, as forking a process with threads isn't safe
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        results = executor.map(_extract_file, jobs, chunksize=JOBS_PER_TASK)
+    else:
+        executor = None
+        results = map(_extract_file, jobs)
+    try:
+        for (job, error) in results:
+            if error is not None:
+                result["errors"].append(f"{job.path}: {error}")
+                continue
+            result["files"] += 1
+            result["bytes"] += job.size
+            if time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+                last_progress = time.monotonic()
+                print(f"{result['files']}/{len(jobs)} files, {result['bytes'] / 2**20:.1f}MiB")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    for (entry_path, target, link_target) in symlinks:
+        if os.path.lexists(target):
+            result["skipped"] += 1
+            continue
+        try:
+            os.symlink(link_target, target)
+        except OSError as e:
+            result["errors"].append(f"{entry_path}: {e}")
+            continue
+        result["files"] += 1
+
+    # Deepest first, so setting a folder's times isn't undone by changes inside it
+    for (target, mode, mtime) in reversed(directories):
+        os.chmod(target, mode & 0o7777)
+        os.utime(target, (mtime, mtime))
+    return result
@@ -1,21 +1,56 @@
+import hashlib
 import os
 
+# Inode number of the root of the mount
+ROOT_INODE = 1
+
+def inode_number(file_id):
+    """
+    Returns the inode number of the entry with the given fileID.
+
+    fileIDs are SHA-1 hashes, so their first 63 bits are unique enough to be used
+    as they are, and stay the same across mounts. Anything else is hashed first.
+    """
+    if not (isinstance(file_id, str) and len(file_id) == 40 and all(c in "0123456789abcdef" for c in file_id)):
+        file_id = hashlib.sha1(str(file_id).encode("utf-8")).hexdigest()
+    number = int(file_id[:16], 16) >> 1
+    # Kept clear of the root's number
+    return number if number > ROOT_INODE else number + ROOT_INODE + 1
+
+def mount_path(domain, relative_path):
+    """
+    Returns the path of an entry as it appears in the mount, i.e. /AppDomain/com.example.app/Documents
+    """
+    path = "/" + domain.replace("-", "/", 1)
+    if relative_path:
+        path += "/" + relative_path
+    return path
+
+def is_safe_path(path):
+    """
+    Returns whether a path as it appears in the mount (see mount_path) only ever goes down from the root.
+    Domains and relativePaths come straight from the manifest, so a crafted one can have empty, "." or ".."
+    components, which would make extract and export write outside of their destination.
+    """
+    if path == "/":
+        return True
+    return path.startswith("/") and all(part not in ("", ".", "..") and "\0" not in part for part in path[1:].split("/"))
+
 class FileInfo():
-    def __init__(self, root, hash, domain, relative_path, plist, flags, virtual=False):
+    # There can be hundreds of thousands of these, so skip the per-instance __dict__
+    __slots__ = ("root", "hash", "domain", "relative_path", "properties", "flags", "virtual", "size")
+
+    def __init__(self, root, hash, domain, relative_path, properties, flags, virtual=False):
         self.root = root
         self.hash = hash
         self.domain = domain
         self.relative_path = relative_path
-        self.plist = plist
+        # Decoded MBFile properties, see mbfile.decode_file_properties
+        self.properties = properties
         self.flags = flags
         self.virtual = virtual
         self.size = None
     
-    @property
-    def properties(self):
-        # Borrowed from _decrypt_inner_file in iphone_backup.py
-        return self.plist['$objects'][self.plist['$top']['root'].integer]
-    
     def is_file(self):
         return self.flags == 1
     
@@ -25,6 +60,19 @@ class FileInfo():
     def is_symlink(self):
         return self.flags == 4
     
+    def get_mount_path(self):
+        if self.domain == "":
+            return "/"
+        return mount_path(self.domain, self.relative_path)
+
+    def get_inode(self):
+        if not self.virtual:
+            return inode_number(self.hash)
+        if self.domain == "":
+            return ROOT_INODE
+        # Virtual folders have no fileID, their name is just as stable
+        return inode_number(hashlib.sha1(self.domain.encode("utf-8")).hexdigest())
+
     def get_path(self):
         return os.path.join(self.root, self.hash[:2], self.hash)
 
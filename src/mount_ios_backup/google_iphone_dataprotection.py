@@ -49,6 +49,7 @@ class Keybag:
         self.attrs = {}
         self.classKeys = {}
         self.KeyBagKeys = None  # DATASIGN blob
+        self._classCiphers = {}  # ECB ciphers for unwrapping, keyed by class
         self.parseBinaryBlob(data)
 
     def parseBinaryBlob(self, data):
@@ -79,6 +80,7 @@ class Keybag:
     def unlockWithPassphrase(self, passphrase):
         passphrase_round1 = pbkdf2_hmac('sha256', passphrase, self.attrs[b"DPSL"], self.attrs[b"DPIC"], 32)
         passphrase_key = pbkdf2_hmac('sha1', passphrase_round1, self.attrs[b"SALT"], self.attrs[b"ITER"], 32)
+        self._classCiphers = {}
         for classkey in self.classKeys.values():
             if b"WPKY" not in classkey:
                 continue
@@ -89,11 +91,27 @@ class Keybag:
                 classkey[b"KEY"] = k
         return True
 
+    def getClassKeys(self):
+        return dict((clas, ck[b"KEY"]) for (clas, ck) in self.classKeys.items() if b"KEY" in ck)
+
+    def unlockWithClassKeys(self, keys):
+        for clas in keys:
+            if clas not in self.classKeys:
+                return False
+        for (clas, key) in keys.items():
+            self.classKeys[clas][b"KEY"] = key
+        self._classCiphers = {}
+        return True
+
     def unwrapKeyForClass(self, protection_class, persistent_key):
-        ck = self.classKeys[protection_class][b"KEY"]
         if len(persistent_key) != 0x28:
             raise Exception("Invalid key length")
-        return _AESUnwrap(ck, persistent_key)
+        cipher = self._classCiphers.get(protection_class)
+        if cipher is None:
+            ck = self.classKeys[protection_class][b"KEY"]
+            cipher = Crypto.Cipher.AES.new(ck, Crypto.Cipher.AES.MODE_ECB)
+            self._classCiphers[protection_class] = cipher
+        return _AESUnwrapWithCipher(cipher, persistent_key)
 
     def printClassKeys(self):
         print("== Keybag")
@@ -141,6 +159,10 @@ def _pack64bit(s):
 
 
 def _AESUnwrap(kek, wrapped):
+    return _AESUnwrapWithCipher(Crypto.Cipher.AES.new(kek, Crypto.Cipher.AES.MODE_ECB), wrapped)
+
+
+def _AESUnwrapWithCipher(cipher, wrapped):
     C = []
     for i in range(len(wrapped)//8):
         C.append(_unpack64bit(wrapped[i * 8:i * 8 + 8]))
@@ -155,7 +177,7 @@ def _AESUnwrap(kek, wrapped):
         for i in reversed(range(1, n+1)):
             todec = _pack64bit(A ^ (n * j + i))
             todec += _pack64bit(R[i])
-            B = Crypto.Cipher.AES.new(kek, Crypto.Cipher.AES.MODE_ECB).decrypt(todec)
+            B = cipher.decrypt(todec)
             A = _unpack64bit(B[:8])
             R[i] = _unpack64bit(B[8:])
 
@@ -173,8 +195,19 @@ def AESdecryptCBC(data, key, iv=b"\x00" * 16):
     return data
 
 
+def paddingLength(data, blocksize=16):
+    # RFC 1423 / PKCS#7: the last byte is the number of padding bytes, which all have that value.
+    # Returns None if the padding isn't valid.
+    if len(data) == 0:
+        return None
+    n = int(data[-1])
+    if n < 1 or n > blocksize or n > len(data) or data[-n:] != bytes([n]) * n:
+        return None
+    return n
+
+
 def removePadding(data, blocksize=16):
-    n = int(data[-1])  # RFC 1423: last byte contains number of padding bytes.
-    if n > blocksize or n > len(data):
+    n = paddingLength(data, blocksize)
+    if n is None:
         raise Exception('Invalid CBC padding')
     return data[:-n]
@@ -0,0 +1,318 @@
+from .file_info import FileInfo
+from .metadata_index import add_domain, read_manifest, BATCH_SIZE, Totals
+from . import stats
+from Crypto.Cipher import AES
+from urllib.request import pathname2url
+import contextlib
+import threading
+import hashlib
+import sqlite3
+import os
+
+# Bump this whenever the layout of index files changes, older files are then rebuilt
+INDEX_VERSION = 3
+# Marks an encrypted index file, followed by the nonce and the tag
+_ENCRYPTED_MAGIC = b"MIBINDEX"
+_NONCE_SIZE = 16
+_TAG_SIZE = 16
+# How much of the start and end of Manifest.db goes into its fingerprint
+_FINGERPRINT_SAMPLE_SIZE = 64 * 1024
+
+# Columns of the Entries table holding MBFile properties, and the property each one holds
+_PROPERTY_COLUMNS = (
+    ("mode",             "Mode"),
+    ("userID",           "UserID"),
+    ("groupID",          "GroupID"),
+    ("size",             "Size"),
+    ("lastModified",     "LastModified"),
+    ("lastStatusChange", "LastStatusChange"),
+    ("birth",            "Birth"),
+    ("protectionClass",  "ProtectionClass"),
+    ("encryptionKey",    "EncryptionKey"),
+    ("target",           "Target"),
+    ("digest",           "Digest"),
+)
+_ENTRY_COLUMNS = "`fileID`,`domain`,`relativePath`,`flags`," + ",".join(f"`{column}`" for (column, _) in _PROPERTY_COLUMNS)
+
+_SCHEMA = f"""
+CREATE TABLE `Info` (`key` TEXT PRIMARY KEY, `value`);
+CREATE TABLE `Domains` (`domain` TEXT PRIMARY KEY);
+CREATE TABLE `Entries` (
+    `domain` TEXT NOT NULL,
+    `relativePath` TEXT NOT NULL,
+    `parent` TEXT,
+    `fileID` TEXT,
+    `flags` INTEGER,
+    {", ".join(f"`{column}`" for (column, _) in _PROPERTY_COLUMNS)},
+    PRIMARY KEY (`domain`, `relativePath`)
+) WITHOUT ROWID;
+"""
+# Created after the entries are inserted, which is faster than keeping it up to date while inserting
+_INDEXES = """
+CREATE INDEX `EntriesParentIdx` ON `Entries` (`domain`, `parent`);
+"""
+_INSERT_ENTRY = f"INSERT INTO `Entries` (`parent`,{_ENTRY_COLUMNS}) VALUES ({','.join('?' * (5 + len(_PROPERTY_COLUMNS)))})"
+
+def manifest_fingerprint(root):
+    """
+    Returns a string that changes whenever the backup's manifest does.
+
+    Hashing all of a large Manifest.db would take longer than loading the index,
+    so only its size, mtime, start and end are used, along with all of Manifest.plist.
+    """
+    db_path = os.path.join(root, "Manifest.db")
+    st = os.stat(db_path)
+    digest = hashlib.sha256()
+    with open(db_path, 'rb') as db_file:
+        digest.update(db_file.read(_FINGERPRINT_SAMPLE_SIZE))
+        db_file.seek(max(0, st.st_size - _FINGERPRINT_SAMPLE_SIZE))
+        digest.update(db_file.read(_FINGERPRINT_SAMPLE_SIZE))
+    with open(os.path.join(root, "Manifest.plist"), 'rb') as plist_file:
+        digest.update(plist_file.read())
+    return f"{st.st_size}:{st.st_mtime_ns}:{digest.hexdigest()}"
+
+def manifest_state(root):
+    """
+    Returns the size, modification time and inode of Manifest.db and Manifest.plist, or None
+    if either is missing. Much cheaper than manifest_fingerprint, for checking for changes often.
+    """
+    try:
+        return tuple((st.st_size, st.st_mtime_ns, st.st_ino) for st in
+                     (os.stat(os.path.join(root, name)) for name in ("Manifest.db", "Manifest.plist")))
+    except FileNotFoundError:
+        return None
+
+@contextlib.contextmanager
+def _temp_path(path):
+    """
+    Yields the path of a temporary file to write an index file to before renaming it to path.
+    If anything goes wrong before then, the temporary file (and SQLite's journal of it) is removed,
+    so failed builds don't pile up in the index folder.
+    """
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        yield temp_path
+    except BaseException:
+        for leftover in (temp_path, temp_path + "-journal"):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(leftover)
+        raise
+
+def save_index(index, path, fingerprint, key=None):
+    """
+    Writes the entries of an index to an index file, so that later mounts can
+    use it with load_index instead of reading the manifest again.
+
+    If key is given, the file is encrypted with it.
+    """
+    if key is not None and not hasattr(sqlite3.Connection, "serialize"):
+        print("Saving encrypted index files requires Python 3.11 or newer, skipping")
+        return
+    with _temp_path(path) as temp_path:
+        connection = sqlite3.connect(":memory:" if key is not None else temp_path)
+        try:
+            connection.executescript(_SCHEMA)
+            connection.executemany(_INSERT_ENTRY, (_entry_row(file_info) for file_info in index.entries()))
+            _finish_index(connection, fingerprint, index.domains, index.totals())
+            if key is not None:
+                cipher = AES.new(key, AES.MODE_GCM, nonce=os.urandom(_NONCE_SIZE))
+                (data, tag) = cipher.encrypt_and_digest(connection.serialize())
+                with open(temp_path, 'wb') as index_file:
+                    index_file.write(_ENCRYPTED_MAGIC + cipher.nonce + tag)
+                    index_file.write(data)
+        finally:
+            connection.close()
+        # Replacing the file rather than writing over it keeps it valid for anything that has it open
+        os.replace(temp_path, path)
+
+def build_index_file(db_connection, root, path, fingerprint, lock=None):
+    """
+    Builds an unencrypted index file straight from the manifest, one row at a time,
+    so memory use doesn't depend on the size of the manifest.
+    """
+    print("Indexing manifest...")
+    domains = set()
+    totals = Totals()
+    with _temp_path(path) as temp_path:
+        connection = sqlite3.connect(temp_path)
+        try:
+            # The file is only renamed into place once it's complete, so there's nothing to protect
+            connection.execute("PRAGMA journal_mode = OFF")
+            connection.execute("PRAGMA synchronous = OFF")
+            connection.executescript(_SCHEMA)
+            for (row, properties) in read_manifest(db_connection, lock):
+                domains.add(row[1])
+                totals.add(row[3], properties.get("Size"))
+                connection.execute(_INSERT_ENTRY, _entry_row(FileInfo(root, row[0], row[1], row[2], properties, row[3])))
+            _finish_index(connection, fingerprint, domains, totals)
+        finally:
+            connection.close()
+        os.replace(temp_path, path)
+
+def _finish_index(connection, fingerprint, domains, totals):
+    connection.executescript(_INDEXES)
+    connection.executemany("INSERT INTO `Info` VALUES (?, ?)", (
+        ("version", INDEX_VERSION),
+        ("fingerprint", fingerprint),
+        ("count", totals.entries),
+        ("files", totals.files),
+        ("size", totals.size),
+        ("blocks", totals.blocks),
+    ))
+    connection.executemany("INSERT INTO `Domains` VALUES (?)", ((domain,) for domain in domains))
+    connection.commit()
+
+def _entry_row(file_info):
+    parent = None
+    if len(file_info.relative_path) > 0:
+        parent = file_info.relative_path.rpartition("/")[0]
+    return (parent, file_info.hash, file_info.domain, file_info.relative_path, file_info.flags) \
+        + tuple(file_info.properties.get(key) for (_, key) in _PROPERTY_COLUMNS)
+
+def load_index(path, root, fingerprint, key=None):
+    """
+    Opens an index file written by save_index or build_index_file.
+
+    Returns None if it doesn't exist, can't be read or is out of date.
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        if key is None:
+            # The file is only ever replaced, never modified, so it can be opened as immutable
+            connection = sqlite3.connect(f"file:{pathname2url(path)}?mode=ro&immutable=1", uri=True, check_same_thread=False)
+            # Map the whole file, so it's served from the shared page cache
+            connection.execute(f"PRAGMA mmap_size = {os.path.getsize(path)}")
+        else:
+            if not hasattr(sqlite3.Connection, "deserialize"):
+                return None
+            with open(path, 'rb') as index_file:
+                header = index_file.read(len(_ENCRYPTED_MAGIC) + _NONCE_SIZE + _TAG_SIZE)
+                data = index_file.read()
+            if not header.startswith(_ENCRYPTED_MAGIC):
+                return None
+            nonce = header[len(_ENCRYPTED_MAGIC):len(_ENCRYPTED_MAGIC) + _NONCE_SIZE]
+            tag = header[len(_ENCRYPTED_MAGIC) + _NONCE_SIZE:]
+            try:
+                data = AES.new(key, AES.MODE_GCM, nonce=nonce).decrypt_and_verify(data, tag)
+            except ValueError:
+                # Wrong key or corrupted file
+                return None
+            connection = sqlite3.connect(":memory:", check_same_thread=False)
+            connection.deserialize(data)
+        info = dict(connection.execute("SELECT `key`, `value` FROM `Info`"))
+        if info.get("version") != INDEX_VERSION or info.get("fingerprint") != fingerprint:
+            connection.close()
+            return None
+        return IndexFile(root, connection, Totals(info["count"], info["files"], info["size"], info["blocks"]))
+    except sqlite3.Error:
+        return None
+
+class IndexFile():
+    """
+    Metadata index backed by an index file written by save_index.
+
+    Offers the same lookups as MetadataIndex, but answers them with queries
+    against the file instead of keeping every entry in memory, so opening it
+    takes next to no time.
+    """
+    def __init__(self, root, connection, totals):
+        self.root = root
+        self.domain_tree = {}
+        self.domains = set(row[0] for row in connection.execute("SELECT `domain` FROM `Domains`"))
+        for domain in self.domains:
+            add_domain(self.domain_tree, domain)
+        self._connection = connection
+        self._totals = totals
+        # Python's sqlite3 connections shouldn't be used by several threads at once
+        self._lock = threading.Lock()
+
+    def _query(self, sql, parameters):
+        with self._lock, stats.timer("db_query"):
+            return self._connection.execute(sql, parameters).fetchall()
+
+    def _file_info(self, row):
+        properties = {}
+        for (index, (_, key)) in enumerate(_PROPERTY_COLUMNS):
+            if row[4 + index] is not None:
+                properties[key] = row[4 + index]
+        return FileInfo(self.root, row[0], row[1], row[2], properties, row[3])
+
+    def get(self, domain, relative_path):
+        """
+        Returns the FileInfo for the given entry, or None if it doesn't exist.
+        """
+        rows = self._query(f"SELECT {_ENTRY_COLUMNS} FROM `Entries` WHERE `domain` = ? AND `relativePath` = ?", (domain, relative_path))
+        if len(rows) == 0:
+            return None
+        return self._file_info(rows[0])
+
+    def list_directory(self, domain, relative_path):
+        """
+        Returns the names of the entries directly inside the given directory.
+        """
+        return [name for (name, _) in self.list_entries(domain, relative_path)]
+
+    def list_entries(self, domain, relative_path):
+        """
+        Returns (name, FileInfo) for each entry directly inside the given directory.
+        """
+        prefix_length = len(relative_path) + 1 if len(relative_path) > 0 else 0
+        rows = self._query(f"SELECT {_ENTRY_COLUMNS} FROM `Entries` WHERE `domain` = ? AND `parent` = ?", (domain, relative_path))
+        return [(row[2][prefix_length:], self._file_info(row)) for row in rows]
+
+    def entries(self):
+        """
+        Returns the FileInfo of every entry in the index.
+        """
+        return [self._file_info(row) for row in self._query(f"SELECT {_ENTRY_COLUMNS} FROM `Entries`", ())]
+
+    def search(self, domains=None, flags=None, ranges=None, path_filter=None):
+        """
+        Yields the FileInfo of every entry that matches all of the given filters, see MetadataIndex.search.
+        """
+        conditions = []
+        parameters = []
+        if domains is not None:
+            domains = list(domains)
+            conditions.append(f"`domain` IN ({','.join('?' * len(domains))})")
+            parameters += domains
+        if flags is not None:
+            conditions.append("`flags` = ?")
+            parameters.append(flags)
+        columns = dict((key, column) for (column, key) in _PROPERTY_COLUMNS)
+        for (key, (lowest, highest)) in (ranges or {}).items():
+            if key not in columns or key in ("EncryptionKey", "Target", "Digest"):
+                raise ValueError(f"can't search by {key}")
+            conditions.append(f"typeof(`{columns[key]}`) = 'integer'")
+            if lowest is not None:
+                conditions.append(f"`{columns[key]}` >= ?")
+                parameters.append(lowest)
+            if highest is not None:
+                conditions.append(f"`{columns[key]}` <= ?")
+                parameters.append(highest)
+        sql = f"SELECT {_ENTRY_COLUMNS} FROM `Entries`"
+        if len(conditions) > 0:
+            sql += " WHERE " + " AND ".join(conditions)
+        # Read a batch at a time, so other threads can use the connection in between
+        with self._lock, stats.timer("db_query"):
+            cur = self._connection.cursor()
+            cur.execute(sql, parameters)
+        try:
+            while True:
+                with self._lock, stats.timer("db_query"):
+                    rows = cur.fetchmany(BATCH_SIZE)
+                if len(rows) == 0:
+                    break
+                for row in rows:
+                    if path_filter is None or path_filter(row[1], row[2]):
+                        yield self._file_info(row)
+        finally:
+            with self._lock:
+                cur.close()
+
+    def totals(self):
+        return self._totals
+
+    def __len__(self):
+        return self._totals.entries
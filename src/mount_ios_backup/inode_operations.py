@@ -0,0 +1,160 @@
+from .file_info import ROOT_INODE
+from fuse import FuseOSError
+import itertools
+import posixpath
+import errno
+import trio
+
+# Default number of worker threads opening and reading files
+DEFAULT_WORKERS = 16
+# Operations that read from disk or decrypt, which release the GIL while they do.
+# They run on the worker threads, so they don't hold up other requests.
+OFFLOADED_OPERATIONS = frozenset(("open", "read", "release"))
+
+class InodeOperations():
+    """
+    Inode-based, asynchronous (trio) version of the operations of a BackupFS,
+    EncryptedBackupFS or SnapshotsFS, for FUSE backends that use the low-level API:
+    entries are addressed by inode number instead of path, lookups and directory
+    listings return the attributes of the entries along with them, and any number
+    of requests can be in flight at once.
+
+    The inode numbers are the ones the filesystem reports in st_ino, which come from
+    the entries' fileIDs, so an inode always refers to the same path. Paths are only
+    remembered while the kernel holds a lookup of their inode.
+
+    Opening, reading and releasing files runs on a pool of worker threads, so many
+    reads (and their decryption) can run in parallel. Everything else is answered from
+    the index on the event loop, as it only takes microseconds and is bound by the GIL anyway,
+    unless the filesystem's lookups may wait on the disk (see BackupFS.lookups_may_block),
+    in which case they run on threads too, so they don't hold up other requests.
+    """
+    def __init__(self, fs, workers=DEFAULT_WORKERS):
+        self.fs = fs
+        self._limiter = trio.CapacityLimiter(workers)
+        # inode -> path and path -> inode, of every inode the kernel knows
+        self._paths = {ROOT_INODE: "/"}
+        self._inodes = {"/": ROOT_INODE}
+        # inode -> number of lookups the kernel holds
+        self._lookups = {}
+        # Directory handle -> (path, entries), and file handle -> path
+        self._directories = {}
+        self._directory_handles = itertools.count(1)
+        self._files = {}
+
+    async def _call(self, op, *args):
+        if op in OFFLOADED_OPERATIONS:
+            return await trio.to_thread.run_sync(self.fs, op, *args, limiter=self._limiter)
+        if self.fs.lookups_may_block():
+            # Not limited by the workers, so lookups don't wait behind reads
+            return await trio.to_thread.run_sync(self.fs, op, *args)
+        return self.fs(op, *args)
+
+    def _path(self, inode):
+        path = self._paths.get(inode)
+        if path is None:
+            raise FuseOSError(errno.ESTALE)
+        return path
+
+    def _remember(self, path, attrs):
+        inode = attrs["st_ino"]
+        self._paths[inode] = path
+        self._inodes[path] = inode
+        self._lookups[inode] = self._lookups.get(inode, 0) + 1
+
+    def forget(self, inode_list):
+        """
+        Takes (inode, count) pairs of lookups the kernel dropped.
+        """
+        for (inode, count) in inode_list:
+            remaining = self._lookups.get(inode, 0) - count
+            if remaining > 0:
+                self._lookups[inode] = remaining
+                continue
+            self._lookups.pop(inode, None)
+            if inode != ROOT_INODE:
+                self._inodes.pop(self._paths.pop(inode, None), None)
+
+    def known_entries(self, paths=None):
+        """
+        Returns (inode or None, parent inode or None, name) for each of the paths, or all paths
+        the kernel knows if None, so their cached attributes and directory entries can be invalidated.
+        """
+        if paths is None:
+            paths = [path for path in list(self._inodes) if path != "/"]
+        return [(self._inodes.get(path), self._inodes.get(posixpath.dirname(path)), posixpath.basename(path))
+                for path in paths]
+
+    async def lookup(self, parent_inode, name):
+        """
+        Returns the attributes of the entry name in a directory, and counts a lookup of it.
+        """
+        parent = self._path(parent_inode)
+        if name == ".":
+            path = parent
+        elif name == "..":
+            path = posixpath.dirname(parent)
+        else:
+            path = posixpath.join(parent, name)
+        attrs = await self._call("getattr", path)
+        self._remember(path, attrs)
+        return attrs
+
+    async def getattr(self, inode):
+        return await self._call("getattr", self._path(inode))
+
+    async def readlink(self, inode):
+        return await self._call("readlink", self._path(inode))
+
+    async def opendir(self, inode):
+        path = self._path(inode)
+        # Listed in full up front, so a refresh while it's being read doesn't shift the offsets
+        entries = []
+        for entry in await self._call("readdir", path, 0):
+            (name, attrs) = (entry, None) if isinstance(entry, str) else entry[:2]
+            if name not in (".", ".."):
+                entries.append((name, attrs))
+        fh = next(self._directory_handles)
+        self._directories[fh] = (path, entries)
+        return fh
+
+    async def readdir(self, fh, start, reply):
+        """
+        Lists the entries of an open directory from offset start on: reply is called with
+        the name, attributes and offset of the next entry for each one, until it returns False.
+        Each entry it accepts counts as a lookup.
+        """
+        (path, entries) = self._directories[fh]
+        for offset in range(start, len(entries)):
+            (name, attrs) = entries[offset]
+            child = posixpath.join(path, name)
+            if attrs is None:
+                try:
+                    attrs = await self._call("getattr", child)
+                except FuseOSError:
+                    # i.e. a domain without a root entry, which can't be looked up either
+                    continue
+            if not reply(name, attrs, offset + 1):
+                return
+            self._remember(child, attrs)
+
+    def releasedir(self, fh):
+        self._directories.pop(fh, None)
+
+    async def open(self, inode, flags):
+        """
+        Returns the file handle, and whether the file must be read with direct I/O.
+        """
+        path = self._path(inode)
+        fh = await self._call("open", path, flags)
+        self._files[fh] = path
+        return (fh, self.fs.is_direct_io(path))
+
+    async def read(self, fh, offset, size):
+        return await self._call("read", self._files[fh], size, offset, fh)
+
+    async def release(self, fh):
+        await self._call("release", self._files.pop(fh), fh)
+
+    async def statfs(self):
+        return await self._call("statfs", "/")
@@ -0,0 +1,81 @@
+from Crypto.Cipher import AES
+from binascii import hexlify
+import hashlib
+import biplist
+import os
+
+# Marks a key cache file, followed by the nonce and the tag
+_MAGIC = b"MIBKEYS1"
+_NONCE_SIZE = 16
+_TAG_SIZE = 16
+
+def default_cache_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "mount-ios-backup", "keys")
+
+class KeyCache():
+    """
+    Stores the unwrapped class keys of backup keybags, so that mounting the
+    same backup again doesn't need to derive them from the password, which
+    takes a long time on purpose.
+
+    Entries are encrypted with a key derived from the contents of `key_file`,
+    which should hold random data (i.e. `head -c 32 /dev/urandom > keyfile`),
+    and are tied to the keybag's UUID.
+    """
+    def __init__(self, cache_dir, key_file):
+        self.cache_dir = cache_dir
+        with open(key_file, 'rb') as infile:
+            self._key = hashlib.sha256(b"mount-ios-backup key cache" + infile.read()).digest()
+
+    def _get_path(self, keybag):
+        return os.path.join(self.cache_dir, hexlify(keybag.uuid).decode("ascii") + ".keys")
+
+    def has_keys(self, keybag):
+        """
+        Returns whether the keybag's class keys are cached and can be decrypted with this key file,
+        by loading them (so keybag ends up unlocked if they are).
+        """
+        return self.load(keybag)
+
+    def load(self, keybag):
+        """
+        Unlocks the keybag with its cached class keys.
+        Returns False if there are none, or they can't be decrypted with this key file.
+        """
+        path = self._get_path(keybag)
+        if not os.path.exists(path):
+            return False
+        with open(path, 'rb') as infile:
+            header = infile.read(len(_MAGIC) + _NONCE_SIZE + _TAG_SIZE)
+            data = infile.read()
+        if not header.startswith(_MAGIC):
+            return False
+        nonce = header[len(_MAGIC):len(_MAGIC) + _NONCE_SIZE]
+        tag = header[len(_MAGIC) + _NONCE_SIZE:]
+        cipher = AES.new(self._key, AES.MODE_GCM, nonce=nonce)
+        cipher.update(keybag.uuid)
+        try:
+            plist = biplist.readPlistFromString(cipher.decrypt_and_verify(data, tag))
+        except ValueError:
+            # Wrong key file or corrupted cache
+            return False
+        class_keys = dict((int(protection_class), key) for (protection_class, key) in plist["ClassKeys"].items())
+        return keybag.unlockWithClassKeys(class_keys)
+
+    def save(self, keybag):
+        """
+        Stores the class keys of an unlocked keybag.
+        """
+        os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+        plist = {"ClassKeys": dict((str(protection_class), biplist.Data(key)) for (protection_class, key) in keybag.getClassKeys().items())}
+        cipher = AES.new(self._key, AES.MODE_GCM, nonce=os.urandom(_NONCE_SIZE))
+        # The UUID is authenticated, so keys can't be used for a different keybag
+        cipher.update(keybag.uuid)
+        (data, tag) = cipher.encrypt_and_digest(biplist.writePlistToString(plist))
+        path = self._get_path(keybag)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as outfile:
+            outfile.write(_MAGIC + cipher.nonce + tag)
+            outfile.write(data)
+        os.replace(temp_path, path)
@@ -0,0 +1,156 @@
+from .file_info import FileInfo
+from .metadata_index import add_domain, matches, decode_rows, Totals
+from . import stats
+import threading
+
+_SELECT_ENTRY = "SELECT `fileID`,`domain`,`relativePath`,`flags`,`file` FROM `Files`"
+
+class LazyIndex():
+    """
+    Metadata index that is usable right away, while the real index is built
+    on a background thread.
+
+    Until that's done, lookups are answered with queries against the manifest,
+    which only decode the entries they return. Afterwards, they are passed on
+    to the built index and the manifest is no longer used.
+    """
+    def __init__(self, root, db_connection, build, close):
+        """
+        build is called with a lock, which it has to hold while using db_connection,
+        and returns the finished index. close is called once the index is in use.
+        """
+        self.root = root
+        self._connection = db_connection
+        self._build_index = build
+        self._close = close
+        # Shared with build, as sqlite3 connections shouldn't be used by several threads at once
+        self._lock = threading.Lock()
+        self._index = None
+        self._thread = None
+        # The list of domains is needed for every lookup, so that is loaded up front
+        self.domain_tree = {}
+        self.domains = set(row[0] for row in db_connection.execute(
+            "SELECT DISTINCT `domain` FROM `Files` WHERE `domain` IS NOT NULL AND `relativePath` IS NOT NULL"))
+        for domain in self.domains:
+            add_domain(self.domain_tree, domain)
+
+    def start(self):
+        """
+        Starts building the index. This has to be called after FUSE has
+        moved to the background, as threads don't survive that.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._build, daemon=True)
+            self._thread.start()
+
+    def _build(self):
+        try:
+            index = self._build_index(self._lock)
+        except Exception as e:
+            # Lookups keep working from the manifest
+            print(f"Building the index failed: {e}")
+            return
+        with self._lock:
+            self._index = index
+            self._close()
+            self._connection = None
+        print("Index ready")
+
+    def is_ready(self):
+        return self._index is not None
+
+    def built_index(self):
+        """
+        Returns the built index, or None if it isn't ready.
+        """
+        return self._index
+
+    def wait(self):
+        """
+        Blocks until the index has been built, or building it failed.
+        """
+        self.start()
+        self._thread.join()
+
+    def _query(self, sql, parameters):
+        """
+        Returns the matching manifest rows, or None if the index is ready and should be used instead.
+        """
+        with self._lock:
+            if self._index is not None:
+                return None
+            with stats.timer("db_query"):
+                return self._connection.execute(sql, parameters).fetchall()
+
+    def _file_infos(self, rows):
+        # Rows whose properties can't be decoded are left out, as they are from the index
+        return [FileInfo(self.root, row[0], row[1], row[2], properties, row[3])
+                for (row, properties) in zip(rows, decode_rows(rows)) if properties is not None]
+
+    def get(self, domain, relative_path):
+        """
+        Returns the FileInfo for the given entry, or None if it doesn't exist.
+        """
+        rows = self._query(f"{_SELECT_ENTRY} WHERE `domain` = ? AND `relativePath` = ?", (domain, relative_path))
+        if rows is None:
+            return self._index.get(domain, relative_path)
+        file_infos = self._file_infos(rows[:1])
+        if len(file_infos) == 0:
+            return None
+        return file_infos[0]
+
+    def list_directory(self, domain, relative_path):
+        """
+        Returns the names of the entries directly inside the given directory.
+        """
+        return [name for (name, _) in self.list_entries(domain, relative_path)]
+
+    def list_entries(self, domain, relative_path):
+        """
+        Returns (name, FileInfo) for each entry directly inside the given directory.
+        """
+        if len(relative_path) == 0:
+            rows = self._query(f"{_SELECT_ENTRY} WHERE `domain` = ? AND `relativePath` != '' AND instr(`relativePath`, '/') = 0", (domain,))
+        else:
+            # Everything under relative_path sorts between "relative_path/" and "relative_path0"
+            prefix = relative_path + "/"
+            rows = self._query(f"{_SELECT_ENTRY} WHERE `domain` = ? AND `relativePath` > ? AND `relativePath` < ? AND instr(substr(`relativePath`, ?), '/') = 0",
+                               (domain, prefix, relative_path + "0", len(prefix) + 1))
+        if rows is None:
+            return self._index.list_entries(domain, relative_path)
+        prefix_length = len(relative_path) + 1 if len(relative_path) > 0 else 0
+        return [(file_info.relative_path[prefix_length:], file_info) for file_info in self._file_infos(rows)]
+
+    def entries(self):
+        """
+        Returns the FileInfo of every entry in the index, waiting for it to be built.
+        """
+        self.wait()
+        if self._index is None:
+            rows = self._query(f"{_SELECT_ENTRY} WHERE `domain` IS NOT NULL AND `relativePath` IS NOT NULL", ())
+            return self._file_infos(rows)
+        return self._index.entries()
+
+    def search(self, domains=None, flags=None, ranges=None, path_filter=None):
+        """
+        Yields the FileInfo of every entry that matches all of the given filters,
+        see MetadataIndex.search. Waits for the index to be built.
+        """
+        self.wait()
+        if self._index is None:
+            return (file_info for file_info in self.entries() if matches(file_info, domains, flags, ranges, path_filter))
+        return self._index.search(domains, flags, ranges, path_filter)
+
+    def totals(self):
+        """
+        Returns the index's totals, or only the number of entries while it's being built.
+        """
+        if self._index is None:
+            return Totals(entries=len(self))
+        return self._index.totals()
+
+    def __len__(self):
+        rows = self._query("SELECT count(*) FROM `Files` WHERE `domain` IS NOT NULL AND `relativePath` IS NOT NULL", ())
+        if rows is None:
+            return len(self._index)
+        return rows[0][0]
@@ -0,0 +1,231 @@
+from . import stats
+import struct
+import biplist
+
+# Decoder for the `file` column of `Files` in Manifest.db.
+#
+# Each value is an MBFile object archived with NSKeyedArchiver as a binary plist.
+# A generic plist parser builds the whole object graph for every entry, but only a
+# handful of values in it are needed, so this reads just those straight from the bytes.
+# Anything it doesn't understand is handed to biplist instead.
+#
+# Binary plist layout: https://opensource.apple.com/source/CF/CF-1153.18/CFBinaryPList.c
+
+# MBFile properties that are copied as-is
+_NUMBER_PROPERTIES = frozenset(("Mode", "UserID", "GroupID", "Size", "LastModified", "LastStatusChange", "Birth", "ProtectionClass"))
+
+# MBFile properties that refer to archived NSData or NSMutableData objects, which are decoded to bytes
+_DATA_PROPERTIES = ("EncryptionKey", "Digest")
+
+_TRAILER = struct.Struct(">6xBBQQQ")
+_INT_FORMATS = {1: "B", 2: "H", 4: "L", 8: "Q"}
+
+class UnexpectedLayout(Exception):
+    pass
+
+class InvalidMBFile(Exception):
+    """
+    Raised when a `file` value can't be decoded as an MBFile archive,
+    whether it's not bytes, not a plist or a plist without the expected objects.
+    """
+    pass
+
+def _decode_with_biplist(blob):
+    plist = biplist.readPlistFromString(blob)
+    objects = plist['$objects']
+    # Borrowed from _decrypt_inner_file in iphone_backup.py
+    attrs = objects[plist['$top']['root'].integer]
+    properties = dict((key, attrs[key]) for key in _NUMBER_PROPERTIES if key in attrs)
+    for key in _DATA_PROPERTIES:
+        if key in attrs:
+            data = objects[attrs[key].integer]
+            properties[key] = bytes(data['NS.data'] if isinstance(data, dict) else data)
+    if "Target" in attrs:
+        properties["Target"] = objects[attrs["Target"].integer]
+    return properties
+
+class MBFileDecoder():
+    """
+    Decodes MBFile archives into a flat dict of the properties the filesystem needs.
+
+    Decoded dictionary keys are remembered between calls, so decoding many
+    entries with the same decoder (see decode_all) is faster than one at a time.
+    """
+    def __init__(self):
+        self._keys = {}
+
+    def decode(self, blob):
+        """
+        Returns the properties of one MBFile archive, raises InvalidMBFile if it can't be decoded.
+        """
+        if not isinstance(blob, bytes):
+            # i.e. a NULL `file` column
+            raise InvalidMBFile(f"expected bytes, got {type(blob).__name__}")
+        try:
+            return self._decode(blob)
+        except (UnexpectedLayout, IndexError, KeyError, ValueError, struct.error):
+            pass
+        try:
+            return _decode_with_biplist(blob)
+        except Exception as e:
+            # biplist raises its own exceptions for broken plists, and anything from KeyError to
+            # AttributeError for plists that aren't MBFile archives
+            raise InvalidMBFile(f"{type(e).__name__}: {e}") from e
+
+    def decode_all(self, blobs):
+        """
+        Decodes every blob in an iterable, i.e. a whole `file` column.
+        Raises InvalidMBFile if any of them can't be decoded.
+        """
+        return [self.decode(blob) for blob in blobs]
+
+    def _decode(self, blob):
+        if blob[:8] != b"bplist00":
+            raise UnexpectedLayout()
+        (offset_size, ref_size, object_count, top_ref, table_offset) = _TRAILER.unpack_from(blob, len(blob) - _TRAILER.size)
+        offsets = _read_ints(blob, table_offset, offset_size, object_count)
+
+        # Top level: {"$top": {"root": UID}, "$objects": [...], ...}
+        (keys, values) = _read_dict(blob, offsets[top_ref], ref_size)
+        root_uid = None
+        objects_start = None
+        for (key_ref, value_ref) in zip(keys, values):
+            key = self._read_key(blob, offsets[key_ref])
+            if key == "$top":
+                (top_keys, top_values) = _read_dict(blob, offsets[value_ref], ref_size)
+                for (top_key_ref, top_value_ref) in zip(top_keys, top_values):
+                    if self._read_key(blob, offsets[top_key_ref]) == "root":
+                        root_uid = _read_uid(blob, offsets[top_value_ref])
+            elif key == "$objects":
+                (marker, objects_count, objects_start) = _read_header(blob, offsets[value_ref])
+                if marker != 0xA:
+                    raise UnexpectedLayout()
+        if root_uid is None or objects_start is None or root_uid >= objects_count:
+            raise UnexpectedLayout()
+
+        def archived_object(uid):
+            if uid >= objects_count:
+                raise UnexpectedLayout()
+            return offsets[_read_ints(blob, objects_start + uid * ref_size, ref_size, 1)[0]]
+
+        properties = {}
+        (keys, values) = _read_dict(blob, archived_object(root_uid), ref_size)
+        for (key_ref, value_ref) in zip(keys, values):
+            key = self._read_key(blob, offsets[key_ref])
+            if key in _NUMBER_PROPERTIES:
+                properties[key] = _read_number(blob, offsets[value_ref])
+            elif key in _DATA_PROPERTIES:
+                data_offset = archived_object(_read_uid(blob, offsets[value_ref]))
+                if blob[data_offset] >> 4 == 0x4:
+                    # NSData is archived as plain data
+                    properties[key] = _read_data(blob, data_offset)
+                    continue
+                # NSMutableData is archived as {"NS.data": <data>, "$class": UID}
+                (data_keys, data_values) = _read_dict(blob, data_offset, ref_size)
+                for (data_key_ref, data_value_ref) in zip(data_keys, data_values):
+                    if self._read_key(blob, offsets[data_key_ref]) == "NS.data":
+                        properties[key] = _read_data(blob, offsets[data_value_ref])
+                if key not in properties:
+                    raise UnexpectedLayout()
+            elif key == "Target":
+                properties[key] = _read_string(blob, archived_object(_read_uid(blob, offsets[value_ref])))
+        return properties
+
+    def _read_key(self, blob, offset):
+        (marker, length, start) = _read_header(blob, offset)
+        if marker == 0x6:
+            length *= 2
+        raw = blob[offset:start + length]
+        key = self._keys.get(raw)
+        if key is None:
+            key = _read_string(blob, offset)
+            self._keys[raw] = key
+        return key
+
+def _read_ints(blob, offset, size, count):
+    # Counts and sizes come from the blob, so a damaged one mustn't make this read (or loop) past its end
+    if size < 1 or offset + size * count > len(blob):
+        raise UnexpectedLayout()
+    if size in _INT_FORMATS:
+        return struct.unpack_from(f">{count}{_INT_FORMATS[size]}", blob, offset)
+    return [int.from_bytes(blob[offset + i * size:offset + (i + 1) * size], "big") for i in range(count)]
+
+def _read_header(blob, offset):
+    """
+    Returns (type, length, start of contents) for the object at offset.
+    """
+    marker = blob[offset]
+    length = marker & 0xF
+    start = offset + 1
+    if length == 0xF:
+        # Length doesn't fit in the marker, it follows as an integer object
+        size = 1 << (blob[offset + 1] & 0xF)
+        length = int.from_bytes(blob[offset + 2:offset + 2 + size], "big")
+        start = offset + 2 + size
+    return (marker >> 4, length, start)
+
+def _read_dict(blob, offset, ref_size):
+    (marker, count, start) = _read_header(blob, offset)
+    if marker != 0xD:
+        raise UnexpectedLayout()
+    return (_read_ints(blob, start, ref_size, count), _read_ints(blob, start + count * ref_size, ref_size, count))
+
+def _read_number(blob, offset):
+    marker = blob[offset]
+    size = 1 << (marker & 0xF)
+    if offset + 1 + size > len(blob):
+        raise UnexpectedLayout()
+    if marker >> 4 == 0x1:
+        # 8 byte integers are signed, everything else is unsigned
+        return int.from_bytes(blob[offset + 1:offset + 1 + size], "big", signed=size == 8)
+    if marker == 0x22:
+        return struct.unpack_from(">f", blob, offset + 1)[0]
+    if marker == 0x23:
+        return struct.unpack_from(">d", blob, offset + 1)[0]
+    raise UnexpectedLayout()
+
+def _read_uid(blob, offset):
+    marker = blob[offset]
+    if marker >> 4 != 0x8:
+        raise UnexpectedLayout()
+    size = (marker & 0xF) + 1
+    if offset + 1 + size > len(blob):
+        raise UnexpectedLayout()
+    return int.from_bytes(blob[offset + 1:offset + 1 + size], "big")
+
+def _read_data(blob, offset):
+    (marker, length, start) = _read_header(blob, offset)
+    if marker != 0x4 or start + length > len(blob):
+        raise UnexpectedLayout()
+    return blob[start:start + length]
+
+def _read_string(blob, offset):
+    (marker, length, start) = _read_header(blob, offset)
+    if start + length * (2 if marker == 0x6 else 1) > len(blob):
+        raise UnexpectedLayout()
+    if marker == 0x5:
+        return blob[start:start + length].decode("ascii")
+    if marker == 0x6:
+        return blob[start:start + length * 2].decode("utf-16-be")
+    raise UnexpectedLayout()
+
+_decoder = MBFileDecoder()
+
+def decode_file_properties(blob):
+    """
+    Decodes the NSKeyedArchiver blob in the `file` column of `Files`
+    into a flat dict of the properties the filesystem needs.
+
+    References to other archived objects (EncryptionKey, Digest, Target) are resolved,
+    so the result doesn't need the rest of the object graph.
+    Raises InvalidMBFile if the blob can't be decoded.
+    """
+    with stats.timer("plist_parse"):
+        return _decoder.decode(blob)
+
+def decode_files(blobs):
+    """
+    Same as decode_file_properties, but for many blobs at once.
+    """
+    with stats.timer("plist_parse"):
+        return _decoder.decode_all(blobs)
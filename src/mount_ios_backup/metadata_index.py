@@ -0,0 +1,472 @@
+from .file_info import FileInfo
+from .mbfile import decode_files, decode_file_properties, InvalidMBFile
+from . import stats
+import contextlib
+import threading
+import array
+import zlib
+import sys
+
+# Number of rows read from the manifest and decoded at a time
+BATCH_SIZE = 10000
+
+# MBFile properties stored as 64-bit integer columns
+_NUMBER_COLUMNS = ("Mode", "UserID", "GroupID", "Size", "LastModified", "LastStatusChange", "Birth", "ProtectionClass")
+_INT64_MIN = -(1 << 63)
+_INT64_MAX = (1 << 63) - 1
+# fileIDs are SHA-1 hashes, stored as raw bytes
+_HASH_SIZE = 20
+# Digests of the contents are SHA-1 hashes too. Their bit in EntryColumns.present comes after the number columns'
+_DIGEST_SIZE = 20
+_DIGEST_BIT = 1 << len(_NUMBER_COLUMNS)
+# Block size statfs reports, and the unit of Totals.blocks
+BLOCK_SIZE = 4096
+
+def read_manifest_rows(db_connection, lock=None):
+    """
+    Yields the (fileID, domain, relativePath, flags, file) rows of every entry in the manifest,
+    BATCH_SIZE rows at a time, with the `file` column still encoded.
+
+    If lock is given, it is held while reading each batch, so other threads can use
+    the connection in between.
+    """
+    lock = lock or contextlib.nullcontext()
+    with lock, stats.timer("db_query"):
+        cur = db_connection.cursor()
+        cur.execute("SELECT `fileID`,`domain`,`relativePath`,`flags`,`file` FROM `Files` WHERE `domain` IS NOT NULL AND `relativePath` IS NOT NULL")
+    while True:
+        with lock, stats.timer("db_query"):
+            rows = cur.fetchmany(BATCH_SIZE)
+        if len(rows) == 0:
+            break
+        yield rows
+    with lock:
+        cur.close()
+
+def decode_rows(rows):
+    """
+    Returns the properties decoded from the `file` column of each of the manifest rows,
+    or None for rows where it can't be decoded, which are reported on stderr and
+    should be left out so one damaged entry doesn't stop the rest of the backup from being read.
+    """
+    try:
+        return decode_files(row[4] for row in rows)
+    except InvalidMBFile:
+        pass
+    # Decoded again one at a time, to find the ones that failed
+    decoded = []
+    for row in rows:
+        try:
+            decoded.append(decode_file_properties(row[4]))
+        except InvalidMBFile as e:
+            print(f"Warning: skipping {row[1]}/{row[2]} ({row[0]}), its properties can't be decoded: {e}", file=sys.stderr)
+            decoded.append(None)
+    return decoded
+
+def read_manifest(db_connection, lock=None):
+    """
+    Yields ((fileID, domain, relativePath, flags), properties) for every entry in the manifest,
+    with the properties decoded from the `file` column a batch at a time.
+    Entries whose properties can't be decoded are skipped, see decode_rows.
+    """
+    for rows in read_manifest_rows(db_connection, lock):
+        for (row, properties) in zip(rows, decode_rows(rows)):
+            if properties is not None:
+                yield (row[:4], properties)
+
+def _checksum(blob):
+    # Of the encoded properties, to tell whether an entry changed without decoding it
+    return zlib.crc32(blob) if isinstance(blob, bytes) else 0
+
+def add_domain(domain_tree, domain):
+    """
+    Adds a domain to a domain tree, splitting it into a "subdomain" if it contains a dash.
+    """
+    parts = domain.split("-", 1)
+    if len(parts) == 1:
+        domain_tree.setdefault(parts[0], 1)
+        return
+    if isinstance(domain_tree.get(parts[0]), dict):
+        domain_tree[parts[0]][parts[1]] = 1
+    else:
+        domain_tree[parts[0]] = { parts[1]: 1 }
+
+class Totals():
+    """
+    Backup-wide totals, counted while an index is built, for statfs.
+    """
+    def __init__(self, entries=0, files=0, size=0, blocks=0):
+        self.entries = entries
+        self.files = files
+        # Sum of the sizes of all files, and the number of BLOCK_SIZE blocks they would take up
+        self.size = size
+        self.blocks = blocks
+
+    def add(self, flags, size):
+        self.entries += 1
+        if flags != 1:
+            return
+        self.files += 1
+        if type(size) is int and size > 0:
+            self.size += size
+            self.blocks += -(-size // BLOCK_SIZE)
+
+def matches(file_info, domains=None, flags=None, ranges=None, path_filter=None):
+    """
+    Returns whether the FileInfo matches the filters, see MetadataIndex.search.
+    """
+    if domains is not None and file_info.domain not in domains:
+        return False
+    if flags is not None and file_info.flags != flags:
+        return False
+    for (key, (lowest, highest)) in (ranges or {}).items():
+        value = file_info.properties.get(key)
+        if type(value) is not int or (lowest is not None and value < lowest) or (highest is not None and value > highest):
+            return False
+    return path_filter is None or path_filter(file_info.domain, file_info.relative_path)
+
+class EntryColumns():
+    """
+    The entries of one or more MetadataIndexes, stored column by column rather than
+    as one object each, with the numeric properties packed into arrays.
+
+    With deduplicate, an entry that's identical to the last one added at the same
+    domain and relativePath (i.e. by an earlier snapshot of the same device) isn't
+    stored again, the indexes sharing these columns refer to the same row instead.
+
+    Rows are only ever appended, so indexes can keep reading their rows while
+    another one is adding to the columns.
+    """
+    def __init__(self, deduplicate=False):
+        self.deduplicate = deduplicate
+        # Row -> value columns
+        self.domains = []
+        self.paths = []
+        self.hashes = bytearray()
+        self.flags = array.array("b")
+        # Bit i set if the row has _NUMBER_COLUMNS[i], and _DIGEST_BIT if it has a digest
+        self.present = array.array("H")
+        self.numbers = dict((key, array.array("q")) for key in _NUMBER_COLUMNS)
+        # Encryption keys of all rows back to back, row i's is at [key_offsets[i]:key_offsets[i + 1]]
+        self.keys = bytearray()
+        self.key_offsets = array.array("Q", (0,))
+        # Digests of all rows, _DIGEST_SIZE bytes each (zeros for rows without one)
+        self.digests = bytearray()
+        # Anything that doesn't fit the columns above, {row: {property: value}}
+        self.other_properties = {}
+        self.odd_hashes = {}
+        # CRC-32 of the encoded properties each row was decoded from, 0 if not known
+        self.checksums = array.array("L")
+        # {domain: {relativePath: last row added there}}, with deduplicate
+        self._latest = {} if deduplicate else None
+        # Held while adding, as the indexes of several snapshots may be refreshed at once
+        self._lock = threading.Lock()
+
+    def add(self, file_id, domain, relative_path, flags, properties, checksum=0):
+        """
+        Adds an entry and returns its row, or with deduplicate, possibly the row of an identical entry.
+        checksum is the _checksum of the blob the properties were decoded from, if known.
+        """
+        with self._lock:
+            return self._add(file_id, domain, relative_path, flags, properties, checksum)
+
+    def _add(self, file_id, domain, relative_path, flags, properties, checksum):
+        if self._latest is not None:
+            latest = self._latest.setdefault(domain, {})
+            row = latest.get(relative_path)
+            if row is not None:
+                if self.checksums[row] == checksum and self.file_id(row) == file_id \
+                        and self.flags[row] == (flags if flags is not None else -1) and self.properties(row) == properties:
+                    return row
+                # Share the string with the earlier row
+                relative_path = self.paths[row]
+        row = len(self.paths)
+        if self._latest is not None:
+            latest[relative_path] = row
+        self.domains.append(domain)
+        self.paths.append(relative_path)
+
+        raw_hash = None
+        if isinstance(file_id, str) and len(file_id) == _HASH_SIZE * 2:
+            try:
+                raw_hash = bytes.fromhex(file_id)
+            except ValueError:
+                pass
+        if raw_hash is None or raw_hash.hex() != file_id:
+            # Not a lowercase SHA-1, keep it as it is
+            raw_hash = bytes(_HASH_SIZE)
+            self.odd_hashes[row] = file_id
+        self.hashes += raw_hash
+        self.flags.append(flags if flags is not None else -1)
+        self.checksums.append(checksum)
+
+        present = 0
+        other = {}
+        for (bit, key) in enumerate(_NUMBER_COLUMNS):
+            value = properties.get(key)
+            if type(value) is int and _INT64_MIN <= value <= _INT64_MAX:
+                present |= 1 << bit
+            elif value is not None:
+                other[key] = value
+                value = 0
+            else:
+                value = 0
+            self.numbers[key].append(value)
+        digest = properties.get("Digest")
+        if isinstance(digest, bytes) and len(digest) == _DIGEST_SIZE:
+            present |= _DIGEST_BIT
+            self.digests += digest
+        else:
+            self.digests += bytes(_DIGEST_SIZE)
+            if digest is not None:
+                other["Digest"] = digest
+        self.present.append(present)
+        encryption_key = properties.get("EncryptionKey")
+        if encryption_key is not None:
+            self.keys += encryption_key
+        self.key_offsets.append(len(self.keys))
+        for (key, value) in properties.items():
+            if key not in _NUMBER_COLUMNS and key not in ("EncryptionKey", "Digest"):
+                other[key] = value
+        if len(other) > 0:
+            self.other_properties[row] = other
+        return row
+
+    def file_id(self, row):
+        file_id = self.odd_hashes.get(row)
+        if file_id is None:
+            file_id = self.hashes[row * _HASH_SIZE:(row + 1) * _HASH_SIZE].hex()
+        return file_id
+
+    def size(self, row):
+        if self.present[row] & (1 << _NUMBER_COLUMNS.index("Size")):
+            return self.numbers["Size"][row]
+        return self.other_properties.get(row, {}).get("Size")
+
+    def is_unchanged(self, row, file_id, flags, checksum):
+        """
+        Returns whether row holds the entry of a manifest row with the given fileID, flags and
+        _checksum, so it doesn't have to be decoded again.
+        """
+        return checksum != 0 and self.checksums[row] == checksum and self.flags[row] == (flags if flags is not None else -1) \
+            and self.file_id(row) == file_id
+
+    def properties(self, row):
+        properties = {}
+        present = self.present[row]
+        for (bit, key) in enumerate(_NUMBER_COLUMNS):
+            if present & (1 << bit):
+                properties[key] = self.numbers[key][row]
+        key_start = self.key_offsets[row]
+        key_end = self.key_offsets[row + 1]
+        if key_end > key_start:
+            properties["EncryptionKey"] = bytes(self.keys[key_start:key_end])
+        if present & _DIGEST_BIT:
+            properties["Digest"] = bytes(self.digests[row * _DIGEST_SIZE:(row + 1) * _DIGEST_SIZE])
+        if row in self.other_properties:
+            properties.update(self.other_properties[row])
+        return properties
+
+    def file_info(self, root, row):
+        flags = self.flags[row]
+        return FileInfo(root, self.file_id(row), self.domains[row], self.paths[row], self.properties(row), flags if flags != -1 else None)
+
+    def __len__(self):
+        return len(self.paths)
+
+class MetadataIndex():
+    """
+    In-memory index of every entry in `Manifest.db`, built once at mount time
+    so that looking up a path is a dictionary lookup instead of a database
+    query plus a plist parse.
+
+    Directory listings are indexed as well: `domain_tree` holds the domains
+    (split into "subdomains" where they contain a dash), and each directory
+    inside a domain maps to the rows of its direct children.
+
+    Entries are stored in EntryColumns, so a large manifest only takes tens of MB.
+    FileInfo objects are created from the columns when looked up. Indexes of several
+    snapshots can share the same deduplicated columns, in which case each one only
+    adds its own lookup tables.
+    """
+    def __init__(self, root, columns=None):
+        self.root = root
+        self.domain_tree = {}
+        self.domains = set()
+        # {domain: {relativePath: row}}
+        self._rows = {}
+        # {domain: {parent: array of rows}}
+        self._children = {}
+        self._columns = columns if columns is not None else EntryColumns()
+        self._totals = Totals()
+
+    def build(self, db_connection, lock=None, previous=None):
+        """
+        Adds every entry in the manifest to the index.
+        Entries whose properties can't be decoded are left out, see decode_rows.
+
+        previous is an index of an earlier version of the same manifest that uses the same columns.
+        Entries whose rows in the manifest haven't changed since then get the same rows in the
+        columns as in previous, only new and changed entries are decoded and added to the columns.
+        """
+        print("Indexing manifest...")
+        columns = self._columns
+        for rows in read_manifest_rows(db_connection, lock):
+            checksums = [_checksum(row[4]) for row in rows]
+            existing = [None] * len(rows)
+            if previous is not None:
+                for (position, (row, checksum)) in enumerate(zip(rows, checksums)):
+                    index = previous.row(row[1], row[2])
+                    if index is not None and columns.is_unchanged(index, row[0], row[3], checksum):
+                        existing[position] = index
+            decoded = iter(decode_rows([row for (row, index) in zip(rows, existing) if index is None]))
+            for (row, checksum, index) in zip(rows, checksums, existing):
+                if index is None:
+                    properties = next(decoded)
+                    if properties is not None:
+                        self.add(row[0], row[1], row[2], row[3], properties, checksum)
+                else:
+                    self._add_row(row[1], index)
+
+    def updated(self, db_connection):
+        """
+        Returns a new index of db_connection, a later version of the manifest this index was built from,
+        built as described in build. This index stays usable, and unchanged while that's done.
+
+        If most rows of the columns are no longer used by this index and they aren't deduplicated
+        (i.e. not shared with other indexes), the new index starts over with new columns instead.
+        """
+        if not self._columns.deduplicate and len(self._columns) > 2 * len(self):
+            index = MetadataIndex(self.root)
+            index.build(db_connection)
+            return index
+        index = MetadataIndex(self.root, self._columns)
+        index.build(db_connection, previous=self)
+        return index
+
+    def changes(self, previous):
+        """
+        Returns (domain, relativePath) for every entry that was added, removed or changed
+        since previous. If previous uses other columns, every entry of both counts as changed.
+        """
+        if previous._columns is not self._columns:
+            return [(domain, path) for index in (self, previous) for (domain, rows) in index._rows.items() for path in rows]
+        changed = []
+        for (domain, rows) in self._rows.items():
+            previous_rows = previous._rows.get(domain, {})
+            changed.extend((domain, path) for (path, index) in rows.items() if previous_rows.get(path) != index)
+        for (domain, rows) in previous._rows.items():
+            current_rows = self._rows.get(domain, {})
+            changed.extend((domain, path) for path in rows if path not in current_rows)
+        return changed
+
+    def add(self, file_id, domain, relative_path, flags, properties, checksum=0):
+        """
+        Adds an entry to the index.
+        """
+        # Every row of a domain refers to the same string
+        domain = sys.intern(domain)
+        self._add_row(domain, self._columns.add(file_id, domain, relative_path, flags, properties, checksum))
+
+    def _add_row(self, domain, index):
+        if domain not in self.domains:
+            self.domains.add(domain)
+            add_domain(self.domain_tree, domain)
+            self._rows[domain] = {}
+            self._children[domain] = {}
+        relative_path = self._columns.paths[index]
+        self._totals.add(self._columns.flags[index], self._columns.size(index))
+        self._rows[domain][relative_path] = index
+        if len(relative_path) > 0:
+            parent = relative_path.rpartition("/")[0]
+            children = self._children[domain].get(parent)
+            if children is None:
+                children = self._children[domain][parent] = array.array("L")
+            children.append(index)
+
+    def _file_info(self, index):
+        return self._columns.file_info(self.root, index)
+
+    def row(self, domain, relative_path):
+        """
+        Returns the row of the given entry in the columns, or None if it doesn't exist.
+        With deduplicated columns, entries that are the same in two indexes have the same row.
+        """
+        return self._rows.get(domain, {}).get(relative_path)
+
+    def get(self, domain, relative_path):
+        """
+        Returns the FileInfo for the given entry, or None if it doesn't exist.
+        """
+        rows = self._rows.get(domain)
+        if rows is None:
+            return None
+        index = rows.get(relative_path)
+        if index is None:
+            return None
+        return self._file_info(index)
+
+    def _child_rows(self, domain, relative_path):
+        return self._children.get(domain, {}).get(relative_path, ())
+
+    def list_directory(self, domain, relative_path):
+        """
+        Returns the names of the entries directly inside the given directory.
+        """
+        prefix_length = len(relative_path) + 1 if len(relative_path) > 0 else 0
+        return [self._columns.paths[index][prefix_length:] for index in self._child_rows(domain, relative_path)]
+
+    def list_entries(self, domain, relative_path):
+        """
+        Returns (name, FileInfo) for each entry directly inside the given directory.
+        """
+        prefix_length = len(relative_path) + 1 if len(relative_path) > 0 else 0
+        return [(self._columns.paths[index][prefix_length:], self._file_info(index)) for index in self._child_rows(domain, relative_path)]
+
+    def _all_rows(self):
+        return (index for rows in self._rows.values() for index in rows.values())
+
+    def entries(self):
+        """
+        Returns the FileInfo of every entry in the index.
+        """
+        return (self._file_info(index) for index in self._all_rows())
+
+    def search(self, domains=None, flags=None, ranges=None, path_filter=None):
+        """
+        Yields the FileInfo of every entry that matches all of the given filters:
+        domains is a collection of domain names, ranges is {property: (lowest, highest)}
+        for numeric properties, with None for no limit, and path_filter is called
+        with the domain and relativePath of entries that pass the other filters.
+
+        The filters are checked against the columns, only matching entries are turned into FileInfo objects.
+        """
+        data = self._columns
+        columns = []
+        for (key, (lowest, highest)) in (ranges or {}).items():
+            if key not in _NUMBER_COLUMNS:
+                raise ValueError(f"can't search by {key}")
+            columns.append((1 << _NUMBER_COLUMNS.index(key), data.numbers[key], lowest, highest))
+        if domains is not None:
+            rows = (index for domain in domains for index in self._rows.get(domain, {}).values())
+        else:
+            rows = self._all_rows()
+        for index in rows:
+            if flags is not None and data.flags[index] != flags:
+                continue
+            present = data.present[index]
+            for (bit, column, lowest, highest) in columns:
+                if not present & bit:
+                    break
+                value = column[index]
+                if (lowest is not None and value < lowest) or (highest is not None and value > highest):
+                    break
+            else:
+                if path_filter is None or path_filter(data.domains[index], data.paths[index]):
+                    yield self._file_info(index)
+
+    def totals(self):
+        return self._totals
+
+    def __len__(self):
+        return self._totals.entries
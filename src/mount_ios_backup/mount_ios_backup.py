@@ -1,15 +1,44 @@
 #!/usr/bin/env python
 
 import os
+import re
 import sys
 import getpass
+import datetime
+import socket
+import contextlib
 import biplist
 import argparse
-from fuse import FUSE
+import stat
+import json
+from fuse import FUSE, FuseOSError
 from .standard_backup import BackupFS
-from .encrypted_backup import EncryptedBackupFS
+from .encrypted_backup import EncryptedBackupFS, DEFAULT_READAHEAD_SIZE, DEFAULT_CACHE_SIZE
+from .key_cache import KeyCache, default_cache_dir
+from .google_iphone_dataprotection import Keybag
+from .extract import extract
+from .verify import verify
+from .export import export, FORMATS
+from .query import query, TYPES
+from .snapshots import SnapshotsFS, snapshot_names, diff
+from .metadata_index import EntryColumns
+from . import stats
+
+# How long the kernel caches names and attributes with --cache
+DEFAULT_CACHE_TIMEOUT = 86400
+# FUSE libraries filesystems can be mounted with, the first one is the default
+BACKENDS = ("fusepy", "pyfuse3")
+# open_backup options that unencrypted backups take as well
+COMMON_OPTIONS = ("lazy", "negative_cache", "shared_columns", "refresh_interval")
 
 def main():
+    # Subcommands come first, anything else is a mount
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        COMMANDS[sys.argv[1]](sys.argv[2:])
+    else:
+        mount_main(sys.argv[1:])
+
+def mount_main(argv):
     arg_parser = PrintUsageParser(description="""
     Mount the specified iPhone backup at the specified mount point.
     
@@ -17,33 +46,433 @@ def main():
     it will be interactively requested. The password can be
     supplied using the --password flag, or the BACKUP_PASSWORD
     environment variable.
+
+    With --key-file, the keys derived from the password are cached,
+    protected by the key file, and the password isn't needed
+    for later mounts of the same backup.
+
+    Other commands: extract, verify, export, query, snapshots, diff (see <command> --help)
     """)
     arg_parser.add_argument("backup", help="the backup folder to read (include device UID)")
     arg_parser.add_argument("mountpoint", help="the folder to mount the backup in")
-    arg_parser.add_argument("-p", "--password", help="the backup password, if encrypted")
+    add_backup_arguments(arg_parser)
+    add_mount_arguments(arg_parser)
+    arg_parser.add_argument("--lazy", action="store_true",
+                            help="mount right away and build the index in the background, looking up entries in the manifest until it's done")
+    args = arg_parser.parse_args(argv)
+    _enable_stats(args)
+    fs = open_backup(args, readahead_size=args.readahead * 1024 * 1024, cache_size=args.cache_size * 1024 * 1024, lazy=args.lazy,
+                     negative_cache=args.cache, refresh_interval=args.refresh)
+    run_mount(fs, args)
+
+def snapshots_main(argv):
+    arg_parser = PrintUsageParser(prog=f"{os.path.basename(sys.argv[0])} snapshots", description="""
+    Mount several backups (i.e. of the same device, taken at different times)
+    side by side at the specified mount point, each in a folder named after
+    its backup folder, or NAME if given as NAME=PATH.
+
+    Entries that are the same in several backups are only kept in memory once.
+    Encrypted backups are all opened with the same password,
+    so it's only asked for once.
+    """)
+    arg_parser.add_argument("mountpoint", help="the folder to mount the backups in")
+    arg_parser.add_argument("backups", nargs="+", metavar="backup", help="a backup folder to read (include device UID), as PATH or NAME=PATH")
+    add_backup_arguments(arg_parser)
+    add_mount_arguments(arg_parser)
+    args = arg_parser.parse_intermixed_args(argv)
+    try:
+        names = snapshot_names(args.backups)
+    except ValueError as e:
+        arg_parser.error(str(e))
+    _enable_stats(args)
+    columns = EntryColumns(deduplicate=True)
+    snapshots = {}
+    for (name, path) in names.items():
+        print(f"Opening {name}...")
+        args.backup = path
+        # The cache size is the limit for all of them together
+        snapshots[name] = open_backup(args, readahead_size=args.readahead * 1024 * 1024, cache_size=args.cache_size * 1024 * 1024 // len(names),
+                                      negative_cache=args.cache, shared_columns=columns, refresh_interval=args.refresh)
+    run_mount(SnapshotsFS(snapshots), args)
+
+def add_mount_arguments(arg_parser):
+    """
+    Adds the arguments of commands that mount backups.
+    """
     arg_parser.add_argument("-f", "--foreground", action="store_true", help="keep the process in the foreground")
-    args = arg_parser.parse_args()
-    root = os.path.abspath(args.backup)
+    arg_parser.add_argument("-t", "--threads", action="store_true", help="handle filesystem requests on multiple threads (fusepy backend)")
+    arg_parser.add_argument("--backend", choices=BACKENDS, default=BACKENDS[0],
+                            help="FUSE library to mount with: fusepy (libfuse 2, one request at a time unless --threads) or "
+                                 "pyfuse3 (experimental, libfuse 3, many requests at once, needs the pyfuse3 package) (default: %(default)s)")
+    arg_parser.add_argument("--workers", type=int,
+                            help="number of threads opening and reading files with the pyfuse3 backend (default: 16)")
+    arg_parser.add_argument("--readahead", type=int, default=DEFAULT_READAHEAD_SIZE // (1024 * 1024), metavar="MIB",
+                            help="how far ahead to decrypt files that are read sequentially from encrypted backups, 0 to disable (default: %(default)s)")
+    arg_parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_SIZE // (1024 * 1024), metavar="MIB",
+                            help="memory limit for caching decrypted data from encrypted backups, 0 to disable (default: %(default)s)")
+    arg_parser.add_argument("--cache", action="store_true",
+                            help="let the kernel cache names, attributes and file contents, and remember names that don't exist, "
+                                 "as the backup doesn't change while mounted")
+    arg_parser.add_argument("--cache-timeout", type=float, default=DEFAULT_CACHE_TIMEOUT, metavar="SECONDS",
+                            help="how long the kernel caches names and attributes with --cache (default: %(default)s)")
+    arg_parser.add_argument("--refresh", type=float, metavar="SECONDS",
+                            help="check for changes to the backup (i.e. by an incremental backup into the same folder) this often, "
+                                 "and reload the manifest in the background when it changed")
+    arg_parser.add_argument("--no-stats", action="store_true", help="don't record statistics about filesystem operations")
+    arg_parser.add_argument("--stats-file", metavar="FILE",
+                            help="file to write the statistics to on SIGUSR1 (default: stderr, which is only visible with -f)")
+
+def _enable_stats(args):
+    # Before the backup is opened, so loading the manifest is included
+    if not args.no_stats:
+        stats.enable(args.stats_file)
+
+def run_mount(fs, args):
+    """
+    Mounts fs at args.mountpoint with the options from add_mount_arguments, until it's unmounted.
+    """
     mountpoint = os.path.abspath(args.mountpoint)
-    password = args.password
     foreground = args.foreground
+    if foreground:
+        print("Staying in foreground, press Ctrl-C to unmount")
+    else:
+        print(f"Switching to background, use 'fusermount -u {mountpoint}' to unmount")
+    # Threads started from here on leave SIGUSR1 to the thread that dumps the stats
+    stats.block_dump_signal()
+    if args.backend == "pyfuse3":
+        _run_pyfuse3(fs, mountpoint, args)
+        return
+    options = {}
+    keep_cache = args.cache
+    if args.cache:
+        cache_timeout = args.cache_timeout
+        if args.refresh is not None:
+            # The high-level FUSE API can't tell the kernel which entries changed on a refresh,
+            # so they aren't kept any longer than it takes to notice a change
+            cache_timeout = min(cache_timeout, args.refresh)
+        options = {"entry_timeout": cache_timeout, "attr_timeout": cache_timeout, "negative_timeout": cache_timeout}
+    if args.cache and args.refresh is not None:
+        # Instead of keeping contents cached regardless, they're kept only as long as the file's size
+        # and modification time don't change
+        keep_cache = False
+        options["auto_cache"] = True
+    # Inode numbers come from the backup's fileIDs, so they stay the same across lookups and mounts
+    BackupFUSE(fs, mountpoint, keep_cache=keep_cache, nothreads=not args.threads, foreground=foreground, use_ino=True, **options)
+
+def _run_pyfuse3(fs, mountpoint, args):
+    try:
+        from .pyfuse3_backend import run_pyfuse3
+    except ImportError as e:
+        print(f"Error: the pyfuse3 backend needs the pyfuse3 package ({e})", file=sys.stderr)
+        sys.exit(1)
+    options = {}
+    if args.workers is not None:
+        options["workers"] = args.workers
+    if args.cache:
+        # The kernel is told about entries that changed on a refresh, so they can be cached for as long as asked
+        options.update(entry_timeout=args.cache_timeout, attr_timeout=args.cache_timeout, negative_timeout=args.cache_timeout,
+                       keep_cache=True)
+    run_pyfuse3(fs, mountpoint, foreground=args.foreground, **options)
+
+def extract_main(argv):
+    arg_parser = PrintUsageParser(prog=f"{os.path.basename(sys.argv[0])} extract", description="""
+    Copy files out of the specified iPhone backup without mounting it,
+    keeping their modification times and permissions.
+
+    Paths are given as they appear in the mount, i.e. /CameraRollDomain/Media.
+    Files that have already been extracted are skipped,
+    so an interrupted extraction can be continued by running it again.
+    """)
+    arg_parser.add_argument("backup", help="the backup folder to read (include device UID)")
+    arg_parser.add_argument("destination", help="the folder to extract to")
+    arg_parser.add_argument("paths", nargs="*", default=["/"], help="files or folders to extract (default: everything)")
+    add_backup_arguments(arg_parser)
+    arg_parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="number of worker processes (default: %(default)s)")
+    arg_parser.add_argument("--no-resume", action="store_true", help="extract all files again, even if they're already there")
+    args = arg_parser.parse_args(argv)
+    # Files are read whole, so there's nothing to gain from read-ahead or the block cache
+    fs = open_backup(args, readahead_size=0, cache_size=0)
+    failed = False
+    for path in args.paths:
+        try:
+            # With several paths, they're kept apart by extracting them with their full paths
+            result = extract(fs, path, args.destination, workers=args.jobs, resume=not args.no_resume, full_paths=len(args.paths) > 1)
+        except FuseOSError:
+            print(f"Error: {path} doesn't exist in the backup", file=sys.stderr)
+            failed = True
+            continue
+        for error in result["errors"]:
+            print(f"Error: {error}", file=sys.stderr)
+        print(f"Extracted {result['files']} files ({result['bytes'] / 2**20:.1f}MiB) from {path}, skipped {result['skipped']} already extracted")
+        failed = failed or len(result["errors"]) > 0
+    if failed:
+        sys.exit(1)
+
+def verify_main(argv):
+    arg_parser = PrintUsageParser(prog=f"{os.path.basename(sys.argv[0])} verify", description="""
+    Check that the files in the specified iPhone backup are intact, without mounting it:
+    every file in the manifest must have a blob of the right size that decrypts
+    with valid padding, and match its digest where the manifest has one.
+
+    Paths are given as they appear in the mount, i.e. /CameraRollDomain/Media.
+    Exits with status 1 if any file fails.
+    """)
+    arg_parser.add_argument("backup", help="the backup folder to read (include device UID)")
+    arg_parser.add_argument("paths", nargs="*", default=["/"], help="files or folders to verify (default: everything)")
+    add_backup_arguments(arg_parser)
+    arg_parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="number of worker processes (default: %(default)s)")
+    arg_parser.add_argument("--json", metavar="FILE", help="also write a report of the results as JSON to this file, - for stdout")
+    args = arg_parser.parse_args(argv)
+    stdout = sys.stdout
+    report = {"backup": os.path.abspath(args.backup), "files": 0, "bytes": 0, "digests": 0, "seconds": 0, "errors": []}
+    # With the report on stdout, everything else goes to stderr
+    with contextlib.redirect_stdout(sys.stderr if args.json == "-" else stdout):
+        # Files are read whole, so there's nothing to gain from read-ahead or the block cache
+        fs = open_backup(args, readahead_size=0, cache_size=0)
+        for path in args.paths:
+            try:
+                result = verify(fs, path, workers=args.jobs)
+            except FuseOSError:
+                print(f"Error: {path} doesn't exist in the backup", file=sys.stderr)
+                report["errors"].append({"path": path, "file_id": None, "error": "doesn't exist in the backup"})
+                continue
+            for error in result["errors"]:
+                print(f"Error: {error['path']} ({error['file_id']}): {error['error']}", file=sys.stderr)
+            for key in ("files", "bytes", "digests", "seconds", "errors"):
+                report[key] += result[key]
+            print(f"Verified {result['files']} files ({result['bytes'] / 2**20:.1f}MiB, {result['digests']} with digests) "
+                  f"in {path} in {result['seconds']:.1f}s, {len(result['errors'])} failed")
+    report["ok"] = len(report["errors"]) == 0
+    if args.json == "-":
+        json.dump(report, stdout, indent=2)
+        stdout.write("\n")
+    elif args.json is not None:
+        with open(args.json, "w") as outfile:
+            json.dump(report, outfile, indent=2)
+            outfile.write("\n")
+    if not report["ok"]:
+        sys.exit(1)
+
+def export_main(argv):
+    arg_parser = PrintUsageParser(prog=f"{os.path.basename(sys.argv[0])} export", description="""
+    Write a tar or zip archive of files in the specified iPhone backup
+    to stdout, a file or a socket, without mounting it.
+
+    Paths are given as they appear in the mount, i.e. HomeDomain/Library.
+    The archive is written as it's produced, so it can be piped
+    into another program, i.e. export <backup> HomeDomain | zstd > out.tar.zst.
+    Progress messages go to stderr.
+    """)
+    arg_parser.add_argument("backup", help="the backup folder to read (include device UID)")
+    arg_parser.add_argument("paths", nargs="*", default=["/"], help="files or folders to export (default: everything)")
+    add_backup_arguments(arg_parser)
+    arg_parser.add_argument("--format", choices=FORMATS, default="tar", help="archive format (default: %(default)s)")
+    output_group = arg_parser.add_mutually_exclusive_group()
+    output_group.add_argument("-o", "--output", metavar="FILE", help="write the archive to this file instead of stdout")
+    output_group.add_argument("--connect", metavar="ADDRESS",
+                              help="write the archive to a socket, either HOST:PORT or the path of a Unix socket")
+    args = arg_parser.parse_intermixed_args(argv)
+    if args.output is None and args.connect is None and sys.stdout.isatty():
+        arg_parser.error("refusing to write an archive to a terminal, use -o or redirect stdout")
+    archive_stdout = sys.stdout.buffer
+    try:
+        # The archive may be going to stdout, so everything else goes to stderr
+        with contextlib.redirect_stdout(sys.stderr), _open_export_output(args, archive_stdout) as output:
+            fs = open_backup(args, readahead_size=0, cache_size=0)
+            for path in args.paths:
+                try:
+                    next(fs.walk(path))
+                except FuseOSError:
+                    print(f"Error: {path} doesn't exist in the backup", file=sys.stderr)
+                    sys.exit(1)
+            result = export(fs, args.paths, output, format=args.format)
+    except BrokenPipeError:
+        _exit_on_broken_pipe(sys.stdout)
+    for error in result["errors"]:
+        print(f"Error: {error}", file=sys.stderr)
+    print(f"Exported {result['entries']} entries ({result['bytes'] / 2**20:.1f}MiB)", file=sys.stderr)
+    if len(result["errors"]) > 0:
+        sys.exit(1)
+
+@contextlib.contextmanager
+def _open_export_output(args, stdout):
+    if args.output is not None:
+        with open(args.output, 'wb') as outfile:
+            yield outfile
+    elif args.connect is not None:
+        if "/" in args.connect or ":" not in args.connect:
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.connect(args.connect)
+        else:
+            (host, port) = args.connect.rsplit(":", 1)
+            connection = socket.create_connection((host.strip("[]"), int(port)))
+        with connection, connection.makefile('wb') as outfile:
+            yield outfile
+    else:
+        yield stdout
+        stdout.flush()
+
+def query_main(argv):
+    arg_parser = PrintUsageParser(prog=f"{os.path.basename(sys.argv[0])} query", description="""
+    Find entries in the specified iPhone backup that match all of the given filters,
+    without mounting it, and print their paths as they appear in the mount.
+
+    This searches the index directly, which is much faster than running find
+    on a mount, i.e. query <backup> --name '*.sqlite' --min-size 10M --modified-after 2024-01-01
+    Progress messages go to stderr.
+    """)
+    arg_parser.add_argument("backup", help="the backup folder to read (include device UID)")
+    add_backup_arguments(arg_parser)
+    arg_parser.add_argument("--path", metavar="GLOB", help="match the whole path, i.e. '/HomeDomain/Library/*.db' (* matches / as well)")
+    arg_parser.add_argument("--name", metavar="GLOB", help="match the last part of the path, i.e. '*.sqlite'")
+    arg_parser.add_argument("--regex", help="regular expression to search for in the path")
+    arg_parser.add_argument("--domain", metavar="GLOB", help="match the domain name, i.e. 'AppDomain-*'")
+    arg_parser.add_argument("--type", choices=TYPES.keys(), help="f for files, d for folders, l for symlinks")
+    arg_parser.add_argument("--min-size", type=_parse_size, metavar="SIZE", help="smallest size, in bytes or with a K, M or G suffix")
+    arg_parser.add_argument("--max-size", type=_parse_size, metavar="SIZE", help="largest size, in bytes or with a K, M or G suffix")
+    arg_parser.add_argument("--modified-after", type=_parse_time, metavar="TIME",
+                            help="earliest modification time, as a Unix timestamp or an ISO date, i.e. 2024-01-01 or 2024-01-01T12:00:00")
+    arg_parser.add_argument("--modified-before", type=_parse_time, metavar="TIME", help="latest modification time, as with --modified-after")
+    arg_parser.add_argument("--protection-class", type=int, metavar="CLASS", help="data protection class")
+    arg_parser.add_argument("-l", "--long", action="store_true", help="print the mode, size and modification time of each entry as well")
+    args = arg_parser.parse_args(argv)
+    stdout = sys.stdout
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            fs = open_backup(args)
+        for (path, file_info) in query(fs, path=args.path, name=args.name, regex=args.regex, domain=args.domain, type=args.type,
+                                       min_size=args.min_size, max_size=args.max_size, modified_after=args.modified_after,
+                                       modified_before=args.modified_before, protection_class=args.protection_class):
+            if args.long:
+                properties = file_info.properties
+                # Not every MBFile has all of them
+                modified = properties.get("LastModified")
+                modified = "-".ljust(19) if modified is None else datetime.datetime.fromtimestamp(modified).isoformat(sep=" ")
+                print(f"{stat.filemode(properties.get('Mode', 0))} {properties.get('Size', 0):>12} {modified} {path}", file=stdout)
+            else:
+                print(path, file=stdout)
+        stdout.flush()
+    except re.error as e:
+        arg_parser.error(f"invalid regular expression: {e}")
+    except BrokenPipeError:
+        _exit_on_broken_pipe(stdout)
+
+def _parse_size(value):
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    try:
+        if value[-1:].upper() in units:
+            return int(float(value[:-1]) * units[value[-1].upper()])
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size: {value}")
+
+def _parse_time(value):
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        # Dates without a time zone are in local time, like the times printed by --long
+        return int(datetime.datetime.fromisoformat(value).timestamp())
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid time: {value}")
+
+def diff_main(argv):
+    arg_parser = PrintUsageParser(prog=f"{os.path.basename(sys.argv[0])} diff", description="""
+    Compare the manifests of two backups (i.e. of the same device, taken
+    at different times) without mounting them or reading any files,
+    and print what changed from the old one to the new one:
+
+    A <path> for entries that were added, D <path> for entries that were deleted
+    and M <path> (<what changed>) for entries that changed, where what changed
+    are the names of properties, or "contents" if the file's digest or
+    encryption key is different. Progress messages go to stderr.
+    """)
+    arg_parser.add_argument("old", help="the older backup folder (include device UID)")
+    arg_parser.add_argument("new", help="the newer backup folder (include device UID)")
+    add_backup_arguments(arg_parser)
+    args = arg_parser.parse_args(argv)
+    stdout = sys.stdout
+    # Entries that didn't change are only kept in memory once
+    columns = EntryColumns(deduplicate=True)
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            args.backup = args.old
+            old_fs = open_backup(args, readahead_size=0, cache_size=0, shared_columns=columns)
+            args.backup = args.new
+            new_fs = open_backup(args, readahead_size=0, cache_size=0, shared_columns=columns)
+        for (status, path, changes) in diff(old_fs, new_fs):
+            if len(changes) > 0:
+                print(f"{status} {path} ({', '.join(changes)})", file=stdout)
+            else:
+                print(f"{status} {path}", file=stdout)
+        stdout.flush()
+    except BrokenPipeError:
+        _exit_on_broken_pipe(stdout)
+
+def _exit_on_broken_pipe(stdout):
+    # The reader went away (i.e. head), there's no one left to tell
+    os.dup2(os.open(os.devnull, os.O_WRONLY), stdout.fileno())
+    sys.exit(1)
+
+def add_backup_arguments(arg_parser):
+    """
+    Adds the arguments every command needs to open a backup.
+    """
+    arg_parser.add_argument("-p", "--password", help="the backup password, if encrypted")
+    arg_parser.add_argument("--index-dir", metavar="DIR",
+                            help="keep an index file of the backup in this folder, so later uses of it are much faster")
+    arg_parser.add_argument("--no-ram-cache", action="store_true",
+                            help="don't load the manifest into memory, keep the index on disk instead")
+    arg_parser.add_argument("--key-file", help="cache the keys of encrypted backups, protected by the contents of this file")
+    arg_parser.add_argument("--key-cache-dir", metavar="DIR", default=default_cache_dir(),
+                            help="where to cache keys when using --key-file (default: %(default)s)")
+
+def open_backup(args, **options):
+    """
+    Returns a BackupFS or EncryptedBackupFS for the backup in args, asking for the password if needed.
+    Any options only apply to encrypted backups, except those in COMMON_OPTIONS.
+    """
+    root = os.path.abspath(args.backup)
+    password = args.password
     if password is None and "BACKUP_PASSWORD" in os.environ:
         password = os.environ["BACKUP_PASSWORD"]
 
     plist = biplist.readPlist(os.path.join(root, "Manifest.plist"))
     if plist["IsEncrypted"]:
         print("This is an encrypted backup.")
-        if password is None:
-            password = getpass.getpass(prompt="Enter the backup password: ")
-        fs = EncryptedBackupFS(root, password)
-    else:
-        print("This is an unencrypted backup.")
-        fs = BackupFS(root)
-    if foreground:
-        print("Staying in foreground, press Ctrl-C to unmount")
-    else:
-        print(f"Switching to background, use 'fusermount -u {mountpoint}' to unmount")
-    FUSE(fs, mountpoint, nothreads=True, foreground=foreground)
+        key_cache = None
+        if args.key_file is not None:
+            key_cache = KeyCache(args.key_cache_dir, args.key_file)
+        # The cached keys are only any use if they can be decrypted, i.e. not with a different key file
+        if password is None and (key_cache is None or not key_cache.has_keys(Keybag(plist["BackupKeyBag"]))):
+            # Kept, so other backups opened with the same args don't ask again
+            password = args.password = getpass.getpass(prompt="Enter the backup password: ")
+        return EncryptedBackupFS(root, password, index_dir=args.index_dir, ram_cache=not args.no_ram_cache, key_cache=key_cache, **options)
+    print("This is an unencrypted backup.")
+    return BackupFS(root, index_dir=args.index_dir, ram_cache=not args.no_ram_cache,
+                    **dict((key, value) for (key, value) in options.items() if key in COMMON_OPTIONS))
+
+class BackupFUSE(FUSE):
+    """
+    Sets caching flags for each file as it's opened, which Operations can't do without raw_fi.
+
+    With keep_cache, the kernel keeps file contents cached across opens, as it would with
+    the kernel_cache option, except for files whose contents change (see BackupFS.is_direct_io),
+    which are always read with direct I/O.
+    """
+    def __init__(self, operations, mountpoint, keep_cache=False, **kwargs):
+        # FUSE runs the filesystem from its constructor
+        self._keep_cache = keep_cache
+        super().__init__(operations, mountpoint, **kwargs)
+
+    def open(self, path, fip):
+        result = super().open(path, fip)
+        if self.operations.is_direct_io(path.decode(self.encoding)):
+            fip.contents.direct_io = 1
+        elif self._keep_cache:
+            fip.contents.keep_cache = 1
+        return result
 
 class PrintUsageParser(argparse.ArgumentParser):
     def error(self, message):
@@ -51,5 +480,14 @@ class PrintUsageParser(argparse.ArgumentParser):
         self.print_help()
         sys.exit(2)
 
+COMMANDS = {
+    "extract": extract_main,
+    "verify": verify_main,
+    "export": export_main,
+    "query": query_main,
+    "snapshots": snapshots_main,
+    "diff": diff_main,
+}
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,167 @@
+from .inode_operations import InodeOperations, DEFAULT_WORKERS
+from .metadata_index import BLOCK_SIZE
+import functools
+import errno
+import sys
+import os
+import pyfuse3
+import trio
+
+# Most requests handled at once, each one is a trio task
+MAX_REQUESTS = 128
+
+def _fuse_errors(method):
+    # pyfuse3 only passes FUSEError on to the kernel, anything else is logged as a bug
+    @functools.wraps(method)
+    async def wrapper(*args):
+        try:
+            return await method(*args)
+        except pyfuse3.FUSEError:
+            raise
+        except OSError as e:
+            raise pyfuse3.FUSEError(e.errno or errno.EIO) from None
+        except Exception as e:
+            # i.e. invalid padding or a key the cipher doesn't accept, when decrypting a damaged file
+            print(f"Error: {method.__name__}: {type(e).__name__}: {e}", file=sys.stderr)
+            raise pyfuse3.FUSEError(errno.EIO) from None
+    return wrapper
+
+def _nanoseconds(seconds):
+    return round(seconds * 10**9)
+
+class Pyfuse3Operations(pyfuse3.Operations):
+    """
+    Runs a BackupFS, EncryptedBackupFS or SnapshotsFS on pyfuse3 (libfuse 3's low-level API)
+    through InodeOperations, translating attribute dicts and errors.
+
+    The timeouts and keep_cache work like the FUSE options of the same names. Unlike with fusepy,
+    the kernel is told about entries that changed when the backup is refreshed, so they
+    don't have to be limited to the refresh interval.
+    """
+    def __init__(self, fs, workers=DEFAULT_WORKERS, entry_timeout=1, attr_timeout=1, negative_timeout=0, keep_cache=False):
+        super().__init__()
+        self._fs = fs
+        self._operations = InodeOperations(fs, workers)
+        self._entry_timeout = entry_timeout
+        self._attr_timeout = attr_timeout
+        self._negative_timeout = negative_timeout
+        self._keep_cache = keep_cache
+        fs.add_refresh_listener(self._invalidate)
+
+    def _entry(self, attrs):
+        entry = pyfuse3.EntryAttributes()
+        entry.st_ino = attrs["st_ino"]
+        entry.st_mode = attrs["st_mode"]
+        entry.st_nlink = attrs["st_nlink"]
+        entry.st_uid = attrs["st_uid"]
+        entry.st_gid = attrs["st_gid"]
+        entry.st_size = attrs["st_size"]
+        entry.st_blksize = BLOCK_SIZE
+        entry.st_blocks = attrs.get("st_blocks", -(-attrs["st_size"] // 512))
+        entry.st_atime_ns = _nanoseconds(attrs["st_atime"])
+        entry.st_ctime_ns = _nanoseconds(attrs["st_ctime"])
+        entry.st_mtime_ns = _nanoseconds(attrs["st_mtime"])
+        entry.entry_timeout = self._entry_timeout
+        entry.attr_timeout = self._attr_timeout
+        return entry
+
+    def _invalidate(self, paths):
+        # Called on the refresh thread, never from a request handler, so it can wait for the kernel
+        for (inode, parent_inode, name) in self._operations.known_entries(paths):
+            if inode is not None:
+                try:
+                    pyfuse3.invalidate_inode(inode)
+                except OSError:
+                    # Already forgotten by the kernel
+                    pass
+            if parent_inode is not None:
+                pyfuse3.invalidate_entry_async(parent_inode, os.fsencode(name), ignore_enoent=True)
+
+    def init(self):
+        # Called once FUSE is running, after it has moved to the background
+        self._fs("init", "/")
+
+    @_fuse_errors
+    async def lookup(self, parent_inode, name, ctx=None):
+        try:
+            return self._entry(await self._operations.lookup(parent_inode, os.fsdecode(name)))
+        except OSError as e:
+            if e.errno != errno.ENOENT or self._negative_timeout <= 0:
+                raise
+        # Inode 0 tells the kernel to remember that the name doesn't exist
+        entry = pyfuse3.EntryAttributes()
+        entry.st_ino = 0
+        entry.entry_timeout = self._negative_timeout
+        return entry
+
+    async def forget(self, inode_list):
+        self._operations.forget(inode_list)
+
+    @_fuse_errors
+    async def getattr(self, inode, ctx=None):
+        return self._entry(await self._operations.getattr(inode))
+
+    @_fuse_errors
+    async def readlink(self, inode, ctx):
+        return os.fsencode(await self._operations.readlink(inode))
+
+    @_fuse_errors
+    async def opendir(self, inode, ctx):
+        return await self._operations.opendir(inode)
+
+    @_fuse_errors
+    async def readdir(self, fh, start_id, token):
+        # readdir_reply sends the attributes along (readdirplus), so no lookups are needed afterwards
+        await self._operations.readdir(fh, start_id,
+            lambda name, attrs, next_id: pyfuse3.readdir_reply(token, os.fsencode(name), self._entry(attrs), next_id))
+
+    async def releasedir(self, fh):
+        self._operations.releasedir(fh)
+
+    @_fuse_errors
+    async def open(self, inode, flags, ctx):
+        (fh, direct_io) = await self._operations.open(inode, flags)
+        return pyfuse3.FileInfo(fh=fh, direct_io=direct_io, keep_cache=self._keep_cache and not direct_io)
+
+    @_fuse_errors
+    async def read(self, fh, off, size):
+        return await self._operations.read(fh, off, size)
+
+    @_fuse_errors
+    async def release(self, fh):
+        await self._operations.release(fh)
+
+    @_fuse_errors
+    async def statfs(self, ctx):
+        result = await self._operations.statfs()
+        data = pyfuse3.StatvfsData()
+        for key in ("f_bsize", "f_frsize", "f_blocks", "f_bfree", "f_bavail", "f_files", "f_ffree", "f_favail", "f_namemax"):
+            setattr(data, key, result[key])
+        return data
+
+def _daemonize():
+    # As libfuse does for fusepy: the mount stays with the child, the parent returns to the shell
+    if os.fork() > 0:
+        os._exit(0)
+    os.setsid()
+    os.chdir("/")
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+
+def run_pyfuse3(fs, mountpoint, foreground=False, workers=DEFAULT_WORKERS, **options):
+    """
+    Mounts fs at mountpoint with pyfuse3 until it's unmounted.
+    options are passed on to Pyfuse3Operations.
+    """
+    operations = Pyfuse3Operations(fs, workers, **options)
+    pyfuse3.init(operations, mountpoint, set(pyfuse3.default_options) | {"ro", "fsname=mount-ios-backup"})
+    try:
+        if not foreground:
+            _daemonize()
+        trio.run(pyfuse3.main, 1, MAX_REQUESTS)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        fs("destroy", "/")
+        pyfuse3.close()
@@ -0,0 +1,62 @@
+from .file_info import mount_path
+import posixpath
+import fnmatch
+import re
+
+# Values of the type filter, and the flags of the entries they match
+TYPES = {"f": 1, "d": 2, "l": 4}
+
+def _glob(pattern):
+    return re.compile(fnmatch.translate(pattern)).match
+
+def query(fs, path=None, name=None, regex=None, domain=None, type=None, min_size=None, max_size=None,
+          modified_after=None, modified_before=None, protection_class=None):
+    """
+    Yields (path, FileInfo) for every entry in the backup that matches all of the given filters,
+    in no particular order:
+
+    path: glob matched against the whole path as it appears in the mount, i.e. /HomeDomain/Library/*.db
+          (* matches / as well)
+    name: glob matched against the last part of the path, i.e. *.sqlite
+    regex: regular expression searched for in the path
+    domain: glob matched against domain names, i.e. AppDomain-*
+    type: "f" for files, "d" for folders or "l" for symlinks
+    min_size, max_size: in bytes, inclusive
+    modified_after, modified_before: Unix timestamps, inclusive
+    protection_class: data protection class number
+
+    The search runs against the index rather than walking the folders, and only entries
+    that pass the size, time, type and domain filters have their path looked at.
+    """
+    domains = None
+    if domain is not None:
+        domains = fnmatch.filter(fs.get_domains(), domain)
+    flags = None
+    if type is not None:
+        if type not in TYPES:
+            raise ValueError(f"unknown type: {type}")
+        flags = TYPES[type]
+    ranges = {}
+    if min_size is not None or max_size is not None:
+        ranges["Size"] = (min_size, max_size)
+    if modified_after is not None or modified_before is not None:
+        ranges["LastModified"] = (modified_after, modified_before)
+    if protection_class is not None:
+        ranges["ProtectionClass"] = (protection_class, protection_class)
+
+    matchers = []
+    if path is not None:
+        matchers.append(_glob(path))
+    if name is not None:
+        name_matcher = _glob(name)
+        matchers.append(lambda entry_path: name_matcher(posixpath.basename(entry_path)))
+    if regex is not None:
+        matchers.append(re.compile(regex).search)
+    path_filter = None
+    if len(matchers) > 0:
+        def path_filter(entry_domain, relative_path):
+            entry_path = mount_path(entry_domain, relative_path)
+            return all(matcher(entry_path) for matcher in matchers)
+
+    for file_info in fs.search(domains, flags, ranges, path_filter):
+        yield (file_info.get_mount_path(), file_info)
@@ -0,0 +1,120 @@
+from . import google_iphone_dataprotection
+from . import stats
+from concurrent.futures import Future, wait
+from Crypto.Cipher import AES
+import threading
+import os
+
+# Files are read ahead in pieces of this size. Must be a multiple of the AES block size.
+CHUNK_SIZE = 1024 * 1024
+# Number of back-to-back sequential reads before reading ahead starts
+SEQUENTIAL_THRESHOLD = 2
+
+class ReadAhead():
+    """
+    Tracks the access pattern of one open encrypted file. Once reads turn out
+    to be sequential, the chunks following the current read are read and
+    decrypted in the background, and later reads are served from them.
+
+    At most `window_size` bytes (rounded up to whole chunks) beyond the chunk
+    currently being read are buffered.
+    """
+    def __init__(self, executor, fh, key, blob_size, window_size):
+        self._executor = executor
+        self._fh = fh
+        self._key = key
+        self._blob_size = blob_size
+        self._last_chunk = (blob_size - 1) // CHUNK_SIZE
+        self._window_chunks = max(1, -(-window_size // CHUNK_SIZE))
+        # Chunk index -> Future of the decrypted chunk
+        self._chunks = {}
+        self._next_offset = None
+        self._sequential_reads = 0
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def read(self, offset, length):
+        """
+        Returns the requested data if it's buffered, or if the reads so far have been
+        sequential. Otherwise returns None and the caller should read the data itself.
+        """
+        if length <= 0 or offset >= self._blob_size:
+            return None
+        first = offset // CHUNK_SIZE
+        last = min((offset + length - 1) // CHUNK_SIZE, self._last_chunk)
+        inline = []
+        with self._lock:
+            if self._closed:
+                return None
+            if offset == self._next_offset:
+                self._sequential_reads += 1
+            else:
+                self._sequential_reads = 0
+            self._next_offset = offset + length
+            sequential = self._sequential_reads >= SEQUENTIAL_THRESHOLD
+            if sequential:
+                # Only the chunks of this read and the window after it are kept. Chunks behind the current one
+                # won't be needed again, and after a seek backwards, neither will the old window ahead of it.
+                for index in [index for index in self._chunks if not first <= index <= last + self._window_chunks]:
+                    self._chunks.pop(index).cancel()
+                # Chunks this read needs right away are decrypted on this thread rather than queued
+                for index in range(first, last + 1):
+                    if index not in self._chunks:
+                        future = Future()
+                        # Marked running up front so close() waits for it instead of cancelling it
+                        future.set_running_or_notify_cancel()
+                        self._chunks[index] = future
+                        inline.append((index, future))
+                for index in range(last + 1, min(last + self._window_chunks, self._last_chunk) + 1):
+                    if index not in self._chunks:
+                        self._chunks[index] = self._executor.submit(self._load_chunk, index)
+            futures = [self._chunks.get(index) for index in range(first, last + 1)]
+        if None in futures:
+            stats.count("readahead_misses")
+            return None
+        for (index, future) in inline:
+            try:
+                future.set_result(self._load_chunk(index))
+            except Exception as e:
+                future.set_exception(e)
+        parts = []
+        try:
+            for (index, future) in zip(range(first, last + 1), futures):
+                chunk_start = index * CHUNK_SIZE
+                chunk = future.result()
+                parts.append(chunk[max(0, offset - chunk_start):offset + length - chunk_start])
+        except Exception:
+            # Let the caller try again the slow way, it will raise a proper error if needed
+            stats.count("readahead_misses")
+            return None
+        stats.count("readahead_hits")
+        return b"".join(parts)
+
+    def _load_chunk(self, index):
+        start = index * CHUNK_SIZE
+        with stats.timer("disk_read"):
+            if index == 0:
+                iv = b"\x00" * AES.block_size
+                data = os.pread(self._fh, CHUNK_SIZE, start)
+            else:
+                # The IV is the last block of the previous chunk
+                data = os.pread(self._fh, CHUNK_SIZE + AES.block_size, start - AES.block_size)
+                iv = data[:AES.block_size]
+                data = data[AES.block_size:]
+        with stats.timer("decrypt"):
+            decrypted = AES.new(self._key, AES.MODE_CBC, iv).decrypt(data)
+        if start + len(data) >= self._blob_size:
+            decrypted = google_iphone_dataprotection.removePadding(decrypted)
+        return decrypted
+
+    def close(self):
+        """
+        Discards the buffer and waits for background reads to stop,
+        so the file descriptor can be closed safely afterwards.
+        """
+        with self._lock:
+            self._closed = True
+            futures = list(self._chunks.values())
+            self._chunks = {}
+        running = [future for future in futures if not future.cancel()]
+        wait(running)
@@ -0,0 +1,155 @@
+from .file_info import ROOT_INODE
+from fuse import FuseOSError, Operations
+import hashlib
+import errno
+import os
+
+# Properties compared by diff, in the order changes are listed
+DIFF_PROPERTIES = ("Size", "LastModified", "Mode", "UserID", "GroupID", "Target")
+# Properties that change along with a file's contents, compared if both entries have one
+CONTENT_PROPERTIES = ("Digest", "EncryptionKey")
+_INODE_MASK = (1 << 63) - 1
+
+class SnapshotsFS(Operations):
+    """
+    Several backups (i.e. snapshots of the same device taken at different times)
+    mounted side by side, each one in a folder of its own: /<name>/HomeDomain/...
+
+    Each snapshot is a BackupFS or EncryptedBackupFS of its own, everything below
+    its folder is passed on to it. Give them the same EntryColumns with deduplicate
+    to share the entries that didn't change between them.
+    """
+    def __init__(self, snapshots):
+        """
+        snapshots is {name: filesystem}, listed in that order.
+        """
+        self._snapshots = snapshots
+        # Mixed into the inode numbers of each snapshot, as entries that didn't change have the same fileID
+        self._inode_salts = dict((name, int(hashlib.sha1(name.encode("utf-8")).hexdigest()[:16], 16) & _INODE_MASK)
+                                 for name in snapshots)
+
+    def _salt_inode(self, name, attrs):
+        if attrs is None or "st_ino" not in attrs:
+            return attrs
+        attrs = dict(attrs)
+        inode = attrs["st_ino"] ^ self._inode_salts[name]
+        # Kept clear of the root's number
+        attrs["st_ino"] = inode if inode > ROOT_INODE else inode + ROOT_INODE + 1
+        return attrs
+
+    def __call__(self, op, *args):
+        if op in ("init", "destroy"):
+            for fs in self._snapshots.values():
+                fs(op, *args)
+            return None
+        (name, _, rest) = args[0].lstrip("/").partition("/")
+        if name == "":
+            # The root itself
+            return super().__call__(op, *args)
+        fs = self._snapshots.get(name)
+        if fs is None:
+            raise FuseOSError(errno.ENOENT)
+        result = fs(op, "/" + rest, *args[1:])
+        if op == "getattr":
+            return self._salt_inode(name, result)
+        if op == "readdir":
+            return [(entry[0], self._salt_inode(name, entry[1]), entry[2]) if isinstance(entry, tuple) else entry
+                    for entry in result]
+        return result
+
+    def add_refresh_listener(self, listener):
+        for (name, fs) in self._snapshots.items():
+            fs.add_refresh_listener(lambda paths, name=name: listener(None if paths is None else [f"/{name}{path}" for path in paths]))
+
+    def lookups_may_block(self):
+        return any(fs.lookups_may_block() for fs in self._snapshots.values())
+
+    def is_direct_io(self, path):
+        (name, _, rest) = path.lstrip("/").partition("/")
+        fs = self._snapshots.get(name)
+        return fs is not None and fs.is_direct_io("/" + rest)
+
+    def _root_stats(self):
+        st = os.lstat(next(iter(self._snapshots.values())).root)
+        attrs = dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
+                     'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_uid'))
+        attrs["st_size"] = 0
+        attrs["st_ino"] = ROOT_INODE
+        return attrs
+
+    def getattr(self, path, fh=None):
+        return self._root_stats()
+
+    def readdir(self, path, fh):
+        yield ('.', self._root_stats(), 0)
+        yield '..'
+        for (name, fs) in self._snapshots.items():
+            yield (name, self._salt_inode(name, fs("getattr", "/")), 0)
+
+    def statfs(self, path):
+        # Totals of all snapshots together
+        result = None
+        for fs in self._snapshots.values():
+            snapshot_result = fs("statfs", "/")
+            if result is None:
+                result = dict(snapshot_result)
+            else:
+                result["f_blocks"] += snapshot_result["f_blocks"]
+                result["f_files"] += snapshot_result["f_files"]
+        result["f_files"] += len(self._snapshots)
+        return result
+
+def snapshot_names(paths):
+    """
+    Returns {name: path} for backup folders given as NAME=PATH or PATH, in which case
+    the name is the folder's name. Raises ValueError if names are used more than once.
+    """
+    result = {}
+    for path in paths:
+        (name, separator, folder) = path.partition("=")
+        if len(separator) == 0 or "/" in name:
+            folder = path
+            name = os.path.basename(os.path.normpath(os.path.abspath(path)))
+        if name in result:
+            raise ValueError(f"more than one snapshot named {name}, use NAME=PATH to name them")
+        if len(name) == 0 or name.startswith("."):
+            raise ValueError(f"invalid snapshot name: {name}")
+        result[name] = folder
+    return result
+
+def _changes(old_info, new_info):
+    changes = []
+    if old_info.flags != new_info.flags:
+        changes.append("type")
+    for key in DIFF_PROPERTIES:
+        if old_info.properties.get(key) != new_info.properties.get(key):
+            changes.append(key)
+    for key in CONTENT_PROPERTIES:
+        if key in old_info.properties and key in new_info.properties:
+            if old_info.properties[key] != new_info.properties[key]:
+                changes.append("contents")
+            break
+    return changes
+
+def diff(old_fs, new_fs):
+    """
+    Yields (status, path, changes) for every entry that differs between two backups:
+    status is "A" for entries only in new_fs, "D" for entries only in old_fs and "M" for
+    entries in both that differ. For "M", changes lists what's different: "type", names of
+    DIFF_PROPERTIES, and "contents" if the digest or encryption key of the file differs.
+
+    Only the manifests are compared, no file contents are read, so a file whose contents changed
+    without its size, modification time, digest or key changing isn't found. That can only happen
+    in unencrypted backups whose manifest has no digests.
+    """
+    for new_info in new_fs.search():
+        old_info = old_fs.get_entry(new_info.domain, new_info.relative_path)
+        if old_info is None:
+            yield ("A", new_info.get_mount_path(), [])
+            continue
+        changes = _changes(old_info, new_info)
+        if len(changes) > 0:
+            yield ("M", new_info.get_mount_path(), changes)
+    for old_info in old_fs.search():
+        if new_fs.get_entry(old_info.domain, old_info.relative_path) is None:
+            yield ("D", old_info.get_mount_path(), [])
@@ -1,24 +1,64 @@
 import os
+import stat
+import time
 import errno
-import biplist
+import shutil
+import hashlib
 import sqlite3
-from .file_info import FileInfo
+import tempfile
+import threading
+from urllib.request import pathname2url
+from .file_info import FileInfo, inode_number, mount_path
+from .metadata_index import MetadataIndex, BLOCK_SIZE
+from .lazy_index import LazyIndex
+from .index_file import manifest_fingerprint, manifest_state, load_index, save_index, build_index_file
+from . import stats
 from fuse import FuseOSError, Operations
 
 def debug(message):
     if False:
         print(message)
 
+# Hidden folder at the root of the mount with files about the mount itself
+STATS_DIR = "/.mount-ios-backup"
+# JSON with the counters and timings collected by the stats module
+STATS_PATH = f"{STATS_DIR}/stats"
+# Files whose contents change while mounted, which the kernel must not cache
+DIRECT_IO_PATHS = frozenset((STATS_PATH,))
+# Number of missing paths remembered with negative_cache, forgotten all at once when full
+NEGATIVE_CACHE_SIZE = 100000
+
 class BackupFS(Operations):
     # Based on the "file creation flags" in https://man7.org/linux/man-pages/man2/open.2.html#DESCRIPTION
     BAD_FILE_FLAGS = os.O_WRONLY | os.O_RDWR | os.O_CREAT | os.O_EXCL | os.O_TMPFILE | os.O_TRUNC
-    def __init__(self, root):
+    # Operations whose latency is recorded in the stats
+    TIMED_OPERATIONS = frozenset(("getattr", "readdir", "open", "read", "readlink"))
+    def __init__(self, root, index_dir=None, ram_cache=True, lazy=False, negative_cache=False, shared_columns=None, refresh_interval=None):
         self.root = os.path.abspath(root)
         self._db_connection = None
-        self._domain_tree = {}
-        self._generate_domain_tree()
+        self._ram_cache = ram_cache
+        self._lazy = lazy
+        # EntryColumns shared with the indexes of other snapshots, only used for in-memory indexes
+        self._shared_columns = shared_columns
+        # Paths that don't exist, with negative_cache. Only ever added to or replaced, so reading it needs no lock
+        self._missing = set() if negative_cache else None
+        # fh -> contents of open virtual files
+        self._virtual_files = {}
+        # Seconds between checks for changes to the manifest, or None to not check
+        self._refresh_interval = refresh_interval
+        # Held while reloading the manifest
+        self._refresh_lock = threading.Lock()
+        # Called with the paths that changed after each refresh, see add_refresh_listener
+        self._refresh_listeners = []
+        self._index = self._load_index(index_dir)
         print("Init finished")
 
+    @property
+    def _domain_tree(self):
+        # Top level of the index's directory tree, used to resolve virtual domains.
+        # Taken from the index each time, as refresh replaces it.
+        return self._index.domain_tree
+
     # Helpers
     # =======
 
@@ -29,6 +69,24 @@ class BackupFS(Operations):
         
         The FileInfo will be "virtual" if the target is a virtual domain, i.e. AppInfo or root
         """
+        # Taken before the lookup: refresh replaces the index before the set, so a name that's missing
+        # from the old index can only end up in the old set, never in the one that goes with the new index
+        missing = self._missing
+        if missing is None:
+            return self._lookup_file_info(partial)
+        if partial in missing:
+            stats.count("negative_cache_hits")
+            raise FuseOSError(errno.ENOENT)
+        try:
+            return self._lookup_file_info(partial)
+        except FuseOSError:
+            # Probes for names like .git or desktop.ini tend to be repeated for every folder, over and over
+            if len(missing) >= NEGATIVE_CACHE_SIZE:
+                missing.clear()
+            missing.add(partial)
+            raise
+
+    def _lookup_file_info(self, partial):
         if partial.startswith("/"):
             partial = partial[1:]
         if partial.endswith(os.sep):
@@ -36,8 +94,10 @@ class BackupFS(Operations):
         if len(partial) == 0:
             return FileInfo(self.root, None, "", None, None, 2, virtual=True)
         parts = partial.split(os.sep)
+        # The same index throughout, even if refresh replaces it meanwhile
+        current_index = self._index
         try:
-            domain_tree = self._domain_tree[parts[0]]
+            domain_tree = current_index.domain_tree[parts[0]]
         except KeyError:
             debug(f"Invalid domain: {parts[0]}")
             raise FuseOSError(errno.ENOENT)
@@ -65,52 +125,271 @@ class BackupFS(Operations):
         # Chop trailing slash
         relative_path = relative_path[:-1]
         
-        cur = self._get_db_connection().cursor()
-        cur.execute("SELECT `fileID`,`file`,`flags` FROM `Files` WHERE `domain` = ? AND `relativePath` = ?", (domain_path, relative_path))
-        row = cur.fetchone()
-        if row is None:
-            debug(f"No matching row from database on domain '{domain_path}', relative '{relative_path}'")
+        file_info = current_index.get(domain_path, relative_path)
+        if file_info is None:
+            debug(f"No matching entry in index on domain '{domain_path}', relative '{relative_path}'")
             raise FuseOSError(errno.ENOENT)
-        return FileInfo(self.root, row[0], domain_path, relative_path, biplist.readPlistFromString(row[1]), row[2])
+        return file_info
     
+    def _load_index(self, index_dir):
+        """
+        Returns the metadata index for the backup.
+
+        If index_dir is given, the index is loaded from an index file in it if that's
+        up to date, otherwise it is built from the manifest and saved there for next time.
+
+        With lazy mounting, a LazyIndex is returned instead of waiting for the index to be built.
+        """
+        index_path = self._index_path = None
+        # What the index was built from, for refresh to compare against. The state is taken
+        # first, so a change made while this is running is picked up rather than missed.
+        self._manifest_state = manifest_state(self.root)
+        fingerprint = self._fingerprint = manifest_fingerprint(self.root)
+        if index_dir is not None:
+            path_hash = hashlib.sha1(self.root.encode("utf-8")).hexdigest()[:12]
+            index_path = self._index_path = os.path.join(index_dir, f"{os.path.basename(self.root)}-{path_hash}.index")
+            index = load_index(index_path, self.root, fingerprint, self._get_index_key())
+            if index is not None:
+                print("Loaded index file")
+                return index
+            os.makedirs(index_dir, exist_ok=True)
+        if self._lazy:
+            return LazyIndex(self.root, self._get_db_connection(),
+                lambda lock: self._build_index(index_path, fingerprint, lock), self._close_db_connection)
+        return self._build_index(index_path, fingerprint)
+
+    def _build_index(self, index_path, fingerprint, lock=None, previous=None):
+        """
+        Builds the index from the manifest.
+
+        If lock is given, the manifest is also used for lookups while building, so the lock
+        is held while reading it, and it's left open for the caller to close.
+
+        If previous is an in-memory index of an earlier version of the manifest,
+        the index is built from it, see MetadataIndex.updated.
+        """
+        if not self._ram_cache:
+            return self._build_index_file(index_path, fingerprint, lock)
+        if isinstance(previous, MetadataIndex):
+            index = previous.updated(self._get_db_connection())
+        else:
+            index = MetadataIndex(self.root, self._shared_columns)
+            index.build(self._get_db_connection(), lock)
+        if lock is None:
+            # Everything needed at runtime is in the index now
+            self._close_db_connection()
+        if index_path is not None:
+            print("Saving index file...")
+            save_index(index, index_path, fingerprint, self._get_index_key())
+        return index
+
+    def _build_index_file(self, index_path, fingerprint, lock=None):
+        # Without RAM-caching, the index is built on disk and used from there, so memory use stays flat
+        temp_dir = None
+        if index_path is None or self._get_index_key() is not None:
+            # Encrypted index files have to be decrypted into memory, so use
+            # an unencrypted one that only lasts as long as the mount instead.
+            temp_dir = tempfile.mkdtemp()
+            index_path = os.path.join(temp_dir, "Manifest.index")
+        try:
+            build_index_file(self._get_db_connection(), self.root, index_path, fingerprint, lock)
+            if lock is None:
+                self._close_db_connection()
+            # The index stays open, so it can be deleted right away
+            index = load_index(index_path, self.root, fingerprint)
+            if index is None:
+                raise ConnectionError("Could not load index file!")
+            return index
+        finally:
+            if temp_dir is not None:
+                shutil.rmtree(temp_dir)
+
+    def refresh(self):
+        """
+        Reloads the index if the manifest changed since it was loaded, i.e. because the backup
+        was updated in place. Entries whose rows in the manifest didn't change aren't decoded again.
+
+        The new index is built next to the old one, which keeps answering lookups until it's
+        replaced in one step, and open files keep reading the blobs they were opened with.
+        Returns whether the index was replaced. Raises an exception if the manifest can't
+        be read (i.e. it's still being written), in which case the old index is kept.
+        """
+        with self._refresh_lock:
+            state = manifest_state(self.root)
+            fingerprint = manifest_fingerprint(self.root)
+            if fingerprint == self._fingerprint:
+                self._manifest_state = state
+                return False
+            previous = self._index
+            if isinstance(previous, LazyIndex):
+                # It's using the manifest until it's built, so wait until then
+                previous = previous.built_index()
+                if previous is None:
+                    return False
+            print("Manifest changed, reloading...")
+            self._reload_manifest()
+            try:
+                index = self._build_index(self._index_path, fingerprint, previous=previous)
+            finally:
+                self._close_db_connection()
+            if isinstance(index, MetadataIndex) and isinstance(previous, MetadataIndex):
+                changed = index.changes(previous)
+            else:
+                changed = None
+            # In this order, see _get_file_info
+            self._index = index
+            if self._missing is not None:
+                self._missing = set()
+            self._entries_changed(previous, changed)
+            self._manifest_state = state
+            self._fingerprint = fingerprint
+            print("Manifest reloaded" if changed is None else f"Manifest reloaded, {len(changed)} entries changed")
+            paths = None if changed is None else [mount_path(domain, relative_path) for (domain, relative_path) in changed]
+            for listener in self._refresh_listeners:
+                listener(paths)
+            return True
+
+    def add_refresh_listener(self, listener):
+        """
+        Has listener called on the refresh thread after each refresh that replaced the index, with the
+        paths (as they appear in the mount) of the entries that were added, removed or changed,
+        or None if they aren't known. Used to tell the kernel which cached entries are stale.
+        """
+        self._refresh_listeners.append(listener)
+
+    def _reload_manifest(self):
+        """
+        Called by refresh before the changed manifest is read.
+        """
+        pass
+
+    def _entries_changed(self, previous, changed):
+        """
+        Called by refresh once the new index is in use, with the old index and the (domain, relativePath)
+        of every entry that was added, removed or changed, or None if they aren't known.
+        """
+        pass
+
+    def _refresh_loop(self):
+        last_state = self._manifest_state
+        while True:
+            time.sleep(self._refresh_interval)
+            state = manifest_state(self.root)
+            # Only reload once the manifest has stopped changing for one interval, as it's rewritten
+            # in place while the backup is updated
+            if state != last_state or state is None or state == self._manifest_state:
+                last_state = state
+                continue
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Reloading the manifest failed, trying again later: {e}")
+
+    def get_file_key(self, file_info):
+        """
+        Returns the key the file's contents are encrypted with, or None if they aren't.
+        Raises ValueError if they are, but the key can't be unwrapped.
+        """
+        return None
+
+    def get_domains(self):
+        return sorted(self._index.domains)
+
+    def is_direct_io(self, path):
+        """
+        Returns whether the kernel must not cache the contents of the file at path.
+        """
+        return path in DIRECT_IO_PATHS
+
+    def lookups_may_block(self):
+        """
+        Returns whether looking up entries may wait on the disk, i.e. with an index file or
+        a lazy index that is still querying the manifest, instead of only using memory.
+        """
+        index = self._index
+        if isinstance(index, LazyIndex):
+            index = index.built_index()
+        return not isinstance(index, MetadataIndex)
+
+    def get_entry(self, domain, relative_path):
+        """
+        Returns the FileInfo of the entry at relative_path in domain, or None if it doesn't exist.
+        """
+        return self._index.get(domain, relative_path)
+
+    def search(self, domains=None, flags=None, ranges=None, path_filter=None):
+        """
+        Yields the FileInfo of every entry in the index that matches all of the given filters,
+        see MetadataIndex.search. The query module offers a friendlier way to use this.
+        """
+        return self._index.search(domains, flags, ranges, path_filter)
+
+    def walk(self, path="/"):
+        """
+        Yields (path, FileInfo) for path and everything below it, with directories before their contents.
+        Entries that can't be looked up (i.e. a domain without a root entry) are skipped.
+        """
+        path = "/" + path.strip("/")
+        yield from self._walk(path, self._get_file_info(path))
+
+    def _walk(self, path, file_info):
+        yield (path, file_info)
+        if not file_info.is_directory():
+            return
+        prefix = path if path != "/" else ""
+        if file_info.virtual:
+            if file_info.domain == "":
+                names = self._domain_tree.keys()
+            else:
+                names = self._domain_tree[file_info.domain].keys()
+            for name in names:
+                try:
+                    child_info = self._get_file_info(f"{prefix}/{name}")
+                except FuseOSError:
+                    continue
+                yield from self._walk(f"{prefix}/{name}", child_info)
+            return
+        for (name, child_info) in self._index.list_entries(file_info.domain, file_info.relative_path):
+            if child_info is not None:
+                yield from self._walk(f"{prefix}/{name}", child_info)
+
+    def _get_index_key(self):
+        """
+        Returns the key index files are encrypted with, or None if they shouldn't be.
+        """
+        return None
+
     # Do not assume this file exists or has a value except while calling _create_db_connection
     def _get_db_file(self):
         return os.path.join(self.root, "Manifest.db")
     
-    def _generate_domain_tree(self):
-        cur = self._get_db_connection().cursor()
-        cur.execute("SELECT DISTINCT domain FROM Files")
-        for row in cur:
-            if row[0] is None:
-                continue
-            parts = row[0].split("-", 1)
-            if len(parts) == 1:
-                self._domain_tree[parts[0]] = 1
-                continue
-            if parts[0] in self._domain_tree:
-                self._domain_tree[parts[0]][parts[1]] = 1
-            else:
-                self._domain_tree[parts[0]] = { parts[1]: 1 }
-    
     # Borrowed from _open_temp_database from iphone_backup.py
     def _create_db_connection(self):
         db = self._get_db_file()
         if not os.path.exists(db):
             return False
         try:
-            if self._db_connection is None:
+            if self._db_connection is None and not self._ram_cache:
+                # Nothing writes to the manifest while it's mounted, so it can be opened as immutable
+                self._db_connection = sqlite3.connect(f"file:{pathname2url(db)}?mode=ro&immutable=1", uri=True, check_same_thread=False)
+                self._db_connection.execute(f"PRAGMA mmap_size = {os.path.getsize(db)}")
+            elif self._db_connection is None:
                 file_connection = sqlite3.connect(db)
-                self._db_connection = sqlite3.connect(":memory:")
+                self._db_connection = sqlite3.connect(":memory:", check_same_thread=False)
                 print("Loading manifest into memory...")
                 file_connection.backup(self._db_connection)
-            # Check that it has the expected table structure and a list of files:
-            cur = self._db_connection.cursor()
-            cur.execute("SELECT count(*) FROM Files;")
-            file_count = cur.fetchone()[0]
-            cur.close()
-            return file_count > 0
+            return self._check_db_connection()
         except sqlite3.Error:
             return False
+
+    def _check_db_connection(self):
+        # Check that it has the expected table structure and a list of files:
+        cur = self._db_connection.cursor()
+        with stats.timer("db_query"):
+            cur.execute("SELECT count(*) FROM Files;")
+        file_count = cur.fetchone()[0]
+        cur.close()
+        return file_count > 0
     
     def _get_db_connection(self):
         if self._db_connection is None:
@@ -118,31 +397,104 @@ class BackupFS(Operations):
                 raise ConnectionError("Could not load Manifest database!")
         return self._db_connection
 
-    # Filesystem methods
-    # ==================
+    def _close_db_connection(self):
+        if self._db_connection is not None:
+            self._db_connection.close()
+            self._db_connection = None
 
-    def getattr(self, path, fh=None):
-        #st = os.lstat(real_path)
-        info = self._get_file_info(path)
+    def _get_stats(self, info):
         if info.virtual:
             st = os.lstat(self.root)
             stats = dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
                      'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_uid'))
             stats["st_size"] = 0
+            stats["st_ino"] = info.get_inode()
             return stats
         attrs = info.properties
         return {
-            'st_atime': attrs["LastStatusChange"],
-            'st_ctime': attrs["Birth"],
-            'st_gid':   attrs["GroupID"],
-            'st_mode':  attrs["Mode"],
-            'st_mtime': attrs["LastModified"],
-            'st_nlink': 1,
-            'st_size':  attrs["Size"],
-            'st_uid':   attrs["UserID"],
+            'st_atime':  attrs["LastStatusChange"],
+            # In 512 byte units, rounded up to whole blocks as counted by statfs, so du adds up to df
+            'st_blocks': -(-attrs["Size"] // BLOCK_SIZE) * (BLOCK_SIZE // 512),
+            'st_ctime':  attrs["Birth"],
+            'st_gid':    attrs["GroupID"],
+            'st_ino':    info.get_inode(),
+            'st_mode':   attrs["Mode"],
+            'st_mtime':  attrs["LastModified"],
+            'st_nlink':  1,
+            'st_size':   attrs["Size"],
+            'st_uid':    attrs["UserID"],
         }
 
+    def _get_virtual_file_stats(self, path):
+        st = os.lstat(self.root)
+        attrs = dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
+                 'st_gid', 'st_mtime', 'st_uid'))
+        attrs["st_ino"] = inode_number(hashlib.sha1(path.encode("utf-8")).hexdigest())
+        if path == STATS_DIR:
+            attrs["st_mode"] = stat.S_IFDIR | 0o555
+            attrs["st_nlink"] = 2
+            attrs["st_size"] = 0
+        else:
+            # The contents are only generated on open, and are read with direct I/O (see DIRECT_IO_PATHS)
+            # so the kernel reads up to the end of them rather than up to this size
+            attrs["st_mode"] = stat.S_IFREG | 0o444
+            attrs["st_nlink"] = 1
+            attrs["st_size"] = 0
+        return attrs
+
+    def _get_child_stats(self, domain, relative_path):
+        # Entries without a row of their own (i.e. a domain without a root entry) get no attributes,
+        # in which case the kernel falls back to calling getattr for them.
+        child_info = self._index.get(domain, relative_path)
+        if child_info is None:
+            return None
+        return self._get_stats(child_info)
+
+    # Filesystem methods
+    # ==================
+
+    def __call__(self, op, *args):
+        if op not in self.TIMED_OPERATIONS or not stats.enabled():
+            return super().__call__(op, *args)
+        start = time.perf_counter()
+        try:
+            result = super().__call__(op, *args)
+            if op == "readdir":
+                # Entries are generated on demand, so list them to include that in the time
+                result = list(result)
+            elif op == "read":
+                stats.count("bytes_read", len(result))
+            return result
+        except FuseOSError as e:
+            stats.count(f"{op}_errors.{errno.errorcode.get(e.errno, e.errno)}")
+            raise
+        finally:
+            stats.add_time(op, time.perf_counter() - start)
+
+    def init(self, path):
+        # Called once FUSE is running, after it has moved to the background
+        stats.start_dump_thread()
+        if isinstance(self._index, LazyIndex):
+            self._index.start()
+        if self._refresh_interval is not None:
+            threading.Thread(target=self._refresh_loop, daemon=True).start()
+
+    def getattr(self, path, fh=None):
+        #st = os.lstat(real_path)
+        if path == STATS_DIR or path == STATS_PATH:
+            return self._get_virtual_file_stats(path)
+        return self._get_stats(self._get_file_info(path))
+
     def readdir(self, path, fh):
+        """
+        Yields (name, attrs, 0) for each entry, so callers that want the stat
+        data of every entry (ls -l, rsync) get it in the same pass.
+        """
+        if path == STATS_DIR:
+            yield '.'
+            yield '..'
+            yield ('stats', self._get_virtual_file_stats(STATS_PATH), 0)
+            return
         file_info = None
         try:
             file_info = self._get_file_info(path)
@@ -150,47 +502,44 @@ class BackupFS(Operations):
         except FuseOSError:
             pass
 
-        yield '.'
-        yield '..'
         # If path doesn't exist or isn't a directory, return
         if file_info is None or not file_info.is_directory():
+            yield '.'
+            yield '..'
             return
-        cursor = self._get_db_connection().cursor()
+        yield ('.', self._get_stats(file_info), 0)
+        yield '..'
         if file_info.virtual:
             # Root
             if file_info.domain == "":
-                for domain in self._domain_tree.keys():
-                    yield domain
+                for (domain, subdomains) in self._domain_tree.items():
+                    if isinstance(subdomains, dict):
+                        yield (domain, self._get_stats(FileInfo(self.root, None, domain, None, None, 2, virtual=True)), 0)
+                    else:
+                        yield (domain, self._get_child_stats(domain, ""), 0)
                 return
-            # Selects all existing domains that start with whatever is in `file_info.domain` plus a dash
-            cursor.execute("SELECT DISTINCT `domain` FROM `Files` WHERE `domain` LIKE ? || '-%'", (file_info.domain,))
-            for row in cursor:
-                # Chop domain prefix
-                yield row[0][len(file_info.domain) + 1:]
+            # Subdomains of the domain in `file_info.domain`
+            for subdomain in self._domain_tree[file_info.domain].keys():
+                yield (subdomain, self._get_child_stats(f"{file_info.domain}-{subdomain}", ""), 0)
             return
-        target_path = file_info.relative_path
-        # If the target path isn't a domain root, restrict results to
-        # items that are actually inside the targeted folder and don't
-        # simply start with the name of the targeted folder.
-        if len(target_path) > 0:
-            target_path += "/"
-        # Filter by matching domain
-        cursor.execute("SELECT `relativePath` FROM `Files` WHERE `domain` = :domain"
-                    # Ignore anything where `relativePath` is an empty string
-                    + " AND `relativePath` <> ''"
-                    # Select anything where `relativePath` starts with whatever's in target_path
-                    + " AND `relativePath` LIKE :path || '%'"
-                    # Ignore anything that starts with target_path but contains a slash (to ignore subdirectories)
-                    + " AND `relativePath` NOT LIKE :path || '%/%'", {"domain": file_info.domain, "path": target_path})
-        for row in cursor:
-            # Chop target_path from beginning of string
-            yield row[0][len(target_path):]
+        for (name, child_info) in self._index.list_entries(file_info.domain, file_info.relative_path):
+            yield (name, None if child_info is None else self._get_stats(child_info), 0)
 
     def statfs(self, path):
-        stv = os.statvfs(self.root)
-        return dict((key, getattr(stv, key)) for key in ('f_bavail', 'f_bfree',
-            'f_blocks', 'f_bsize', 'f_favail', 'f_ffree', 'f_files', 'f_flag',
-            'f_frsize', 'f_namemax'))
+        # Sizes and counts of the backup's contents, not of the filesystem the backup is on
+        totals = self._index.totals()
+        return {
+            'f_bavail':  0,
+            'f_bfree':   0,
+            'f_blocks':  totals.blocks,
+            'f_bsize':   BLOCK_SIZE,
+            'f_favail':  0,
+            'f_ffree':   0,
+            'f_files':   totals.entries,
+            'f_flag':    os.ST_RDONLY | os.ST_NOSUID,
+            'f_frsize':  BLOCK_SIZE,
+            'f_namemax': 255,
+        }
 
     # This does not raise the EROFS error in the
     # default implementation like most other functions,
@@ -205,6 +554,13 @@ class BackupFS(Operations):
         # If any flags that cause writing are present, throw an error
         if flags & self.BAD_FILE_FLAGS != 0:
             raise FuseOSError(errno.EROFS)
+        if path == STATS_DIR:
+            return self.opendir(path)
+        if path == STATS_PATH:
+            # A real file descriptor keeps the handle distinct from those of backup files
+            fh = os.open(os.devnull, os.O_RDONLY)
+            self._virtual_files[fh] = stats.to_json().encode("utf-8")
+            return fh
         file_info = self._get_file_info(path)
         if file_info.is_directory():
             # Default implementation is just return 0, so I guess that's fine?
@@ -212,14 +568,18 @@ class BackupFS(Operations):
         return os.open(file_info.get_path(), flags)
 
     def read(self, path, length, offset, fh):
-        os.lseek(fh, offset, os.SEEK_SET)
-        return os.read(fh, length)
+        if fh in self._virtual_files:
+            return self._virtual_files[fh][offset:offset + length]
+        # Positional reads don't touch the shared file offset, so this is safe with multiple threads
+        with stats.timer("disk_read"):
+            return os.pread(fh, length, offset)
     
     def readlink(self, path):
         file_info = self._get_file_info(path)
         if "Target" not in file_info.properties:
             raise FuseOSError(errno.EINVAL)
-        return file_info.plist['$objects'][file_info.properties["Target"].integer]
+        return file_info.properties["Target"]
 
     def release(self, path, fh):
+        self._virtual_files.pop(fh, None)
         return os.close(fh)
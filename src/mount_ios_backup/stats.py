@@ -0,0 +1,196 @@
+import contextlib
+import threading
+import signal
+import json
+import time
+import sys
+import os
+
+# Latencies are counted in buckets of powers of two microseconds, the last one holds everything slower
+_BUCKETS = 32
+_DUMP_SIGNAL = signal.SIGUSR1
+_dump_signal_blocked = False
+_dump_thread_started = False
+# Nothing is recorded until enable is called, so operations don't wait on the lock for stats nobody reads
+_enabled = False
+# File the stats are written to on SIGUSR1, or None for stderr
+_dump_path = None
+
+class Histogram():
+    """
+    Latency histogram with power-of-two buckets, so recording a value is cheap.
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = [0] * _BUCKETS
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+        self.buckets[min(int(seconds * 1000000).bit_length(), _BUCKETS - 1)] += 1
+
+    def _percentile(self, fraction):
+        # Upper bound of the bucket the percentile falls in
+        target = self.count * fraction
+        seen = 0
+        for (index, count) in enumerate(self.buckets):
+            seen += count
+            if seen >= target:
+                return 1 << index
+        return 1 << _BUCKETS
+
+    def to_dict(self):
+        if self.count == 0:
+            return {"count": 0}
+        return {
+            "count":    self.count,
+            "total_ms": round(self.total * 1000, 3),
+            "mean_us":  round(self.total * 1000000 / self.count, 1),
+            "min_us":   round(self.min * 1000000, 1),
+            "max_us":   round(self.max * 1000000, 1),
+            "p50_us":   self._percentile(0.5),
+            "p90_us":   self._percentile(0.9),
+            "p99_us":   self._percentile(0.99),
+            # "<N": number of calls that took less than N microseconds
+            "buckets":  dict((f"<{1 << index}", count) for (index, count) in enumerate(self.buckets) if count > 0),
+        }
+
+class Stats():
+    """
+    Counters and latency histograms, collected while the backup is mounted.
+
+    Other statistics (i.e. those of the block cache) can be included with
+    add_source, they are fetched whenever a snapshot is taken.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._histograms = {}
+        self._counters = {}
+        self._sources = {}
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.add(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def add_source(self, name, function):
+        self._sources[name] = function
+
+    def snapshot(self):
+        with self._lock:
+            result = {
+                "uptime_s":   round(time.time() - self._started, 3),
+                "counters":   dict(self._counters),
+                "latency":    dict((name, histogram.to_dict()) for (name, histogram) in sorted(self._histograms.items())),
+            }
+        for (name, function) in self._sources.items():
+            result[name] = function()
+        return result
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True) + "\n"
+
+# Shared by everything in the mount
+_stats = Stats()
+
+def enable(dump_path=None):
+    """
+    Starts recording, for a mount. With dump_path, SIGUSR1 writes the stats to that file instead of stderr,
+    which is /dev/null once the mount has moved to the background.
+    """
+    global _enabled, _dump_path
+    _enabled = True
+    _dump_path = None if dump_path is None else os.path.abspath(dump_path)
+
+def enabled():
+    return _enabled
+
+def timer(name):
+    """
+    Context manager that records how long its body takes under name.
+    """
+    if not _enabled:
+        return contextlib.nullcontext()
+    return _stats.timer(name)
+
+def add_time(name, seconds):
+    if _enabled:
+        _stats.add_time(name, seconds)
+
+def count(name, amount=1):
+    if _enabled:
+        _stats.count(name, amount)
+
+def add_source(name, function):
+    _stats.add_source(name, function)
+
+def to_json():
+    if not _enabled:
+        return json.dumps({"enabled": False}) + "\n"
+    return _stats.to_json()
+
+def dump():
+    """
+    Writes the stats to the file given to enable, or to stderr.
+    """
+    if _dump_path is None:
+        sys.stderr.write(_stats.to_json())
+        sys.stderr.flush()
+        return
+    # Replaced whole, so the file is never seen half written
+    temp_path = f"{_dump_path}.tmp"
+    with open(temp_path, "w") as outfile:
+        outfile.write(_stats.to_json())
+    os.replace(temp_path, _dump_path)
+
+def block_dump_signal():
+    """
+    Keeps SIGUSR1 from killing the process, so that start_dump_thread can wait for it.
+    Must be called before any threads are started, as they inherit the signal mask.
+    Does nothing unless enable was called first.
+    """
+    global _dump_signal_blocked
+    if not _enabled:
+        return
+    signal.pthread_sigmask(signal.SIG_BLOCK, [_DUMP_SIGNAL])
+    _dump_signal_blocked = True
+
+def start_dump_thread():
+    """
+    Dumps the stats whenever the process receives SIGUSR1.
+    Does nothing unless block_dump_signal was called first, or if the thread is already running.
+    """
+    global _dump_thread_started
+    if not _dump_signal_blocked or _dump_thread_started:
+        return
+    _dump_thread_started = True
+    def wait():
+        while True:
+            signal.sigwait([_DUMP_SIGNAL])
+            try:
+                dump()
+            except OSError as e:
+                print(f"Error: can't write the stats to {_dump_path}: {e}", file=sys.stderr)
+    threading.Thread(target=wait, daemon=True).start()
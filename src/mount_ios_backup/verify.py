@@ -0,0 +1,175 @@
+from . import google_iphone_dataprotection
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from Crypto.Cipher import AES
+import multiprocessing
+import itertools
+import posixpath
+import hashlib
+import time
+import os
+
+# Blobs are read (and decrypted) in pieces of this size. Must be a multiple of the AES block size.
+VERIFY_CHUNK_SIZE = 8 * 1024 * 1024
+# Number of files handed to a worker process at a time
+JOBS_PER_TASK = 16
+# Batches of files handed to the workers but not finished yet, per worker
+TASKS_PER_WORKER = 2
+# Seconds between progress messages
+PROGRESS_INTERVAL = 2
+# Length of the SHA-1 digests stored in the manifest
+DIGEST_SIZE = 20
+
+class VerifyJob():
+    """
+    Everything a worker process needs to verify one file, without access to the backup's index or keys.
+    """
+    def __init__(self, path, file_id, source, key, size, digest):
+        # Path of the file in the backup, for the report
+        self.path = path
+        self.file_id = file_id
+        # Blob in the backup folder
+        self.source = source
+        # Unwrapped AES key, or None if the file isn't encrypted
+        self.key = key
+        self.size = size
+        # SHA-1 digest from the manifest, or None if there isn't one
+        self.digest = digest
+
+def _verify_file(job):
+    """
+    Reads the blob of one file from start to end. Runs in a worker process,
+    returns (job, error message or None, whether the digest was checked).
+    """
+    try:
+        try:
+            blob_size = os.path.getsize(job.source)
+        except FileNotFoundError:
+            if job.size == 0:
+                # Empty files don't always get a blob
+                return (job, None, False)
+            return (job, "missing from backup", False)
+        if job.size == 0 and blob_size == 0:
+            return (job, None, False)
+        if job.key is not None and (blob_size == 0 or blob_size % AES.block_size != 0):
+            return (job, f"encrypted blob is {blob_size} bytes, not a multiple of {AES.block_size}", False)
+        if job.key is None and blob_size != job.size:
+            return (job, f"size is {blob_size} bytes, expected {job.size}", False)
+        # The digest is of the contents in some backups and of the blob as stored in others, so both are tried
+        contents_hash = hashlib.sha1() if job.digest is not None else None
+        blob_hash = hashlib.sha1() if job.digest is not None and job.key is not None else None
+        cipher = AES.new(job.key, AES.MODE_CBC, b"\x00" * AES.block_size) if job.key is not None else None
+        # The last decrypted block, held back until the end of the blob so its padding can be removed
+        last_block = b""
+        read = 0
+        with open(job.source, 'rb', buffering=0) as infile:
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(infile.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            while True:
+                chunk = infile.read(VERIFY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                read += len(chunk)
+                if cipher is None:
+                    if contents_hash is not None:
+                        contents_hash.update(chunk)
+                    continue
+                if blob_hash is not None:
+                    blob_hash.update(chunk)
+                data = cipher.decrypt(chunk)
+                if contents_hash is not None:
+                    contents_hash.update(last_block)
+                    contents_hash.update(memoryview(data)[:-AES.block_size])
+                last_block = data[-AES.block_size:]
+        if read != blob_size:
+            return (job, f"blob changed while it was read ({read} bytes, expected {blob_size})", False)
+        if cipher is not None:
+            padding = google_iphone_dataprotection.paddingLength(last_block, AES.block_size)
+            if padding is None:
+                return (job, "invalid padding, the blob is damaged or the key is wrong", False)
+            if read - padding != job.size:
+                return (job, f"size is {read - padding} bytes after removing padding, expected {job.size}", False)
+            if contents_hash is not None:
+                contents_hash.update(last_block[:-padding])
+        if job.digest is None:
+            return (job, None, False)
+        if job.digest not in (contents_hash.digest(), blob_hash.digest() if blob_hash is not None else None):
+            return (job, f"digest is {contents_hash.hexdigest()}, expected {job.digest.hex()}", True)
+        return (job, None, True)
+    except (OSError, ValueError) as e:
+        # ValueError is raised by the cipher, i.e. for a key of the wrong length
+        return (job, str(e), False)
+
+def _verify_jobs(jobs, workers):
+    """
+    Yields the results of _verify_file for each of jobs, in no particular order.
+    Only a few batches of jobs are handed out at a time, so memory use doesn't grow with the number of files.
+    """
+    batches = iter(lambda: list(itertools.islice(jobs, JOBS_PER_TASK)), [])
+    if workers <= 1:
+        for batch in batches:
+            yield from map(_verify_file, batch)
+        return
+    # Worker processes are started fresh rather than forked, as forking a process with threads isn't safe
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        pending = set()
+        for batch in batches:
+            pending.add(executor.submit(_verify_batch, batch))
+            while len(pending) >= workers * TASKS_PER_WORKER:
+                (done, pending) = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result()
+        for future in pending:
+            yield from future.result()
+
+def _verify_batch(batch):
+    return [_verify_file(job) for job in batch]
+
+def _list_jobs(fs, base, result):
+    for (entry_path, file_info) in fs.walk(base):
+        if not file_info.is_file():
+            continue
+        digest = file_info.properties.get("Digest")
+        if not isinstance(digest, bytes) or len(digest) != DIGEST_SIZE:
+            digest = None
+        try:
+            key = fs.get_file_key(file_info)
+        except ValueError as e:
+            result["errors"].append({"path": entry_path, "file_id": file_info.hash, "error": str(e)})
+            continue
+        except Exception as e:
+            result["errors"].append({"path": entry_path, "file_id": file_info.hash, "error": f"can't unwrap key: {e}"})
+            continue
+        yield VerifyJob(entry_path, file_info.hash, file_info.get_path(), key, file_info.properties["Size"], digest)
+
+def verify(fs, path="/", workers=None):
+    """
+    Checks every file at or below path (as it appears in the mount) against the manifest:
+    its blob exists, has the expected size (after removing the padding, for encrypted files),
+    decrypts with valid padding and matches the file's digest where the manifest has one.
+
+    Blobs are read from start to end by a pool of worker processes, in large sequential pieces,
+    so memory use stays the same no matter how large the files or the backup are.
+
+    Returns a dict with the number of files checked, bytes read, digests checked,
+    seconds taken and a list of errors, each a dict with the path, fileID and error message.
+    """
+    workers = workers or os.cpu_count() or 1
+    base = posixpath.normpath("/" + path.strip("/"))
+    result = {"files": 0, "bytes": 0, "digests": 0, "errors": [], "seconds": 0}
+    start = time.monotonic()
+    last_progress = start
+    print(f"Verifying files in {base}...")
+    for (job, error, digest_checked) in _verify_jobs(_list_jobs(fs, base, result), workers):
+        result["files"] += 1
+        result["digests"] += digest_checked
+        if error is not None:
+            result["errors"].append({"path": job.path, "file_id": job.file_id, "error": error})
+        else:
+            result["bytes"] += job.size
+        if time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+            last_progress = time.monotonic()
+            elapsed = last_progress - start
+            print(f"{result['files']} files, {result['bytes'] / 2**20:.1f}MiB ({result['bytes'] / 2**20 / elapsed:.1f}MiB/s), "
+                  f"{len(result['errors'])} errors")
+    result["seconds"] = round(time.monotonic() - start, 3)
+    return result
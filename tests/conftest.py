@@ -0,0 +1,47 @@
+from generate_backup import generate_backup, _mbfile
+import hashlib
+import sqlite3
+import pytest
+import os
+
+PASSWORD = "test password"
+
+def _generate(tmp_path_factory, name, password):
+    path = str(tmp_path_factory.mktemp(name))
+    # Files of up to 1MiB, so reads span several cache blocks and readahead chunks
+    contents = generate_backup(path, files=40, domains=3, depth=2, median_size=64 * 1024, max_size=1024 * 1024,
+                               password=password, seed=1, iterations=10)
+    return (path, contents)
+
+@pytest.fixture(scope="session")
+def plain_backup(tmp_path_factory):
+    """
+    (folder, contents) of a small unencrypted backup, contents being a dict of (domain, relativePath) -> bytes.
+    Shared by every test, so it mustn't be changed.
+    """
+    return _generate(tmp_path_factory, "plain", None)
+
+@pytest.fixture(scope="session")
+def encrypted_backup(tmp_path_factory):
+    """
+    Same as plain_backup, but encrypted with PASSWORD.
+    """
+    return _generate(tmp_path_factory, "encrypted", PASSWORD)
+
+def add_entry(backup, domain, relative_path, flags, mode, data=None, target=None):
+    """
+    Adds an entry to the manifest of an unencrypted backup, with a blob holding data for files.
+    For making up entries a real backup wouldn't have.
+    """
+    file_id = hashlib.sha1(f"{domain}-{relative_path}".encode("utf-8")).hexdigest()
+    size = 0
+    if data is not None:
+        size = len(data)
+        os.makedirs(os.path.join(backup, file_id[:2]), exist_ok=True)
+        with open(os.path.join(backup, file_id[:2], file_id), "wb") as outfile:
+            outfile.write(data)
+    connection = sqlite3.connect(os.path.join(backup, "Manifest.db"))
+    connection.execute("INSERT INTO Files VALUES (?, ?, ?, ?, ?)",
+                       (file_id, domain, relative_path, flags, _mbfile(relative_path, mode, size, 1600000000, 1, target=target)))
+    connection.commit()
+    connection.close()
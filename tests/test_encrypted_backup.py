@@ -0,0 +1,130 @@
+from conftest import PASSWORD
+import tarfile
+import errno
+import io
+import os
+import pytest
+
+try:
+    from mount_ios_backup.encrypted_backup import EncryptedBackupFS, CACHE_BLOCK_SIZE, DEFAULT_CACHE_SIZE
+    from mount_ios_backup.readahead import SEQUENTIAL_THRESHOLD
+    from mount_ios_backup.file_info import mount_path
+    from mount_ios_backup.extract import extract
+    from mount_ios_backup.export import export
+    from mount_ios_backup.verify import verify
+    from fuse import FuseOSError
+except (ImportError, OSError) as e:
+    # fusepy raises OSError rather than ImportError when libfuse isn't installed
+    pytest.skip(f"needs fusepy and libfuse ({e})", allow_module_level=True)
+
+# Protection class the generated backups' files are in
+FILE_PROTECTION_CLASS = 3
+
+def _mount(backup, **kwargs):
+    fs = EncryptedBackupFS(backup, PASSWORD, **kwargs)
+    fs.init("/")
+    return fs
+
+def _largest_file(contents):
+    ((domain, relative_path), data) = max(contents.items(), key=lambda item: len(item[1]))
+    return (mount_path(domain, relative_path), data)
+
+def _read(fs, path, ranges):
+    """
+    Reads each (offset, length) of ranges in turn through one handle, like the kernel would.
+    """
+    fh = fs.open(path, os.O_RDONLY)
+    try:
+        return [fs.read(path, length, offset, fh) for (offset, length) in ranges]
+    finally:
+        fs.release(path, fh)
+
+def _break_class_key(fs):
+    # Replaces the class key the files' keys are wrapped with, so unwrapping them fails its integrity check
+    fs._keybag.classKeys[FILE_PROTECTION_CLASS][b"KEY"] = bytes(32)
+    fs._keybag._classCiphers.clear()
+
+def test_wrong_class_key_open(encrypted_backup):
+    (backup, contents) = encrypted_backup
+    fs = _mount(backup)
+    _break_class_key(fs)
+    (path, _) = _largest_file(contents)
+    with pytest.raises(FuseOSError) as e:
+        fs.open(path, os.O_RDONLY)
+    assert e.value.errno == errno.EIO
+    with pytest.raises(ValueError):
+        fs.get_file_key(fs._get_file_info(path))
+
+def test_wrong_class_key_extract(encrypted_backup, tmp_path):
+    (backup, contents) = encrypted_backup
+    fs = _mount(backup)
+    _break_class_key(fs)
+    (path, _) = _largest_file(contents)
+    result = extract(fs, path, str(tmp_path), workers=1)
+    assert result["files"] == 0
+    assert len(result["errors"]) == 1 and result["errors"][0].startswith(path)
+    # Nothing is written, rather than the ciphertext
+    assert os.listdir(tmp_path) == []
+
+def test_wrong_class_key_export(encrypted_backup):
+    (backup, contents) = encrypted_backup
+    fs = _mount(backup)
+    _break_class_key(fs)
+    (path, _) = _largest_file(contents)
+    output = io.BytesIO()
+    result = export(fs, [path], output)
+    assert len(result["errors"]) == 1 and result["errors"][0].startswith(path)
+    output.seek(0)
+    with tarfile.open(fileobj=output) as archive:
+        assert archive.getnames() == []
+
+def test_wrong_class_key_verify(encrypted_backup):
+    (backup, contents) = encrypted_backup
+    fs = _mount(backup)
+    _break_class_key(fs)
+    result = verify(fs, workers=1)
+    assert result["files"] == 0
+    assert len(result["errors"]) == len(contents)
+
+@pytest.mark.parametrize("cache_size", [0, DEFAULT_CACHE_SIZE])
+def test_read_whole_file(encrypted_backup, cache_size):
+    (backup, contents) = encrypted_backup
+    fs = _mount(backup, readahead_size=0, cache_size=cache_size)
+    for ((domain, relative_path), data) in contents.items():
+        # Asking for more than there is, as the size the kernel asks for is rounded up
+        assert _read(fs, mount_path(domain, relative_path), [(0, len(data) + 4096)]) == [data]
+
+@pytest.mark.parametrize("cache_size", [0, DEFAULT_CACHE_SIZE])
+def test_read_unaligned_range(encrypted_backup, cache_size):
+    (backup, contents) = encrypted_backup
+    fs = _mount(backup, readahead_size=0, cache_size=cache_size)
+    (path, data) = _largest_file(contents)
+    # Starting and ending inside AES blocks and cache blocks, across cache block boundaries, at the end of the file and past it
+    ranges = [(CACHE_BLOCK_SIZE - 5, 23), (3 * CACHE_BLOCK_SIZE + 7, 2 * CACHE_BLOCK_SIZE + 9), (17, 1),
+              (len(data) - 21, 100), (len(data) + 1, 10)]
+    expected = [data[offset:offset + length] for (offset, length) in ranges]
+    assert _read(fs, path, ranges) == expected
+    if cache_size > 0:
+        # Read again, from the decrypted blocks in the cache
+        hits = fs._block_cache.hits
+        assert _read(fs, path, ranges) == expected
+        assert fs._block_cache.hits > hits
+
+@pytest.mark.parametrize("cache_size", [0, DEFAULT_CACHE_SIZE])
+def test_read_readahead(encrypted_backup, monkeypatch, cache_size):
+    (backup, contents) = encrypted_backup
+    fs = _mount(backup, readahead_size=1024 * 1024, cache_size=cache_size)
+    (path, data) = _largest_file(contents)
+    decrypted_ranges = []
+    decrypt_range = fs._decrypt_range
+    def counting_decrypt_range(open_file, fh, start, end):
+        decrypted_ranges.append((start, end))
+        return decrypt_range(open_file, fh, start, end)
+    monkeypatch.setattr(fs, "_decrypt_range", counting_decrypt_range)
+    # Sequential reads of a size that isn't a multiple of the AES block size
+    length = 100000
+    ranges = [(offset, length) for offset in range(0, len(data), length)]
+    assert b"".join(_read(fs, path, ranges)) == data
+    # Only the reads before the pattern is known aren't served from the data read ahead
+    assert len(decrypted_ranges) > 0
+    assert all(start < SEQUENTIAL_THRESHOLD * length for (start, _) in decrypted_ranges)
@@ -0,0 +1,75 @@
+from conftest import add_entry
+import tarfile
+import zipfile
+import shutil
+import io
+import pytest
+
+try:
+    from mount_ios_backup.standard_backup import BackupFS
+    from mount_ios_backup.file_info import mount_path
+    from mount_ios_backup.export import export
+except (ImportError, OSError) as e:
+    # fusepy raises OSError rather than ImportError when libfuse isn't installed
+    pytest.skip(f"needs fusepy and libfuse ({e})", allow_module_level=True)
+
+def _mount(backup):
+    fs = BackupFS(backup)
+    fs.init("/")
+    return fs
+
+def _copy(plain_backup, tmp_path):
+    (backup, contents) = plain_backup
+    return (shutil.copytree(backup, str(tmp_path / "backup")), contents)
+
+def _names(output, format):
+    output.seek(0)
+    if format == "tar":
+        with tarfile.open(fileobj=output) as archive:
+            return archive.getnames()
+    with zipfile.ZipFile(output) as archive:
+        return [name.rstrip("/") for name in archive.namelist()]
+
+@pytest.mark.parametrize("format", ["tar", "zip"])
+def test_export(plain_backup, format):
+    (backup, contents) = plain_backup
+    output = io.BytesIO()
+    result = export(_mount(backup), ["/"], output, format)
+    assert result["errors"] == []
+    output.seek(0)
+    if format == "tar":
+        with tarfile.open(fileobj=output) as archive:
+            for ((domain, relative_path), data) in contents.items():
+                assert archive.extractfile(mount_path(domain, relative_path).lstrip("/")).read() == data
+    else:
+        with zipfile.ZipFile(output) as archive:
+            for ((domain, relative_path), data) in contents.items():
+                assert archive.read(mount_path(domain, relative_path).lstrip("/")) == data
+
+@pytest.mark.parametrize("format", ["tar", "zip"])
+def test_dot_dot_paths(plain_backup, tmp_path, format):
+    (backup, _) = _copy(plain_backup, tmp_path)
+    add_entry(backup, "HomeDomain", "..", 2, 0o40755)
+    add_entry(backup, "HomeDomain", "../escaped", 1, 0o100644, data=b"outside")
+    output = io.BytesIO()
+    result = export(_mount(backup), ["/HomeDomain"], output, format)
+    assert sorted(error.split(":")[0] for error in result["errors"]) == ["/HomeDomain/..", "/HomeDomain/../escaped"]
+    assert not any(".." in name.split("/") for name in _names(output, format))
+
+def test_symlink_with_entries_below(plain_backup, tmp_path):
+    (backup, _) = _copy(plain_backup, tmp_path)
+    # Only differ in case, so on a case-insensitive filesystem the file would be unpacked through the symlink
+    add_entry(backup, "HomeDomain", "Link", 4, 0o120755, target="/tmp")
+    add_entry(backup, "HomeDomain", "link", 2, 0o40755)
+    add_entry(backup, "HomeDomain", "link/file", 1, 0o100644, data=b"data")
+    add_entry(backup, "HomeDomain", "other", 4, 0o120755, target="/tmp")
+    output = io.BytesIO()
+    result = export(_mount(backup), ["/HomeDomain"], output)
+    assert result["errors"] == ["/HomeDomain/Link: symlink with other entries below it, left out"]
+    names = _names(output, "tar")
+    assert "HomeDomain/link/file" in names and "HomeDomain/other" in names and "HomeDomain/Link" not in names
+    # Symlinks come after everything else
+    output.seek(0)
+    with tarfile.open(fileobj=output) as archive:
+        types = [member.issym() for member in archive.getmembers()]
+    assert types == sorted(types)
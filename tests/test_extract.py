@@ -0,0 +1,59 @@
+from conftest import add_entry
+import shutil
+import os
+import pytest
+
+try:
+    from mount_ios_backup.standard_backup import BackupFS
+    from mount_ios_backup.extract import extract
+    from mount_ios_backup.file_info import mount_path
+except (ImportError, OSError) as e:
+    # fusepy raises OSError rather than ImportError when libfuse isn't installed
+    pytest.skip(f"needs fusepy and libfuse ({e})", allow_module_level=True)
+
+def _mount(backup):
+    fs = BackupFS(backup)
+    fs.init("/")
+    return fs
+
+def _copy(plain_backup, tmp_path):
+    (backup, contents) = plain_backup
+    return (shutil.copytree(backup, str(tmp_path / "backup")), contents)
+
+def test_extract(plain_backup, tmp_path):
+    (backup, contents) = plain_backup
+    destination = str(tmp_path / "out")
+    result = extract(_mount(backup), "/", destination, workers=1, full_paths=True)
+    assert result["errors"] == []
+    for ((domain, relative_path), data) in contents.items():
+        with open(os.path.join(destination, mount_path(domain, relative_path).lstrip("/")), "rb") as infile:
+            assert infile.read() == data
+
+@pytest.mark.parametrize("full_paths", [False, True])
+def test_dot_dot_paths(plain_backup, tmp_path, full_paths):
+    (backup, _) = _copy(plain_backup, tmp_path)
+    # Folders named .. and a file below them, which would end up two levels above HomeDomain
+    add_entry(backup, "HomeDomain", "..", 2, 0o40755)
+    add_entry(backup, "HomeDomain", "../..", 2, 0o40755)
+    add_entry(backup, "HomeDomain", "../../escaped", 1, 0o100644, data=b"outside")
+    add_entry(backup, "HomeDomain", "../escaped", 1, 0o100644, data=b"outside")
+    destination = tmp_path / "a" / "b" / "out"
+    result = extract(_mount(backup), "/HomeDomain" if not full_paths else "/", str(destination), workers=1, full_paths=full_paths)
+    assert sorted(error.split(":")[0] for error in result["errors"]) == \
+        ["/HomeDomain/..", "/HomeDomain/../..", "/HomeDomain/../../escaped", "/HomeDomain/../escaped"]
+    assert not any(path.name == "escaped" for path in tmp_path.rglob("*"))
+
+def test_existing_symlink_not_followed(plain_backup, tmp_path):
+    (backup, contents) = _copy(plain_backup, tmp_path)
+    (domain, relative_path) = next(key for key in sorted(contents) if "/" in key[1])
+    folder = mount_path(domain, relative_path.rpartition("/")[0])
+    # As left by an earlier extraction of a backup with a symlink where this one has a folder
+    destination = tmp_path / "out"
+    outside = tmp_path / "outside"
+    outside.mkdir()
+    link = destination / folder.lstrip("/")
+    link.parent.mkdir(parents=True)
+    os.symlink(str(outside), str(link))
+    result = extract(_mount(backup), "/", str(destination), workers=1, full_paths=True)
+    assert any(error.startswith(f"{folder}:") and "symlink" in error for error in result["errors"])
+    assert list(outside.iterdir()) == []
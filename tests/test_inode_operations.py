@@ -0,0 +1,224 @@
+import posixpath
+import threading
+import stat
+import errno
+import pytest
+
+trio = pytest.importorskip("trio")
+try:
+    from mount_ios_backup.inode_operations import InodeOperations
+    from mount_ios_backup.file_info import ROOT_INODE
+    from fuse import FuseOSError
+except (ImportError, OSError) as e:
+    # fusepy raises OSError rather than ImportError when libfuse isn't installed
+    pytest.skip(f"needs fusepy and libfuse ({e})", allow_module_level=True)
+
+def _attrs(inode, mode):
+    return {"st_ino": inode, "st_mode": mode, "st_size": 0}
+
+class _FakeFS():
+    """
+    Answers the operations InodeOperations calls from a dict of path -> attributes.
+    """
+    def __init__(self, entries, unlisted_attrs=()):
+        self.entries = dict(entries)
+        # Listed by readdir without their attributes, so InodeOperations has to look them up
+        self.unlisted_attrs = set(unlisted_attrs)
+        self.calls = []
+        # Whether lookups should run on threads, see BackupFS.lookups_may_block
+        self.blocking = False
+        # Operation -> threads it was called on
+        self.threads = {}
+
+    def __call__(self, op, *args):
+        self.calls.append((op,) + args)
+        self.threads.setdefault(op, set()).add(threading.get_ident())
+        return getattr(self, op)(*args)
+
+    def lookups_may_block(self):
+        return self.blocking
+
+    def getattr(self, path, fh=None):
+        if path not in self.entries:
+            raise FuseOSError(errno.ENOENT)
+        return self.entries[path]
+
+    def readdir(self, path, fh):
+        yield "."
+        yield ".."
+        for child in sorted(self.entries):
+            if child != "/" and posixpath.dirname(child) == path:
+                name = posixpath.basename(child)
+                yield name if child in self.unlisted_attrs else (name, self.entries[child], 0)
+
+def _tree():
+    return {
+        "/": _attrs(ROOT_INODE, stat.S_IFDIR | 0o755),
+        "/HomeDomain": _attrs(10, stat.S_IFDIR | 0o755),
+        "/HomeDomain/a": _attrs(11, stat.S_IFREG | 0o644),
+        "/HomeDomain/b": _attrs(12, stat.S_IFREG | 0o644),
+        "/HomeDomain/c": _attrs(13, stat.S_IFREG | 0o644),
+        "/HomeDomain/d": _attrs(14, stat.S_IFREG | 0o644),
+    }
+
+def _run(function, *args):
+    return trio.run(function, *args)
+
+def _read_all(ops, fh, start=0, limit=None):
+    """
+    Calls readdir like the kernel does, with a reply buffer that's full after limit entries.
+    Returns the accepted (name, attrs, next offset) tuples.
+    """
+    accepted = []
+    def reply(name, attrs, next_offset):
+        if limit is not None and len(accepted) >= limit:
+            return False
+        accepted.append((name, attrs, next_offset))
+        return True
+    _run(ops.readdir, fh, start, reply)
+    return accepted
+
+def test_lookup_counts_and_forget():
+    ops = InodeOperations(_FakeFS(_tree()))
+    home = _run(ops.lookup, ROOT_INODE, "HomeDomain")
+    assert home["st_ino"] == 10
+    for _ in range(3):
+        assert _run(ops.lookup, 10, "a")["st_ino"] == 11
+    assert _run(ops.getattr, 11)["st_ino"] == 11
+    # The path is kept until every lookup is forgotten
+    ops.forget([(11, 2)])
+    assert _run(ops.getattr, 11)["st_ino"] == 11
+    ops.forget([(11, 1)])
+    with pytest.raises(FuseOSError) as e:
+        _run(ops.getattr, 11)
+    assert e.value.errno == errno.ESTALE
+    # Forgetting more lookups than are held, or an unknown inode, is harmless
+    ops.forget([(11, 1), (99, 1)])
+    # The same inode can be looked up again
+    assert _run(ops.lookup, 10, "a")["st_ino"] == 11
+    assert _run(ops.getattr, 11)["st_ino"] == 11
+
+def test_forget_root():
+    ops = InodeOperations(_FakeFS(_tree()))
+    _run(ops.lookup, ROOT_INODE, ".")
+    ops.forget([(ROOT_INODE, 1)])
+    # The root is never forgotten, as the kernel never looks it up
+    assert _run(ops.getattr, ROOT_INODE)["st_ino"] == ROOT_INODE
+
+def test_lookup_dot_entries():
+    ops = InodeOperations(_FakeFS(_tree()))
+    _run(ops.lookup, ROOT_INODE, "HomeDomain")
+    assert _run(ops.lookup, 10, ".")["st_ino"] == 10
+    assert _run(ops.lookup, 10, "..")["st_ino"] == ROOT_INODE
+
+def test_lookup_missing():
+    ops = InodeOperations(_FakeFS(_tree()))
+    with pytest.raises(FuseOSError) as e:
+        _run(ops.lookup, ROOT_INODE, "missing")
+    assert e.value.errno == errno.ENOENT
+    assert ops.known_entries() == []
+
+def test_readdir_offsets():
+    ops = InodeOperations(_FakeFS(_tree()))
+    _run(ops.lookup, ROOT_INODE, "HomeDomain")
+    fh = _run(ops.opendir, 10)
+    entries = _read_all(ops, fh)
+    assert [(name, next_offset) for (name, _, next_offset) in entries] == [("a", 1), ("b", 2), ("c", 3), ("d", 4)]
+    # Continuing from any returned offset gives the entries after it
+    assert [name for (name, _, _) in _read_all(ops, fh, 2)] == ["c", "d"]
+    assert _read_all(ops, fh, 4) == []
+    ops.releasedir(fh)
+
+def test_readdir_full_reply_buffer():
+    fs = _FakeFS(_tree())
+    ops = InodeOperations(fs)
+    _run(ops.lookup, ROOT_INODE, "HomeDomain")
+    fh = _run(ops.opendir, 10)
+    names = []
+    offset = 0
+    while True:
+        entries = _read_all(ops, fh, offset, limit=3)
+        if len(entries) == 0:
+            break
+        names += [name for (name, _, _) in entries]
+        offset = entries[-1][2]
+    # The entry that didn't fit is sent again with the next call, not skipped
+    assert names == ["a", "b", "c", "d"]
+    # Only accepted entries count as lookups: each one was accepted once
+    for inode in (11, 12, 13, 14):
+        ops.forget([(inode, 1)])
+        with pytest.raises(FuseOSError):
+            _run(ops.getattr, inode)
+
+def test_readdir_rejected_entry_is_not_counted():
+    ops = InodeOperations(_FakeFS(_tree()))
+    _run(ops.lookup, ROOT_INODE, "HomeDomain")
+    fh = _run(ops.opendir, 10)
+    assert _read_all(ops, fh, limit=0) == []
+    # The rejected entry wasn't remembered, so its inode is unknown
+    with pytest.raises(FuseOSError) as e:
+        _run(ops.getattr, 11)
+    assert e.value.errno == errno.ESTALE
+
+def test_readdir_looks_up_missing_attrs():
+    tree = _tree()
+    # A listed entry that can't be looked up, i.e. a domain without a root entry
+    fs = _FakeFS(tree, unlisted_attrs=("/HomeDomain/b", "/HomeDomain/ghost"))
+    fs.entries["/HomeDomain/ghost"] = None
+    ops = InodeOperations(fs)
+    _run(ops.lookup, ROOT_INODE, "HomeDomain")
+    fh = _run(ops.opendir, 10)
+    del fs.entries["/HomeDomain/ghost"]
+    entries = _read_all(ops, fh)
+    assert [(name, attrs["st_ino"]) for (name, attrs, _) in entries] == [("a", 11), ("b", 12), ("c", 13), ("d", 14)]
+    assert ("getattr", "/HomeDomain/b") in fs.calls
+
+def test_opendir_snapshot():
+    # Entries are listed when the directory is opened, so changes don't shift the offsets of a listing in progress
+    fs = _FakeFS(_tree())
+    ops = InodeOperations(fs)
+    _run(ops.lookup, ROOT_INODE, "HomeDomain")
+    fh = _run(ops.opendir, 10)
+    first = _read_all(ops, fh, limit=2)
+    del fs.entries["/HomeDomain/a"]
+    fs.entries["/HomeDomain/0"] = _attrs(15, stat.S_IFREG | 0o644)
+    rest = _read_all(ops, fh, first[-1][2])
+    assert [name for (name, _, _) in first + rest] == ["a", "b", "c", "d"]
+
+def test_known_entries_after_refresh():
+    fs = _FakeFS(_tree())
+    ops = InodeOperations(fs)
+    _run(ops.lookup, ROOT_INODE, "HomeDomain")
+    _run(ops.lookup, 10, "a")
+    _run(ops.lookup, 10, "b")
+    assert sorted(ops.known_entries()) == [(10, ROOT_INODE, "HomeDomain"), (11, 10, "a"), (12, 10, "b")]
+
+    # A refresh changes a, removes b and adds e
+    fs.entries["/HomeDomain/a"] = dict(fs.entries["/HomeDomain/a"], st_size=100)
+    del fs.entries["/HomeDomain/b"]
+    fs.entries["/HomeDomain/e"] = _attrs(16, stat.S_IFREG | 0o644)
+    changed = ["/HomeDomain/a", "/HomeDomain/b", "/HomeDomain/e", "/OtherDomain/f"]
+    # Removed entries keep their inode until the kernel forgets them, so it can be invalidated.
+    # New entries have none, but their parent's can be, so a cached negative lookup is dropped.
+    assert ops.known_entries(changed) == [(11, 10, "a"), (12, 10, "b"), (None, 10, "e"), (None, None, "f")]
+    assert _run(ops.getattr, 11)["st_size"] == 100
+    with pytest.raises(FuseOSError) as e:
+        _run(ops.getattr, 12)
+    assert e.value.errno == errno.ENOENT
+    assert _run(ops.lookup, 10, "e")["st_ino"] == 16
+
+    ops.forget([(12, 1)])
+    assert ops.known_entries(["/HomeDomain/b"]) == [(None, 10, "b")]
+    assert (12, 10, "b") not in ops.known_entries()
+
+@pytest.mark.parametrize("blocking", [False, True])
+def test_blocking_lookups_on_threads(blocking):
+    fs = _FakeFS(_tree())
+    fs.blocking = blocking
+    ops = InodeOperations(fs)
+    _run(ops.lookup, ROOT_INODE, "HomeDomain")
+    fh = _run(ops.opendir, 10)
+    _read_all(ops, fh)
+    on_event_loop = fs.threads["getattr"] | fs.threads["readdir"] == {threading.get_ident()}
+    # Lookups that may wait on the disk mustn't hold up the event loop
+    assert on_event_loop != blocking
@@ -0,0 +1,108 @@
+from mount_ios_backup.mbfile import MBFileDecoder, InvalidMBFile, decode_file_properties, decode_files, _decode_with_biplist
+import hashlib
+import biplist
+import pytest
+
+def _mbfile(properties, encryption_key=None, target=None, relative_path="Library/Preferences/test.plist", padding=0,
+            digest=None, mutable_digest=False):
+    """
+    Archives an MBFile the way NSKeyedArchiver does, with padding filler objects
+    before it so its UID and the object references need more than one byte.
+    """
+    objects = ["$null"] + [f"filler{i}" for i in range(padding)]
+    root = len(objects)
+    properties = dict(properties)
+    objects.append(properties)
+    properties["RelativePath"] = biplist.Uid(len(objects))
+    objects.append(relative_path)
+    if encryption_key is not None:
+        properties["EncryptionKey"] = biplist.Uid(len(objects))
+        objects.append({"NS.data": biplist.Data(encryption_key), "$class": biplist.Uid(len(objects) + 1)})
+        objects.append({"$classname": "NSMutableData", "$classes": ["NSMutableData", "NSData", "NSObject"]})
+    if target is not None:
+        properties["Target"] = biplist.Uid(len(objects))
+        objects.append(target)
+    if digest is not None:
+        properties["Digest"] = biplist.Uid(len(objects))
+        if mutable_digest:
+            objects.append({"NS.data": biplist.Data(digest), "$class": biplist.Uid(len(objects) + 1)})
+            objects.append({"$classname": "NSMutableData", "$classes": ["NSMutableData", "NSData", "NSObject"]})
+        else:
+            objects.append(biplist.Data(digest))
+    properties["$class"] = biplist.Uid(len(objects))
+    objects.append({"$classname": "MBFile", "$classes": ["MBFile", "NSObject"]})
+    return biplist.writePlistToString({"$version": 100000, "$archiver": "NSKeyedArchiver",
+                                       "$top": {"root": biplist.Uid(root)}, "$objects": objects})
+
+_BASE = {"Mode": 0o100644, "UserID": 501, "GroupID": 501, "Size": 1234, "LastModified": 1600000000,
+         "LastStatusChange": 1600000001, "Birth": 1599999999, "ProtectionClass": 3}
+
+def _check(blob, expected):
+    # The specialised parser must give the same result as biplist, without falling back to it
+    assert MBFileDecoder()._decode(blob) == expected
+    assert _decode_with_biplist(blob) == expected
+    assert decode_file_properties(blob) == expected
+
+@pytest.mark.parametrize("value", [0, 0x7F, 0xFF, 0x1234, 0xFFFF, 0x12345678, 0xFFFFFFFF, 1 << 40, (1 << 63) - 1])
+def test_int_sizes(value):
+    properties = dict(_BASE, Size=value)
+    _check(_mbfile(properties), properties)
+
+@pytest.mark.parametrize("value", [-1, -128, -40000, -(1 << 40), -(1 << 63)])
+def test_negative_ints(value):
+    properties = dict(_BASE, LastModified=value, Birth=value)
+    _check(_mbfile(properties), properties)
+
+def test_missing_properties():
+    properties = {"Mode": 0o40755, "Size": 0}
+    _check(_mbfile(properties), properties)
+
+@pytest.mark.parametrize("padding", [0, 300])
+def test_uids(padding):
+    # 1 and 2 byte UIDs and object references
+    properties = dict(_BASE)
+    _check(_mbfile(properties, encryption_key=bytes(range(40)), target="../target", padding=padding),
+           dict(properties, EncryptionKey=bytes(range(40)), Target="../target"))
+
+def test_encryption_key():
+    key = b"\x03\x00\x00\x00" + bytes(range(40))
+    _check(_mbfile(_BASE, encryption_key=key), dict(_BASE, EncryptionKey=key))
+
+@pytest.mark.parametrize("mutable", [False, True])
+def test_digest(mutable):
+    # Archived as NSData (plain data) or NSMutableData (a dict around it)
+    digest = hashlib.sha1(b"contents").digest()
+    _check(_mbfile(_BASE, encryption_key=bytes(40), digest=digest, mutable_digest=mutable),
+           dict(_BASE, EncryptionKey=bytes(40), Digest=digest))
+
+@pytest.mark.parametrize("target", ["relative/target", "/private/var/mobile/Library", "Ünïcödé/文件", "emoji 📷", "x" * 100])
+def test_targets(target):
+    # Non-ASCII strings are stored as UTF-16, long ones with their length in a separate integer
+    _check(_mbfile(_BASE, target=target), dict(_BASE, Target=target))
+
+def test_unicode_relative_path():
+    _check(_mbfile(_BASE, relative_path="Documents/Ünïcödé 文件.txt"), _BASE)
+
+def test_decode_files():
+    blobs = [_mbfile(dict(_BASE, Size=size)) for size in range(20)]
+    assert decode_files(blobs) == [dict(_BASE, Size=size) for size in range(20)]
+
+@pytest.mark.parametrize("length", [0, 1, 8, 40, -33, -32, -1])
+def test_truncated(length):
+    blob = _mbfile(_BASE, encryption_key=bytes(range(40)), target="target")
+    with pytest.raises(InvalidMBFile):
+        MBFileDecoder().decode(blob[:length])
+
+@pytest.mark.parametrize("blob", [None, "bplist00", 42, bytearray(b"bplist00"), b"", b"garbage", b"bplist00" + bytes(100)])
+def test_invalid(blob):
+    with pytest.raises(InvalidMBFile):
+        decode_file_properties(blob)
+
+def test_not_an_mbfile():
+    # A valid plist, but not an archive
+    with pytest.raises(InvalidMBFile):
+        decode_file_properties(biplist.writePlistToString({"Size": 1}))
+
+def test_invalid_in_batch():
+    with pytest.raises(InvalidMBFile):
+        decode_files([_mbfile(_BASE), None])
@@ -0,0 +1,53 @@
+import errno
+import os
+import pytest
+
+pyfuse3 = pytest.importorskip("pyfuse3")
+trio = pytest.importorskip("trio")
+try:
+    from mount_ios_backup.pyfuse3_backend import Pyfuse3Operations
+    from mount_ios_backup.file_info import ROOT_INODE
+    from fuse import FuseOSError
+except (ImportError, OSError) as e:
+    # fusepy raises OSError rather than ImportError when libfuse isn't installed
+    pytest.skip(f"needs fusepy and libfuse ({e})", allow_module_level=True)
+
+class _FailingFS():
+    """
+    Raises error from every operation but open.
+    """
+    def __init__(self, error):
+        self.error = error
+
+    def __call__(self, op, *args):
+        if op == "open":
+            return 3
+        raise self.error
+
+    def add_refresh_listener(self, listener):
+        pass
+
+    def lookups_may_block(self):
+        return False
+
+    def is_direct_io(self, path):
+        return False
+
+@pytest.mark.parametrize(("error", "expected"), [
+    (FuseOSError(errno.ENOENT), errno.ENOENT),
+    (OSError(errno.EACCES, "denied"), errno.EACCES),
+    # As raised when decrypting a damaged blob
+    (Exception("Invalid CBC padding"), errno.EIO),
+    (ValueError("Incorrect AES key length (5 bytes)"), errno.EIO),
+])
+def test_errors(error, expected):
+    operations = Pyfuse3Operations(_FailingFS(error))
+
+    async def read():
+        file_info = await operations.open(ROOT_INODE, os.O_RDONLY, None)
+        return await operations.read(file_info.fh, 0, 4096)
+
+    for function in (lambda: operations.getattr(ROOT_INODE), read):
+        with pytest.raises(pyfuse3.FUSEError) as e:
+            trio.run(function)
+        assert e.value.errno == expected
@@ -0,0 +1,36 @@
+import sqlite3
+import shutil
+import os
+import biplist
+import pytest
+
+try:
+    from mount_ios_backup.mount_ios_backup import query_main
+    from mount_ios_backup.file_info import mount_path
+except (ImportError, OSError) as e:
+    # fusepy raises OSError rather than ImportError when libfuse isn't installed
+    pytest.skip(f"needs fusepy and libfuse ({e})", allow_module_level=True)
+
+def _remove_properties(backup, domain, relative_path, keys):
+    """
+    Removes properties from an entry in the manifest of an unencrypted backup.
+    """
+    connection = sqlite3.connect(os.path.join(backup, "Manifest.db"))
+    (file_id, blob) = connection.execute("SELECT fileID, file FROM Files WHERE domain = ? AND relativePath = ?",
+                                         (domain, relative_path)).fetchone()
+    archive = biplist.readPlistFromString(blob)
+    properties = archive["$objects"][archive["$top"]["root"].integer]
+    for key in keys:
+        del properties[key]
+    connection.execute("UPDATE Files SET file = ? WHERE fileID = ?", (biplist.writePlistToString(archive), file_id))
+    connection.commit()
+    connection.close()
+
+def test_long_listing_missing_properties(plain_backup, tmp_path, capsys):
+    (backup, contents) = plain_backup
+    backup = shutil.copytree(backup, str(tmp_path / "backup"))
+    (domain, relative_path) = sorted(contents)[0]
+    _remove_properties(backup, domain, relative_path, ("LastModified", "Mode"))
+    query_main([backup, "--path", mount_path(domain, relative_path), "-l"])
+    (line,) = capsys.readouterr().out.splitlines()
+    assert line.split() == ["?---------", str(len(contents[(domain, relative_path)])), "-", mount_path(domain, relative_path)]
@@ -0,0 +1,52 @@
+from mount_ios_backup.readahead import ReadAhead, CHUNK_SIZE, SEQUENTIAL_THRESHOLD
+from concurrent.futures import ThreadPoolExecutor
+from Crypto.Cipher import AES
+import random
+import os
+import pytest
+
+WINDOW_CHUNKS = 8
+KEY = bytes(range(32))
+
+@pytest.fixture
+def blob(tmp_path):
+    """
+    (file descriptor, contents) of an encrypted blob of 40.5 chunks.
+    """
+    size = 40 * CHUNK_SIZE + CHUNK_SIZE // 2
+    data = random.Random(0).getrandbits(8 * size).to_bytes(size, "little")
+    padding = AES.block_size - len(data) % AES.block_size
+    path = tmp_path / "blob"
+    path.write_bytes(AES.new(KEY, AES.MODE_CBC, b"\x00" * AES.block_size).encrypt(data + bytes([padding]) * padding))
+    fh = os.open(str(path), os.O_RDONLY)
+    yield (fh, data)
+    os.close(fh)
+
+def test_sequential_read(blob):
+    (fh, data) = blob
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        readahead = ReadAhead(executor, fh, KEY, os.fstat(fh).st_size, WINDOW_CHUNKS * CHUNK_SIZE)
+        length = 300 * 1024
+        results = [readahead.read(offset, length) for offset in range(0, len(data), length)]
+        readahead.close()
+    # The first reads aren't served until the pattern is known, the rest all are
+    assert results[:SEQUENTIAL_THRESHOLD] == [None] * SEQUENTIAL_THRESHOLD
+    assert None not in results[SEQUENTIAL_THRESHOLD:]
+    assert b"".join(results[SEQUENTIAL_THRESHOLD:]) == data[SEQUENTIAL_THRESHOLD * length:]
+
+def test_buffer_bounded_after_seeking_backwards(blob):
+    (fh, data) = blob
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        readahead = ReadAhead(executor, fh, KEY, os.fstat(fh).st_size, WINDOW_CHUNKS * CHUNK_SIZE)
+        largest = 0
+        # Sequential runs that each start further back than the previous one's window
+        for start_chunk in (30, 20, 10, 0):
+            offset = start_chunk * CHUNK_SIZE
+            for _ in range(3 * SEQUENTIAL_THRESHOLD):
+                result = readahead.read(offset, 128 * 1024)
+                assert result is None or result == data[offset:offset + 128 * 1024]
+                offset += 128 * 1024
+                largest = max(largest, len(readahead._chunks))
+        readahead.close()
+    # The chunks of one read (at most 2 here) and the window after it
+    assert largest <= WINDOW_CHUNKS + 2
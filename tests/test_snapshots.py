@@ -0,0 +1,49 @@
+import hashlib
+import sqlite3
+import shutil
+import os
+import biplist
+import pytest
+
+try:
+    from mount_ios_backup.standard_backup import BackupFS
+    from mount_ios_backup.file_info import mount_path
+    from mount_ios_backup.snapshots import diff
+except (ImportError, OSError) as e:
+    # fusepy raises OSError rather than ImportError when libfuse isn't installed
+    pytest.skip(f"needs fusepy and libfuse ({e})", allow_module_level=True)
+
+def _mount(backup):
+    fs = BackupFS(backup)
+    fs.init("/")
+    return fs
+
+def _rewrite_file(backup, domain, relative_path, data):
+    """
+    Replaces the contents of a file in an unencrypted backup and its Digest in the manifest,
+    leaving every other property (Size and LastModified included) as it was.
+    """
+    connection = sqlite3.connect(os.path.join(backup, "Manifest.db"))
+    (file_id, blob) = connection.execute("SELECT fileID, file FROM Files WHERE domain = ? AND relativePath = ?",
+                                         (domain, relative_path)).fetchone()
+    archive = biplist.readPlistFromString(blob)
+    objects = archive["$objects"]
+    properties = objects[archive["$top"]["root"].integer]
+    objects[properties["Digest"].integer] = biplist.Data(hashlib.sha1(data).digest())
+    connection.execute("UPDATE Files SET file = ? WHERE fileID = ?", (biplist.writePlistToString(archive), file_id))
+    connection.commit()
+    connection.close()
+    with open(os.path.join(backup, file_id[:2], file_id), "wb") as outfile:
+        outfile.write(data)
+
+def test_diff_unchanged(plain_backup):
+    (backup, _) = plain_backup
+    assert list(diff(_mount(backup), _mount(backup))) == []
+
+def test_diff_contents_only(plain_backup, tmp_path):
+    (backup, contents) = plain_backup
+    new_backup = shutil.copytree(backup, str(tmp_path / "new"))
+    ((domain, relative_path), data) = max(contents.items(), key=lambda item: len(item[1]))
+    # Same size and modification time, only the contents differ
+    _rewrite_file(new_backup, domain, relative_path, bytes(byte ^ 0xFF for byte in data[:16]) + data[16:])
+    assert list(diff(_mount(backup), _mount(new_backup))) == [("M", mount_path(domain, relative_path), ["contents"])]
@@ -0,0 +1,38 @@
+from mount_ios_backup import stats
+import json
+import pytest
+
+@pytest.fixture
+def fresh_stats(monkeypatch):
+    """
+    Gives each test its own Stats, disabled until it calls stats.enable.
+    """
+    monkeypatch.setattr(stats, "_stats", stats.Stats())
+    monkeypatch.setattr(stats, "_enabled", False)
+    monkeypatch.setattr(stats, "_dump_path", None)
+
+class _NoLock():
+    def __enter__(self):
+        raise AssertionError("the lock was taken with stats disabled")
+
+    def __exit__(self, *exc_info):
+        pass
+
+def test_disabled(fresh_stats):
+    stats._stats._lock = _NoLock()
+    with stats.timer("read"):
+        pass
+    stats.add_time("read", 0.1)
+    stats.count("bytes_read", 100)
+    assert json.loads(stats.to_json()) == {"enabled": False}
+
+def test_dump_to_file(fresh_stats, tmp_path):
+    path = tmp_path / "stats.json"
+    stats.enable(str(path))
+    with stats.timer("read"):
+        pass
+    stats.count("bytes_read", 100)
+    stats.dump()
+    result = json.loads(path.read_text())
+    assert result["counters"] == {"bytes_read": 100}
+    assert result["latency"]["read"]["count"] == 1
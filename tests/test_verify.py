@@ -0,0 +1,51 @@
+from conftest import PASSWORD
+import hashlib
+import shutil
+import pytest
+
+try:
+    from mount_ios_backup.standard_backup import BackupFS
+    from mount_ios_backup.encrypted_backup import EncryptedBackupFS
+    from mount_ios_backup.file_info import mount_path
+    from mount_ios_backup.verify import verify
+except (ImportError, OSError) as e:
+    # fusepy raises OSError rather than ImportError when libfuse isn't installed
+    pytest.skip(f"needs fusepy and libfuse ({e})", allow_module_level=True)
+
+def _mount(backup, password=None, **kwargs):
+    fs = EncryptedBackupFS(backup, password, **kwargs) if password is not None else BackupFS(backup, **kwargs)
+    fs.init("/")
+    return fs
+
+@pytest.mark.parametrize("index", ["memory", "file"])
+def test_digests_decoded(plain_backup, tmp_path, index):
+    (backup, contents) = plain_backup
+    kwargs = {"index_dir": str(tmp_path)} if index == "file" else {}
+    # The second mount loads the index file the first one wrote
+    for _ in range(2 if index == "file" else 1):
+        fs = _mount(backup, **kwargs)
+        for ((domain, relative_path), data) in contents.items():
+            assert fs.get_entry(domain, relative_path).properties["Digest"] == hashlib.sha1(data).digest()
+
+@pytest.mark.parametrize("encrypted", [False, True])
+def test_verify(plain_backup, encrypted_backup, encrypted):
+    (backup, contents) = encrypted_backup if encrypted else plain_backup
+    result = verify(_mount(backup, PASSWORD if encrypted else None), workers=1)
+    assert result["errors"] == []
+    assert result["files"] == len(contents)
+    assert result["digests"] == len(contents)
+    assert result["bytes"] == sum(len(data) for data in contents.values())
+
+def test_verify_changed_contents(plain_backup, tmp_path):
+    (backup, contents) = plain_backup
+    backup = shutil.copytree(backup, str(tmp_path / "backup"))
+    fs = _mount(backup)
+    ((domain, relative_path), data) = max(contents.items(), key=lambda item: len(item[1]))
+    file_info = fs.get_entry(domain, relative_path)
+    # Same size, so only the digest can tell
+    with open(file_info.get_path(), "r+b") as blob:
+        blob.seek(len(data) // 2)
+        blob.write(bytes([data[len(data) // 2] ^ 0xFF]))
+    result = verify(fs, workers=1)
+    assert [error["path"] for error in result["errors"]] == [mount_path(domain, relative_path)]
+    assert result["errors"][0]["error"].startswith("digest is ")